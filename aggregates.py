@@ -0,0 +1,102 @@
+"""
+Incrementally maintained aggregates over groups of topics, like "is any light
+in this room on".
+
+Each group has an output topic, its member topics and a predicate telling
+whether a payload counts as active. The set of active members and the number
+of members without a known value are updated on every message of a member,
+so reading an aggregate does not scan the members. `on_change` is called
+with the output topic and its new value (`b'\x01'` if any member is active,
+otherwise `b'\x00'`) when that value changes. Until every member has a known
+value the aggregate is unknown (`value` is None) and not reported.
+"""
+
+
+PREDICATES = {
+        # lights, sockets, windows
+        'on': lambda payload: payload != b'\x00',
+        # dmx channels
+        'nonzero': lambda payload: any(payload),
+    }
+
+
+class AggregateGroup():
+
+    __slots__ = ('output_topic', 'topics', 'predicate', 'active', 'unknown', 'value')
+
+    def __init__(self, output_topic, topics, predicate):
+        self.output_topic = output_topic
+        self.topics = topics
+        self.predicate = predicate
+        self.active = set()
+        self.unknown = len(topics)
+        self.value = None
+
+
+class AggregateEngine():
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.groups = {}
+
+        # member topic -> (group, ...)
+        self._member_groups = {}
+        # member topics with a known value
+        self._known = set()
+        # member topics tuple -> group
+        self._by_topics = {}
+
+    def add(self, output_topic, topics, predicate='on'):
+        topics = tuple(topics)
+        group = AggregateGroup(output_topic, topics, PREDICATES[predicate])
+        self.groups[output_topic] = group
+        self._by_topics[topics] = group
+
+        for t in topics:
+            self._member_groups[t] = self._member_groups.get(t, ()) + (group,)
+
+    def update(self, topic, payload, notify=True):
+        groups = self._member_groups.get(topic)
+        if groups is None:
+            return
+
+        known = topic in self._known
+        self._known.add(topic)
+
+        for group in groups:
+            active = group.predicate(payload)
+
+            if not known:
+                group.unknown -= 1
+            elif active == (topic in group.active):
+                continue
+
+            if active:
+                group.active.add(topic)
+            else:
+                group.active.discard(topic)
+
+            if group.unknown:
+                continue
+
+            value = b'\x01' if group.active else b'\x00'
+            if value != group.value:
+                group.value = value
+                if notify and self.on_change is not None:
+                    self.on_change(group.output_topic, value)
+
+    def seed(self, items):
+        """
+        Set the values of `(topic, payload)` pairs without calling `on_change`.
+        """
+
+        for topic, payload in items:
+            self.update(topic, payload, notify=False)
+
+    def group(self, topics):
+        """
+        The group with exactly the members `topics`, or None.
+        """
+
+        return self._by_topics.get(tuple(topics))
+
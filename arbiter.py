@@ -0,0 +1,269 @@
+"""
+Decides which of several writers controls a DMX channel.
+
+Scripts write through an `ArbiterSource` with a priority. Per channel the
+sources with the highest priority win; their payloads are merged either
+latest takes precedence (LTP, the default) or highest takes precedence (HTP,
+the per byte maximum). Manual control (a payload on the channel from
+outside) holds the channel and the channels depending on it for
+`manual_hold` seconds since the last manual payload, after which the
+channels are released back to the scripts. The sources which wrote a
+channel are told when a hold of it starts and ends.
+
+Writes only mark channels as changed, `flush` (once per frame) resolves the
+changed and released channels and publishes the results which differ from
+the last published ones; a channel no source writes any more is set to zeros
+once. With `publish_frame`, rooms whose channels are all set by scripts are
+published as one `dmx/<room>/frame` (see `dmxframe.py`) instead of one
+message per changed channel. The channels depending on each channel are
+expanded once when the arbiter is created, so a frame costs the same no
+matter how many channels and scripts there are.
+"""
+
+import heapq
+import itertools
+
+import dmxframe
+
+
+LTP = 'ltp'
+HTP = 'htp'
+
+
+class ArbiterSource():
+
+    __slots__ = ('arbiter', 'name', 'priority', 'channels', 'on_hold')
+
+    def __init__(self, arbiter, name, priority):
+        self.arbiter = arbiter
+        self.name = name
+        self.priority = priority
+        # channels written by this source
+        self.channels = set()
+        # `on_hold(channel, held)`, called when a manual hold of a channel
+        # written by this source starts (`held` True) and ends
+        self.on_hold = None
+
+    def publish(self, channel, payload):
+        self.arbiter.write(self, channel, payload)
+
+    def release(self, channel):
+        self.arbiter.release(self, channel)
+
+
+def lock_closures(dependencies, channels=()):
+    """
+    Channel -> frozenset of the channel and all channels depending on it
+    (transitively), from `dependencies` (channel -> list of channels).
+    """
+
+    closures = {}
+
+    def closure(channel, visiting=()):
+        if channel not in closures:
+            result = {channel}
+            for c in dependencies.get(channel, ()):
+                if c not in visiting:
+                    result |= closure(c, visiting + (channel,))
+            closures[channel] = frozenset(result)
+        return closures[channel]
+
+    for channel in itertools.chain(dependencies, channels):
+        closure(channel)
+    return closures
+
+
+class ChannelArbiter():
+
+    manual_hold = 600
+
+    def __init__(self, publish, channels, dependencies=None, merge_modes=None, manual_hold=None,
+                 publish_frame=None, rooms=None):
+        """
+        `publish(channel, payload)` sends the resolved payloads, `channels`
+        are the channels which may be written, `dependencies` maps a channel
+        to the channels held with it by manual control and `merge_modes` a
+        channel to `LTP` or `HTP`. Channels are not checked here, the
+        scripts only write allowed channels.
+
+        `publish_frame(room, frame)` sends frames of the `rooms` (room ->
+        channels).
+        """
+
+        self.publish = publish
+        self.channels = frozenset(channels)
+        self.closures = lock_closures(dependencies or {}, self.channels)
+        self.merge_modes = dict(merge_modes or {})
+        if manual_hold is not None:
+            self.manual_hold = manual_hold
+
+        # channel -> {source: (payload, sequence)}
+        self.writes = {}
+        # channel -> time the manual hold ends
+        self.held = {}
+        self._hold_heap = []
+        self._sequence = itertools.count()
+
+        self.publish_frame = publish_frame
+        self.rooms = {room: tuple(channels) for room, channels in (rooms or {}).items()} if publish_frame else {}
+        self.channel_rooms = {c: room for room, channels in self.rooms.items() for c in channels}
+        self.frames = 0
+
+        self.dirty = set()
+        # keyframes: channels to publish even if unchanged
+        self.forced = set()
+        self.last_sent = {}
+
+    def source(self, name, priority=0):
+        return ArbiterSource(self, name, priority)
+
+    def remove(self, source):
+        """
+        Drop the writes of a source, e.g. of a stopped script.
+        """
+
+        for channel in source.channels:
+            self.writes[channel].pop(source, None)
+            self.dirty.add(channel)
+        source.channels.clear()
+
+    def release(self, source, channel):
+        """
+        Drop the write of a source to one channel.
+        """
+
+        if channel in source.channels:
+            source.channels.discard(channel)
+            self.writes[channel].pop(source, None)
+            self.dirty.add(channel)
+
+    def write(self, source, channel, payload):
+        writes = self.writes.get(channel)
+        if writes is None:
+            writes = self.writes[channel] = {}
+
+        previous = writes.get(source)
+        if previous is not None and previous[0] == payload:
+            # repeated by the source's keyframe
+            self.forced.add(channel)
+
+        writes[source] = (payload, next(self._sequence))
+        source.channels.add(channel)
+        self.dirty.add(channel)
+
+    def manual(self, channel, now):
+        """
+        A payload from outside was seen on `channel`, hold it and the
+        channels depending on it.
+        """
+
+        until = now + self.manual_hold
+        started = []
+        for c in self.closures.get(channel, (channel,)):
+            # one heap entry per held channel, moved on when it comes up
+            if c not in self.held:
+                heapq.heappush(self._hold_heap, (until, c))
+                started.append(c)
+            self.held[c] = until
+            # the manual payload is what receivers have now
+            self.last_sent.pop(c, None)
+
+        self._notify_hold(started, True)
+
+    def is_held(self, channel):
+        return channel in self.held
+
+    def resolve(self, channel):
+        """
+        The payload the scripts set for `channel`, or None.
+        """
+
+        writes = self.writes.get(channel)
+        if not writes:
+            return None
+
+        top = max(source.priority for source in writes)
+        winners = [w for source, w in writes.items() if source.priority == top]
+
+        if len(winners) == 1:
+            return winners[0][0]
+        if self.merge_modes.get(channel, LTP) == HTP:
+            return bytes(map(max, itertools.zip_longest(*(payload for payload, _ in winners), fillvalue=0)))
+        return max(winners, key=lambda w: w[1])[0]
+
+    def flush(self, now):
+        """
+        Release expired manual holds and publish the changed channels.
+        """
+
+        released = []
+        while self._hold_heap and self._hold_heap[0][0] <= now:
+            _, channel = heapq.heappop(self._hold_heap)
+            until = self.held[channel]
+            if until > now:
+                heapq.heappush(self._hold_heap, (until, channel))
+            else:
+                del self.held[channel]
+                self.dirty.add(channel)
+                released.append(channel)
+
+        if released:
+            self._notify_hold(released, False)
+
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, set()
+        forced, self.forced = self.forced, set()
+        # channel -> payload to publish
+        changes = {}
+        # room -> changed channels, published as a frame
+        room_changes = {}
+
+        for channel in dirty:
+            if channel in self.held:
+                continue
+            payload = self.resolve(channel)
+            if payload is None:
+                previous = self.last_sent.pop(channel, None)
+                if previous is None:
+                    continue
+                # no source writes the channel any more, turn it off
+                payload = bytes(len(previous))
+            elif payload != self.last_sent.get(channel) or channel in forced:
+                self.last_sent[channel] = payload
+            else:
+                continue
+
+            room = self.channel_rooms.get(channel)
+            if room is not None:
+                changes[channel] = payload
+                room_changes.setdefault(room, []).append(channel)
+            else:
+                self.publish(channel, payload)
+
+        for room, changed in room_changes.items():
+            # a frame sets all channels of the room, only send it if the
+            # sources set all of them now
+            channels = self.rooms[room]
+            payloads = [None if c in self.held else self.resolve(c) for c in channels]
+
+            if None in payloads:
+                for c in changed:
+                    self.publish(c, changes[c])
+            else:
+                self.frames += 1
+                self.publish_frame(room, dmxframe.pack(payloads))
+
+    def _notify_hold(self, channels, held):
+        for channel in channels:
+            for source in list(self.writes.get(channel, ())):
+                if source.on_hold is not None:
+                    source.on_hold(channel, held)
+
+    def stats(self):
+        return {
+                'channels': len(self.writes),
+                'held': len(self.held),
+                'frames': self.frames,
+            }
@@ -5,11 +5,11 @@ A control script for our H6510BD Acer projector.
 """
 
 import argparse
+import functools
 import logging
 import queue
 import re
 import serial
-import sys
 import threading
 import time
 
@@ -68,8 +68,8 @@ class MQTT_beamer_controller(helpers.MQTT_Client):
             ('beamer/plenar/control', 0),
         ]
 
-    def __init__(self, serial_thread, clientId='beamer-control', mqtt_host='autoc4', keepalive=60, heartbeat=True):
-        super().__init__(clientId, mqtt_host=mqtt_host, keepalive=keepalive, heartbeat=heartbeat, daemon=True)
+    def __init__(self, serial_thread, clientId='beamer-control', mqtt_host='autoc4', keepalive=60, heartbeat=True, **kwargs):
+        super().__init__(clientId, mqtt_host=mqtt_host, keepalive=keepalive, heartbeat=heartbeat, daemon=True, **kwargs)
         self.serial_thread = serial_thread
 
     def on_message(self, client, userdata, msg):
@@ -103,7 +103,9 @@ class SerialThread(threading.Thread):
     current_song = None
     current_state = None
 
-    def __init__(self, serial_device, baudrate, *args, **kwargs):
+    lamp_query_interval = 60
+
+    def __init__(self, serial_device, baudrate, scheduler, *args, **kwargs):
         super().__init__(*args, daemon=True, **kwargs)
 
         self.serial_device = serial_device
@@ -113,8 +115,8 @@ class SerialThread(threading.Thread):
         self.current_command = None
         self.current_lamp_status = None
 
-        self.last_lamp_query = time.time()
-        self.deferred_commands = []
+        self.scheduler = scheduler
+        scheduler.every(self.lamp_query_interval, self.queue_automatic_queries, name='lamp query')
 
     def request_stop(self):
         self.should_stop = True
@@ -246,28 +248,23 @@ class SerialThread(threading.Thread):
             self.queue_on_only_queries()
 
     def queue_automatic_queries(self):
-        if time.time() - self.last_lamp_query > 60:
-            try:
-                self.queue_lamp_query()
-            except queue.Full:
-                pass
+        if not self.command_queue.empty():
             return
 
-        now = time.time()
-        for i in range(len(self.deferred_commands)):
-            if self.deferred_commands[i][1] <= now:
-                cmd, _ = self.deferred_commands.pop(i)
-                try:
-                    self.queue_command(cmd)
-                except queue.Full:
-                    pass # shouldn't happen, but to be safe
-                return
+        try:
+            self.queue_lamp_query()
+        except queue.Full:
+            pass
+
+    def queue_deferred_command(self, cmd):
+        try:
+            self.queue_command(cmd)
+        except queue.Full:
+            pass # shouldn't happen, but to be safe
 
     def on_command_sent(self, cmd):
-        if cmd == QUERY_COMMANDS['lamp status']:
-            self.last_lamp_query = time.time()
-        elif cmd in ( ALLOWED_COMMANDS['power on'], ALLOWED_COMMANDS['power off']):
-            self.deferred_commands.append((QUERY_COMMANDS['lamp status'], time.time() + 5))
+        if cmd in ( ALLOWED_COMMANDS['power on'], ALLOWED_COMMANDS['power off']):
+            self.scheduler.after(5, functools.partial(self.queue_deferred_command, QUERY_COMMANDS['lamp status']), name='lamp status')
 
     def main_loop(self):
 
@@ -295,9 +292,6 @@ class SerialThread(threading.Thread):
                     if not current_buffer and self.current_command is None:
                         # line buffer empty, may queue command
 
-                        if self.command_queue.empty():
-                            self.queue_automatic_queries()
-
                         self.send_command()
 
                     elif current_buffer and time.time() - last_data_received > 10:
@@ -305,6 +299,19 @@ class SerialThread(threading.Thread):
                         current_buffer = b''
 
 
+def create_daemon(args):
+    logging.info('starting beamer control script')
+
+    scheduler = helpers.get_scheduler()
+
+    serial_thread = SerialThread('/dev/ttyUSB0', 9600, scheduler)
+    serial_thread.start()
+
+    mqtt_thread = MQTT_beamer_controller(serial_thread, **helpers.get_client_kwargs(args))
+
+    return helpers.Daemon(mqtt_thread, [serial_thread, scheduler], None)
+
+
 def main():
     parser = argparse.ArgumentParser(
             description='MQTT Beamer Control',
@@ -315,19 +322,7 @@ def main():
 
     logging.info('starting')
 
-    logging.info('starting beamer control script')
-
-    serial_thread = SerialThread('/dev/ttyUSB0', 9600)
-    serial_thread.start()
-
-    mqtt_thread = MQTT_beamer_controller(serial_thread)
-    mqtt_thread.start()
-
-    while mqtt_thread.is_alive() and serial_thread.is_alive():
-        time.sleep(1)
-
-    logging.info('exiting')
-    sys.exit(1)
+    helpers.run_daemon(create_daemon(args))
 
 if __name__ == '__main__':
     main()
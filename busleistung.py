@@ -180,35 +180,35 @@ class DisplayManager(threading.Thread):
 
 
 
-def main():
-    parser = argparse.ArgumentParser(
-            description='Busleisten Kontrollatöör',
-            parents=[helpers.get_default_parser()],
-        )
-    args = parser.parse_args()
-    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
-
-    logging.info('starting')
-
+def create_daemon(args):
     logging.info('starting display manager')
     dm = DisplayManager()
     dm.start()
 
-    logging.info('starting mqtt client')
-    mqtt_thread = MQTT_Thread(dm, mqtt_host='172.23.23.110', heartbeat=True, heartbeat_blank=True)
+    mqtt_kwargs = {'mqtt_host': '172.23.23.110'}
+    mqtt_kwargs.update(helpers.get_client_kwargs(args))
+    mqtt_thread = MQTT_Thread(dm, heartbeat=True, heartbeat_blank=True, **mqtt_kwargs)
     dm.mqtt_thread = mqtt_thread
-    mqtt_thread.start()
 
     # time.sleep(10)
     # dm.change_module('OpenChaos')
     # time.sleep(10)
     # return
 
-    while mqtt_thread.is_alive() and dm.is_alive():
-        time.sleep(1)
+    return helpers.Daemon(mqtt_thread, [dm], None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Busleisten Kontrollatöör',
+            parents=[helpers.get_default_parser()],
+        )
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    logging.info('starting')
 
-    logging.info('exiting')
-    sys.exit(1)
+    helpers.run_daemon(create_daemon(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+"""
+Compact binary capture files of MQTT traffic.
+
+A capture starts with `MAGIC`, followed by records of a fixed size header
+(time, flags, topic length, payload length) and the topic and payload bytes.
+Flags hold the retain bit and the QoS.
+"""
+
+import struct
+from collections import namedtuple
+
+from paho.mqtt.client import MQTTMessageInfo, MQTT_ERR_SUCCESS
+
+
+MAGIC = b'AC4CAP\x01'
+RECORD = struct.Struct('<dBHI') # time, flags, topic length, payload length
+
+FLAG_RETAIN = 0x01
+FLAG_QOS_SHIFT = 1
+
+CapturedMessage = namedtuple('CapturedMessage', ['time', 'topic', 'payload', 'qos', 'retain'])
+
+
+class CaptureWriter():
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self.count = 0
+
+    def write(self, t, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+        topic = topic.encode('utf-8')
+        flags = (FLAG_RETAIN if retain else 0) | (qos << FLAG_QOS_SHIFT)
+
+        self._file.write(RECORD.pack(t, flags, len(topic), len(payload)) + topic + payload)
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Yields the `CapturedMessage`s of a capture file. An incomplete last
+    record (from an interrupted recording) is ignored.
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        raise ValueError('not a capture file: {}'.format(path))
+
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        t, flags, topic_len, payload_len = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        end = start + topic_len + payload_len
+        if end > len(data):
+            break
+
+        yield CapturedMessage(
+                t,
+                data[start:start + topic_len].decode('utf-8'),
+                data[start + topic_len:end],
+                flags >> FLAG_QOS_SHIFT,
+                bool(flags & FLAG_RETAIN),
+            )
+
+        offset = end
+
+
+class RecordingClient():
+    """
+    Stand-in for the paho client which records published messages instead of
+    sending them. `clock` gives the time stored with each message.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.published = []
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+
+        t = self.clock() if self.clock is not None else 0.0
+        self.published.append(CapturedMessage(t, topic, payload, qos, retain))
+
+        self._mid += 1
+        info = MQTTMessageInfo(self._mid)
+        info.rc = MQTT_ERR_SUCCESS
+        return info
+
+    def subscribe(self, *args, **kwargs):
+        pass
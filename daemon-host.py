@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+Runs several daemons in one process on one shared broker connection, instead
+of one interpreter and connection per daemon.
+
+Usage:
+    python daemon-host.py logicer skynet beamer-control [--state-file ...]
+
+Every daemon module provides `create_daemon(args)` (and optionally
+`add_arguments(parser)` for its own options), see `helpers.Daemon`. The
+daemons keep their heartbeat topics; the connection's will only covers the
+host's own heartbeat (`heartbeat/<--client-id>`).
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+import helpers
+
+
+DAEMONS = [
+        'logicer',
+        'mpd-transport',
+        'beamer-control',
+        'skynet',
+        'busleistung',
+    ]
+
+
+def load_daemon_module(name):
+    # the daemon scripts are not importable by name because of the dashes
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='MQTT daemon host',
+            parents=[helpers.get_default_parser()],
+        )
+    parser.add_argument('daemons', nargs='+', choices=DAEMONS, metavar='daemon', help='Daemons to run: ' + ', '.join(DAEMONS))
+    parser.add_argument('--client-id', default='daemon-host', help='Client id and heartbeat name of the shared connection')
+
+    # the daemon options have to be known before parsing
+    names = [a for a in sys.argv[1:] if a in DAEMONS]
+    modules = {name: load_daemon_module(name) for name in dict.fromkeys(names)}
+    for module in modules.values():
+        if hasattr(module, 'add_arguments'):
+            module.add_arguments(parser)
+
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    logging.info('starting')
+
+    host = helpers.MQTT_Host(args.client_id, **helpers.get_client_kwargs(args))
+
+    # the messages of all daemons are journalled once, by the host
+    daemon_args = argparse.Namespace(**vars(args))
+    daemon_args.journal_dir = None
+
+    daemons = []
+    for name, module in modules.items():
+        logging.info('starting {}'.format(name))
+        daemon = module.create_daemon(daemon_args)
+        host.attach(daemon.client)
+        daemons.append(daemon)
+
+    host.start()
+
+    threads = [t for daemon in daemons for t in daemon.threads]
+    while host.is_alive() and all(t.is_alive() for t in threads):
+        time.sleep(1)
+
+    logging.info('exiting')
+    for daemon in daemons:
+        if daemon.on_exit is not None:
+            daemon.on_exit()
+    host.publish_wills()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+"""
+Compares setting all DMX channels of a room with one message per channel and
+with one `dmx/<room>/frame` message (see `dmxframe.py`), end-to-end through
+an MQTT broker.
+
+Every tick all channels of `--room` get a new payload holding a sequence
+number in its first 4 bytes. The latency of a tick is the time until the
+last of its channels arrived at the receiver. Paths:
+
+    channels:       one message per channel topic
+    frame:          one frame, fanned out to the channel topics by the logicer
+    frame-native:   one frame, received as frame
+
+By default the test runs against an in-process `mqttbroker.MQTTBroker` with
+the logicer in-process, like `mqtt-loadtest.py`.
+
+Usage:
+    python dmx-frame-benchmark.py [--rate 30] [--seconds 5] [--room wohnzimmer] [--latency-ms 0]
+"""
+
+import argparse
+import struct
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+
+import dmxframe
+import helpers
+import logicer
+import mqttbroker
+
+
+PATHS = ['channels', 'frame', 'frame-native']
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class FrameBenchmark():
+
+    payload_size = 8
+
+    def __init__(self, host, port, room, path):
+        self.room = room
+        self.path = path
+        self.channels = logicer.MQTTLogicer.room_dmx_channels[room]
+        self.frame_topic = 'dmx/' + room + '/frame'
+
+        # sequence number -> (send time, channels still missing)
+        self.pending = {}
+        self.latencies = []
+        self.published = 0
+        self.received = 0
+        self.lock = threading.Lock()
+        self.subscribed = threading.Event()
+
+        self.receiver = mqtt_client.Client('frame-benchmark-receiver')
+        self.receiver.on_connect = self.on_connect
+        self.receiver.on_subscribe = lambda *a: self.subscribed.set()
+        self.receiver.on_message = self.on_message
+        self.receiver.connect(host, port, 60)
+        self.receiver.loop_start()
+
+        self.sender = mqtt_client.Client('frame-benchmark-sender')
+        self.sender.connect(host, port, 60)
+        self.sender.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if self.path == 'frame-native':
+            client.subscribe(self.frame_topic)
+        else:
+            client.subscribe('dmx/' + self.room + '/+')
+
+    def on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+
+        if self.path == 'frame-native':
+            payloads = dmxframe.unpack(msg.payload)
+        elif msg.topic in self.channels and len(msg.payload) >= 4:
+            payloads = [msg.payload]
+        else:
+            return
+
+        with self.lock:
+            self.received += 1
+            for payload in payloads:
+                seq, = struct.unpack_from('!I', payload)
+                pending = self.pending.get(seq)
+                if pending is None:
+                    continue
+                pending[1] -= 1
+                if not pending[1]:
+                    del self.pending[seq]
+                    self.latencies.append(now - pending[0])
+
+    def send(self, seq):
+        payload = struct.pack('!I', seq) + b'\xff' * (self.payload_size - 4)
+
+        with self.lock:
+            self.pending[seq] = [time.perf_counter(), len(self.channels)]
+
+        if self.path == 'channels':
+            for t in self.channels:
+                self.sender.publish(t, payload, retain=True)
+            self.published += len(self.channels)
+        else:
+            self.sender.publish(self.frame_topic, dmxframe.pack([payload] * len(self.channels)))
+            self.published += 1
+
+    def run(self, rate, seconds):
+        interval = 1 / rate
+        start = time.perf_counter()
+
+        for seq in range(1, int(rate * seconds) + 1):
+            deadline = start + seq * interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(seq)
+
+        # wait for stragglers
+        time.sleep(1)
+        for client in (self.sender, self.receiver):
+            client.disconnect()
+            client.loop_stop()
+
+        return time.perf_counter() - start - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='DMX frame vs per-channel benchmark',
+            parents=[helpers.get_default_parser()],
+        )
+    parser.add_argument('--rate', type=float, default=30, help='Room updates per second')
+    parser.add_argument('--seconds', type=float, default=5, help='Duration per path')
+    parser.add_argument('--room', default='wohnzimmer', choices=[r for r, c in logicer.MQTTLogicer.room_dmx_channels.items() if c])
+    parser.add_argument('--path', action='append', choices=PATHS, help='Paths to measure (default: all)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Injected latency of the in-process broker')
+    parser.set_defaults(loglevel='warning')
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    host = args.mqtt_host or '127.0.0.1'
+    port = args.mqtt_port
+
+    if port is None:
+        broker = mqttbroker.MQTTBroker(host, 0, args.latency_ms / 1e3)
+        broker.start()
+        port = broker.port
+
+        # retained state a production broker would hold, the logicer rules
+        # expect it
+        for t in logicer.MQTTLogicer.alle_lichter + logicer.MQTTLogicer.dmx_channels + ['relais/plenar/dmx', 'relais/fnord/dmx', 'club/status']:
+            broker.publish(t, b'\x00', 0, True)
+
+    lg = logicer.MQTTLogicer(mqtt_host=host, mqtt_port=port)
+    lg.start()
+    while not lg.connection_established:
+        time.sleep(0.01)
+
+    print('{:<14}{:>10}{:>10}{:>10}{:>8}{:>10}{:>10}{:>10}'.format(
+            'path', 'updates/s', 'sent/s', 'recv/s', 'lost', 'p50 ms', 'p90 ms', 'p99 ms'))
+
+    for path in args.path or PATHS:
+        bench = FrameBenchmark(host, port, args.room, path)
+        bench.subscribed.wait(5)
+        # retained channel messages of the previous path
+        time.sleep(0.2)
+        with bench.lock:
+            bench.received = 0
+
+        duration = bench.run(args.rate, args.seconds)
+
+        latencies = sorted(bench.latencies)
+        print('{:<14}{:>10.0f}{:>10.0f}{:>10.0f}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                path,
+                len(latencies) / duration,
+                bench.published / duration,
+                bench.received / duration,
+                len(bench.pending),
+                percentile(latencies, 50) * 1e3,
+                percentile(latencies, 90) * 1e3,
+                percentile(latencies, 99) * 1e3,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Fades of DMX channels, computed for all channels at once.
+
+The values of all channels are rows of one NumPy array (one column per byte
+of the payload, like `dmx/<room>/<channel>` takes them). `step` advances
+every running fade in one vectorized computation and returns the channels
+whose bytes changed since they were last returned, so a frame costs the same
+for one fading channel as for all of them and unchanged channels are not
+published again.
+"""
+
+import threading
+
+import numpy as np
+
+
+# progress (0..1) -> eased progress (0..1), applied to arrays
+EASINGS = {
+        'linear':   lambda p: p,
+        'in':       lambda p: p * p,
+        'out':      lambda p: p * (2 - p),
+        'in_out':   lambda p: p * p * (3 - 2 * p),
+    }
+EASING_NAMES = list(EASINGS)
+
+
+class FadeEngine():
+
+    # bytes per channel
+    width = 8
+
+    # frames per second `step` is meant to be called at
+    fps = 30
+
+    def __init__(self, channels, fps=None):
+        self.channels = list(channels)
+        self.index = {c: row for row, c in enumerate(self.channels)}
+        if fps is not None:
+            self.fps = fps
+
+        n = len(self.channels)
+        self.values = np.zeros((n, self.width))
+        self.start = np.zeros((n, self.width))
+        self.target = np.zeros((n, self.width))
+        self.start_time = np.zeros(n)
+        self.duration = np.zeros(n)
+        self.easing = np.zeros(n, dtype=np.int8)
+        self.active = np.zeros(n, dtype=bool)
+
+        # bytes last returned by `step`, and the payload length per channel
+        self.sent = np.zeros((n, self.width), dtype=np.uint8)
+        self.lengths = np.full(n, self.width)
+
+        self.fading = 0
+        self.frames = 0
+        self.changed = 0
+        self._lock = threading.Lock()
+
+    def fade(self, channels, target, duration, now, easing='linear', current_value=None):
+        """
+        Fade `channels` from their current value to the payload `target`
+        within `duration` seconds. Channels which are not fading start from
+        `current_value(channel)` (a payload or None) if given. Unknown
+        channels are ignored.
+        """
+
+        if easing not in EASINGS:
+            raise ValueError('unknown easing: {}'.format(easing))
+        target = bytes(target[:self.width])
+
+        with self._lock:
+            rows = []
+            for c in channels:
+                row = self.index.get(c)
+                if row is None:
+                    continue
+                rows.append(row)
+
+                if not self.active[row] and current_value is not None:
+                    payload = current_value(c)
+                    if payload is not None:
+                        payload = payload[:self.width]
+                        self.values[row] = 0
+                        self.values[row, :len(payload)] = list(payload)
+                        self.sent[row] = self.values[row]
+
+            rows = np.array(rows, dtype=np.intp)
+            self.start[rows] = self.values[rows]
+            self.target[rows] = 0
+            self.target[rows, :len(target)] = list(target)
+            self.start_time[rows] = now
+            self.duration[rows] = duration
+            self.easing[rows] = EASING_NAMES.index(easing)
+            self.lengths[rows] = len(target)
+            self.active[rows] = True
+            self.fading = int(self.active.sum())
+
+    def take_over(self, other):
+        """
+        Continue the fades of the engine `other` (e.g. the one of the rules
+        before a reload) for the channels both engines have.
+        """
+
+        with other._lock, self._lock:
+            self.frames = other.frames
+            self.changed = other.changed
+
+            rows = [(row, other.index[c]) for row, c in enumerate(self.channels) if c in other.index]
+            if not rows:
+                return
+
+            new, old = np.array(rows, dtype=np.intp).T
+            for name in ('values', 'start', 'target', 'start_time', 'duration', 'easing', 'active', 'sent', 'lengths'):
+                getattr(self, name)[new] = getattr(other, name)[old]
+            self.fading = int(self.active.sum())
+
+    def cancel(self, channels):
+        """
+        Stop the fades of `channels`, e.g. because they were set directly.
+        """
+
+        if not self.fading:
+            return
+
+        with self._lock:
+            for c in channels:
+                row = self.index.get(c)
+                if row is not None:
+                    self.active[row] = False
+            self.fading = int(self.active.sum())
+
+    def step(self, now):
+        """
+        Advance all fades to `now`. Returns `(channel, payload)` of the
+        channels whose bytes changed.
+        """
+
+        if not self.fading:
+            return []
+
+        with self._lock:
+            rows = np.flatnonzero(self.active)
+
+            duration = self.duration[rows]
+            progress = np.ones(len(rows))
+            np.divide(now - self.start_time[rows], duration, out=progress, where=duration > 0)
+            np.clip(progress, 0, 1, out=progress)
+
+            eased = progress.copy()
+            easing = self.easing[rows]
+            for code, name in enumerate(EASING_NAMES):
+                mask = easing == code
+                if code and mask.any():
+                    eased[mask] = EASINGS[name](progress[mask])
+
+            start = self.start[rows]
+            values = start + (self.target[rows] - start) * eased[:, np.newaxis]
+            self.values[rows] = values
+
+            frame = np.rint(values).astype(np.uint8)
+            changed = (frame != self.sent[rows]).any(axis=1)
+            self.sent[rows] = frame
+
+            self.active[rows[progress >= 1]] = False
+            self.fading = int(self.active.sum())
+            self.frames += 1
+
+            result = [
+                    (self.channels[row], frame[i, :self.lengths[row]].tobytes())
+                    for i, row in zip(np.flatnonzero(changed), rows[changed])
+                ]
+            self.changed += len(result)
+
+        return result
+
+    def stats(self):
+        return {
+                'fading': self.fading,
+                'frames': self.frames,
+                'changed': self.changed,
+            }
@@ -0,0 +1,44 @@
+"""
+Packed frames of the DMX channels of a room, sent as `dmx/<room>/frame`
+instead of one message per channel.
+
+A frame is one byte holding the number of bytes per channel (the stride),
+followed by the payload of each channel of the room in the order of
+`logicer_rules.room_dmx_channels`, each padded with zeros to the stride.
+A frame may hold fewer channels than the room has, the remaining ones are
+left as they are.
+"""
+
+
+def pack(payloads, stride=None):
+    """
+    Frame of the channel `payloads`, the stride defaults to the longest one.
+    """
+
+    if stride is None:
+        stride = max(len(p) for p in payloads)
+    if not 0 < stride < 256:
+        raise ValueError('invalid stride: {}'.format(stride))
+
+    frame = bytearray((stride,))
+    for p in payloads:
+        if len(p) > stride:
+            raise ValueError('payload longer than stride: {}'.format(len(p)))
+        frame += p
+        frame += bytes(stride - len(p))
+    return bytes(frame)
+
+
+def unpack(frame):
+    """
+    The channel payloads of a frame.
+    """
+
+    if not frame:
+        raise ValueError('empty frame')
+
+    stride = frame[0]
+    if stride == 0 or (len(frame) - 1) % stride:
+        raise ValueError('frame length {} does not match stride {}'.format(len(frame), stride))
+
+    return [frame[i:i + stride] for i in range(1, len(frame), stride)]
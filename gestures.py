@@ -0,0 +1,254 @@
+"""
+Gesture recognition for push buttons and switches (`schalter/*` topics).
+
+A `GestureEngine` turns the raw on/off messages of a switch into gestures and
+calls the handler configured for the switch with `(topic, gesture)`:
+
+    press, release  debounced edges
+    short           released before `long_press` seconds
+    long            released after being held for more than `long_press`
+    hold            still held `long_press` seconds after the press (only with
+                    `hold=True`, the release then is not reported as `long`)
+    double          pressed again within `double_press` seconds after a short
+                    press (the short press is only reported once the window
+                    passed without a second press)
+    repeat          like short, but within `cycle_window` seconds of the
+                    previous short/repeat gesture
+
+Debouncing reports the first edge immediately and ignores further edges for
+`debounce` seconds; if the contact settled in the other state by then, the
+matching edge is reported when the debounce time is over.
+
+The state per switch is constant size, and all pending timeouts of all
+switches are kept in a single heap, driven by `poll` (which `feed` calls with
+the message time) and by the `helpers.Scheduler` given to `start`.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class _Switch():
+
+    # what happened so far, the other slots are the configuration
+    state_slots = (
+            'raw', 'state', 'edge_time', 'press_time', 'release_time',
+            'hold_fired', 'short_pending', 'suppress_release', 'last_short',
+        )
+
+    __slots__ = (
+            'topic', 'handler', 'released_value',
+            'debounce', 'long_press', 'hold', 'double_press', 'cycle_window',
+        ) + state_slots
+
+    def __init__(self, topic, handler, released_value, debounce, long_press, hold, double_press, cycle_window):
+        self.topic = topic
+        self.handler = handler
+        self.released_value = released_value
+        self.debounce = debounce
+        self.long_press = long_press
+        self.hold = hold
+        self.double_press = double_press
+        self.cycle_window = cycle_window
+
+        self.raw = None
+        self.state = None
+        self.edge_time = None
+        self.press_time = None
+        self.release_time = None
+        self.hold_fired = False
+        self.short_pending = False
+        self.suppress_release = False
+        self.last_short = None
+
+
+class GestureEngine():
+
+    debounce = 0.03
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.switches = {}
+
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.scheduler = None
+
+    def configure(self, topic, handler, released_value=b'\x00', debounce=None,
+                  long_press=None, hold=False, double_press=None, cycle_window=None):
+        self.switches[topic] = _Switch(
+                topic, handler, released_value,
+                self.debounce if debounce is None else debounce,
+                long_press, hold, double_press, cycle_window,
+            )
+
+    def start(self, scheduler):
+        """
+        Let `scheduler` fire the timeouts, so they do not wait for the next
+        message. Its clock has to match the one of the engine.
+        """
+
+        self.scheduler = scheduler
+        with self._lock:
+            if self._heap:
+                scheduler.at(self._heap[0][0], self.poll, name='gestures')
+
+    def take_over(self, other):
+        """
+        Continue the presses in progress and pending timeouts of the engine
+        `other` (e.g. the one of the rules before a reload) for the switches
+        both engines have. Call before `start`.
+        """
+
+        with other._lock, self._lock:
+            for topic, sw in self.switches.items():
+                old = other.switches.get(topic)
+                if old is not None:
+                    for name in _Switch.state_slots:
+                        setattr(sw, name, getattr(old, name))
+
+            for deadline, _, old in other._heap:
+                sw = self.switches.get(old.topic)
+                if sw is not None:
+                    heapq.heappush(self._heap, (deadline, next(self._sequence), sw))
+
+            # jobs of `other` still scheduled find nothing to do
+            other._heap = []
+
+    def feed(self, topic, payload, retain=False, now=None):
+        """
+        Process a message. Retained messages only set the current state; a
+        switch whose state is not known yet is taken to be released.
+        """
+
+        sw = self.switches.get(topic)
+        if sw is None:
+            return
+
+        if now is None:
+            now = self.clock()
+
+        self.poll(now)
+
+        events = []
+        with self._lock:
+            pressed = payload != sw.released_value
+            sw.raw = pressed
+
+            if retain:
+                sw.state = pressed
+            elif sw.edge_time is not None and now < sw.edge_time + sw.debounce:
+                # bouncing, decided when the debounce time is over
+                self._schedule(sw, sw.edge_time + sw.debounce)
+            else:
+                if sw.state is None:
+                    # first message after a start, not retained: the switch
+                    # was released before
+                    sw.state = False
+                self._edge(sw, pressed, now, events)
+
+        self._dispatch(events)
+
+    def poll(self, now=None):
+        """
+        Fire all timeouts due at `now`.
+        """
+
+        if now is None:
+            now = self.clock()
+
+        events = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, sw = heapq.heappop(self._heap)
+                self._timeout(sw, deadline, events)
+
+        self._dispatch(events)
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def _schedule(self, sw, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._sequence), sw))
+        if self.scheduler is not None:
+            self.scheduler.at(deadline, self.poll, name='gestures')
+
+    def _edge(self, sw, pressed, now, events):
+        if pressed == sw.state:
+            return
+
+        sw.state = pressed
+        sw.edge_time = now
+        if sw.debounce:
+            self._schedule(sw, now + sw.debounce)
+
+        if pressed:
+            events.append((sw, 'press'))
+            sw.press_time = now
+            sw.hold_fired = False
+
+            if sw.short_pending and now - sw.release_time <= sw.double_press:
+                sw.short_pending = False
+                sw.suppress_release = True
+                events.append((sw, 'double'))
+
+            elif sw.hold and sw.long_press is not None:
+                self._schedule(sw, now + sw.long_press)
+
+            return
+
+        events.append((sw, 'release'))
+
+        if sw.suppress_release:
+            sw.suppress_release = False
+            return
+
+        if sw.hold_fired:
+            return
+
+        duration = now - sw.press_time if sw.press_time is not None else 0
+        sw.press_time = None
+
+        if sw.long_press is not None and duration > sw.long_press:
+            events.append((sw, 'long'))
+
+        elif sw.double_press is not None:
+            sw.short_pending = True
+            sw.release_time = now
+            self._schedule(sw, now + sw.double_press)
+
+        else:
+            self._short(sw, now, events)
+
+    def _short(self, sw, t, events):
+        if sw.cycle_window is not None and sw.last_short is not None and t - sw.last_short <= sw.cycle_window:
+            events.append((sw, 'repeat'))
+        else:
+            events.append((sw, 'short'))
+        sw.last_short = t
+
+    def _timeout(self, sw, now, events):
+        # there may be stale heap entries, so check what actually is due
+        if sw.raw != sw.state and now >= sw.edge_time + sw.debounce:
+            self._edge(sw, sw.raw, now, events)
+
+        if (sw.hold and sw.state and not sw.hold_fired and sw.press_time is not None
+                and now >= sw.press_time + sw.long_press):
+            sw.hold_fired = True
+            events.append((sw, 'hold'))
+
+        if sw.short_pending and now >= sw.release_time + sw.double_press:
+            sw.short_pending = False
+            self._short(sw, sw.release_time, events)
+
+    def _dispatch(self, events):
+        for sw, gesture in events:
+            try:
+                sw.handler(sw.topic, gesture)
+            except Exception:
+                logging.exception('gesture handler exception ({} {})'.format(sw.topic, gesture))
@@ -1,15 +1,474 @@
 import argparse
+import asyncio
+import heapq
+import http.server
+import itertools
+import json
 import logging
+import sys
 from systemd.journal import JournalHandler
 import threading
+import time
+from collections import namedtuple
 from paho.mqtt import client as mqtt_client
 
+import journal
+
+
+class TopicRouter():
+    """
+    Maps MQTT topic filters to handlers.
+
+    Exact topics are kept in a dict, filters containing `+` or `#` in a trie
+    keyed by topic level. The handlers matching a topic are computed once and
+    cached, so dispatching a message costs one dict lookup in the common case.
+    Handlers are returned in the order they were added.
+    """
+
+    max_cache_size = 4096
+
+    def __init__(self, rules=()):
+        self._exact = {}
+        self._trie = {}
+        self._cache = {}
+        self._order = 0
+
+        for topic_filter, handler in rules:
+            self.add(topic_filter, handler)
+
+    def add(self, topic_filter, handler):
+        entry = (self._order, handler)
+        self._order += 1
+
+        if '+' in topic_filter or '#' in topic_filter:
+            node = self._trie
+            for level in topic_filter.split('/'):
+                node = node.setdefault(level, {})
+            node.setdefault(None, []).append(entry)
+        else:
+            self._exact.setdefault(topic_filter, []).append(entry)
+
+        self._cache.clear()
+
+    def match(self, topic):
+        """
+        Return a tuple of all handlers whose filter matches `topic`.
+        """
+
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+
+        entries = list(self._exact.get(topic, ()))
+        if self._trie:
+            self._match_trie(self._trie, topic.split('/'), 0, entries)
+        entries.sort(key=lambda e: e[0])
+        handlers = tuple(h for _, h in entries)
+
+        if len(self._cache) >= self.max_cache_size:
+            # junk topics should not grow the cache without bound
+            self._cache.clear()
+        self._cache[topic] = handlers
+
+        return handlers
+
+    def _match_trie(self, node, levels, i, entries):
+        if '#' in node:
+            entries.extend(node['#'][None])
+
+        if i == len(levels):
+            entries.extend(node.get(None, ()))
+            return
+
+        if levels[i] in node:
+            self._match_trie(node[levels[i]], levels, i + 1, entries)
+        if '+' in node:
+            self._match_trie(node['+'], levels, i + 1, entries)
+
+
+class SceneBatch():
+    """
+    A batch of messages sent by `MQTT_Client.publish_scene`.
+
+    Tracks the outstanding message ids and logs how long it took until the
+    whole batch was acknowledged by the broker. `done` is set at that point.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.published = 0
+        self.skipped = 0
+        self.duration = None
+        self.done = threading.Event()
+
+        self._pending = set()
+        self._sealed = False
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def add(self, mid):
+        with self._lock:
+            self._pending.add(mid)
+        self.published += 1
+
+    def acknowledged(self, mid):
+        with self._lock:
+            self._pending.discard(mid)
+        self._check_done()
+
+    def seal(self):
+        """
+        Called once all messages of the batch have been handed to paho.
+        """
+
+        self._sealed = True
+        self._check_done()
+
+    def _check_done(self):
+        with self._lock:
+            if not self._sealed or self._pending or self.done.is_set():
+                return
+            self.duration = time.monotonic() - self._start
+            self.done.set()
+
+        logging.info('{}: {} messages acknowledged after {:.1f} ms ({} unchanged, skipped)'.format(
+                self.name, self.published, self.duration * 1e3, self.skipped))
+
+
+class ClientMetrics():
+    """
+    Runtime counters of an `MQTT_Client`.
+
+    The message and latency counters are only written from the paho network
+    thread (the one running `on_message`), so plain integer increments are
+    enough. Acknowledgements are counted in whichever thread paho handles
+    them in, with `loop_forever` also threads publishing from outside the
+    callbacks (e.g. scheduler jobs), so `published` is counted under a lock
+    by `message_published`. Readers in other threads may see slightly stale
+    values.
+    """
+
+    # handler latency bucket k counts durations below 2**k microseconds, the
+    # last bucket everything above
+    latency_buckets = 22
+
+    def __init__(self, subscribe_topics=()):
+        self.messages = {}
+        self.latency_counts = [0] * self.latency_buckets
+        self.latency_sum_ns = 0
+        self.published = 0
+        self.connects = 0
+        self._published_lock = threading.Lock()
+
+        self.set_topic_filters(t for t, _ in subscribe_topics)
+
+    def set_topic_filters(self, topic_filters):
+        self._router = TopicRouter()
+        for topic_filter in topic_filters:
+            self._router.add(topic_filter, topic_filter)
+            self.messages.setdefault(topic_filter, 0)
+
+    def message_handled(self, topic, duration_ns):
+        for topic_filter in self._router.match(topic):
+            self.messages[topic_filter] += 1
+
+        self.latency_counts[min((duration_ns // 1000).bit_length(), self.latency_buckets - 1)] += 1
+        self.latency_sum_ns += duration_ns
+
+    def message_published(self, count=1):
+        with self._published_lock:
+            self.published += count
+
+    @staticmethod
+    def queue_depth(paho_client):
+        """
+        Number of packets waiting to be sent plus messages waiting for an
+        acknowledgement in paho.
+        """
+
+        if paho_client is None:
+            return 0
+        return len(getattr(paho_client, '_out_packet', ())) + len(getattr(paho_client, '_out_messages', ()))
+
+    def snapshot(self, paho_client):
+        counts = list(self.latency_counts)
+        return {
+                'messages': dict(self.messages),
+                'handler_latency': {
+                    'le_us': [2 ** k for k in range(self.latency_buckets - 1)] + ['inf'],
+                    'counts': counts,
+                    'count': sum(counts),
+                    'sum_us': self.latency_sum_ns // 1000,
+                },
+                'published': self.published,
+                'queue_depth': self.queue_depth(paho_client),
+                'reconnects': max(self.connects - 1, 0),
+            }
+
+    def prometheus(self, client_id, paho_client):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+
+        label = 'client="{}"'.format(client_id)
+        lines = [
+                '# TYPE mqtt_messages_total counter',
+            ]
+        for topic_filter, count in list(self.messages.items()):
+            lines.append('mqtt_messages_total{{{},filter="{}"}} {}'.format(label, topic_filter, count))
+
+        lines.append('# TYPE mqtt_handler_latency_seconds histogram')
+        cumulative = 0
+        for k, count in enumerate(list(self.latency_counts)):
+            cumulative += count
+            le = '{:g}'.format(2 ** k / 1e6) if k < self.latency_buckets - 1 else '+Inf'
+            lines.append('mqtt_handler_latency_seconds_bucket{{{},le="{}"}} {}'.format(label, le, cumulative))
+        lines.append('mqtt_handler_latency_seconds_sum{{{}}} {}'.format(label, self.latency_sum_ns / 1e9))
+        lines.append('mqtt_handler_latency_seconds_count{{{}}} {}'.format(label, cumulative))
+
+        lines += [
+                '# TYPE mqtt_published_total counter',
+                'mqtt_published_total{{{}}} {}'.format(label, self.published),
+                '# TYPE mqtt_outbound_queue_depth gauge',
+                'mqtt_outbound_queue_depth{{{}}} {}'.format(label, self.queue_depth(paho_client)),
+                '# TYPE mqtt_reconnects_total counter',
+                'mqtt_reconnects_total{{{}}} {}'.format(label, max(self.connects - 1, 0)),
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+
+class ScheduledJob():
+    """
+    A job of the `Scheduler`. `interval` is None for one-shot jobs.
+
+    Keeps statistics on how late the job ran compared to its deadline.
+    """
+
+    __slots__ = (
+            'func', 'name', 'interval', 'deadline', 'cancelled',
+            'runs', 'late_sum', 'late_max', 'late_last', 'skipped',
+        )
+
+    def __init__(self, func, name, interval, deadline):
+        self.func = func
+        self.name = name
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+
+        self.runs = 0
+        self.late_sum = 0
+        self.late_max = 0
+        self.late_last = 0
+        self.skipped = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        return {
+                'runs': self.runs,
+                'late_mean_ms': self.late_sum / self.runs * 1e3 if self.runs else 0,
+                'late_max_ms': self.late_max * 1e3,
+                'late_last_ms': self.late_last * 1e3,
+                'skipped': self.skipped,
+            }
+
+
+class Scheduler(threading.Thread):
+    """
+    Runs periodic and delayed jobs of a daemon from one thread and one heap.
+
+    Periodic jobs are scheduled from their previous deadline, not from when
+    they finished, so they do not drift. With `align=True` deadlines are
+    multiples of the interval in wall clock time (every full minute for
+    `interval=60`). If a job overran, the missed runs are skipped and counted.
+
+    Jobs run one after another in the scheduler thread, so they should not
+    block for long. Exceptions are logged and do not stop periodic jobs.
+    """
+
+    def __init__(self, clock=time.time, *args, **kwargs):
+        super(Scheduler, self).__init__(*args, daemon=True, **kwargs)
+        self.clock = clock
+
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._periodic = []
+
+    def every(self, interval, func, align=False, delay=None, name=None):
+        """
+        Run `func()` every `interval` seconds. The first run is after `delay`
+        seconds (default: one interval), or at the next aligned time.
+        """
+
+        now = self.clock()
+        if align:
+            deadline = (now // interval + 1) * interval
+        else:
+            deadline = now + (interval if delay is None else delay)
+
+        job = ScheduledJob(func, name or _job_name(func), interval, deadline)
+        with self._condition:
+            self._periodic.append(job)
+        return self._add(job)
+
+    def after(self, delay, func, name=None):
+        """
+        Run `func()` once, `delay` seconds from now.
+        """
+
+        return self.at(self.clock() + delay, func, name)
+
+    def at(self, deadline, func, name=None):
+        """
+        Run `func()` once at the time `deadline` of the scheduler clock.
+        """
+
+        return self._add(ScheduledJob(func, name or _job_name(func), None, deadline))
+
+    def stats(self):
+        """
+        Lateness statistics of the periodic jobs, by name.
+        """
+
+        with self._condition:
+            self._periodic = [job for job in self._periodic if not job.cancelled]
+            jobs = list(self._periodic)
+        return {job.name: job.stats() for job in jobs}
+
+    def _add(self, job):
+        with self._condition:
+            heapq.heappush(self._heap, (job.deadline, next(self._sequence), job))
+            if self._heap[0][2] is job:
+                self._condition.notify()
+        return job
+
+    def run(self):
+
+        try:
+            self.main_loop()
+
+        except:
+            logging.exception('Scheduler exception, exiting.')
+
+    def main_loop(self):
+
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    timeout = self._heap[0][0] - self.clock()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+                _, _, job = heapq.heappop(self._heap)
+
+            if job.cancelled:
+                continue
+
+            now = self.clock()
+            late = now - job.deadline
+            job.runs += 1
+            job.late_sum += late
+            job.late_last = late
+            if late > job.late_max:
+                job.late_max = late
+
+            try:
+                job.func()
+            except Exception:
+                logging.exception('scheduled job exception ({})'.format(job.name))
+
+            if job.interval is not None and not job.cancelled:
+                job.deadline += job.interval
+                now = self.clock()
+                if job.deadline <= now:
+                    missed = int((now - job.deadline) // job.interval) + 1
+                    job.skipped += missed
+                    job.deadline += missed * job.interval
+                self._add(job)
+
+
+def _job_name(func):
+    return getattr(func, '__qualname__', None) or repr(func)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    The scheduler shared by everything in this process, started on first use.
+    """
+
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+            _scheduler.start()
+        return _scheduler
+
+
+class MetricsHTTPServer(threading.Thread):
+    """
+    Serves the metrics of an `MQTT_Client` for Prometheus on `/metrics`.
+    """
+
+    def __init__(self, client, port, host='', *args, **kwargs):
+        super(MetricsHTTPServer, self).__init__(*args, daemon=True, **kwargs)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = client.metrics.prometheus(client.clientId, client.mqtt_client).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
 
 class MQTT_Client(threading.Thread):
 
     heartbeat_topic_prefix = 'heartbeat/'
+    metrics_topic_prefix = 'stats/'
     subscribe_topics = []
 
+    # allows `publish_scene` batches to be pipelined instead of trickling out
+    # 20 messages (the paho default) per round trip
+    max_inflight_messages = 200
+
+    # seconds between batched writes of the journal
+    journal_flush_interval = 1
+
+    # seconds between repeated heartbeats, so monitors can tell a hung client
+    # from a quiet one (see liveness.py)
+    heartbeat_interval = 60
+
+    # attached to an `MQTT_Host`, which subscribes for all its clients
+    hosted = False
+
     def __init__(
         self,
         clientId = None,
@@ -18,6 +477,9 @@ class MQTT_Client(threading.Thread):
         keepalive = 60,
         heartbeat = False,
         heartbeat_blank = False,
+        metrics_interval = None,
+        metrics_port = None,
+        journal_dir = None,
         *args,
         **kwargs,
     ):
@@ -48,21 +510,56 @@ class MQTT_Client(threading.Thread):
         #self.connection_established = threading.Event()
         self.connection_established = False
 
+        # message id -> SceneBatch, for batches waiting for acknowledgement
+        self._batches = {}
+        self._batches_lock = threading.Lock()
+        self._batches_publishing = 0
+        self._early_acks = set()
+
+        self.metrics = ClientMetrics(self.subscribe_topics)
+        self.metrics_interval = metrics_interval
+        self.metrics_port = metrics_port
+
+        self.journal = journal.JournalWriter(journal_dir) if journal_dir else None
+
     def run(self):
 
         try:
+            self.start_metrics()
+            self.start_journal()
+            self.start_heartbeat()
             self.main_loop()
 
         except:
             logging.exception('MQTT Client Thread exception, exiting.')
 
+    def start_metrics(self):
+        if self.metrics_interval:
+            get_scheduler().every(self.metrics_interval, self.publish_metrics, name='metrics')
+
+        if self.metrics_port:
+            MetricsHTTPServer(self, self.metrics_port).start()
+
+    def start_heartbeat(self):
+        if self.heartbeat and self.heartbeat_interval:
+            get_scheduler().every(self.heartbeat_interval, self.refresh_heartbeat, name='heartbeat')
+
+    def refresh_heartbeat(self):
+        if self.heartbeat and self.connection_established:
+            self.mqtt_client.publish(self.heartbeat_topic, b'\x01', retain=True)
+
+    def start_journal(self):
+        if self.journal is not None:
+            get_scheduler().every(self.journal_flush_interval, self.journal.flush, name='journal')
+
     def main_loop(self):
 
         self.mqtt_client = mqtt_client.Client(self.clientId)
 
-        self.mqtt_client.on_message = self.on_message
-        self.mqtt_client.on_connect = self.on_connect
-        #self.mqtt_client.on_publish = on_publish
+        self.mqtt_client.on_message = self._handle_message
+        self.mqtt_client.on_connect = self._handle_connect
+        self.mqtt_client.on_publish = self.on_publish
+        self.mqtt_client.max_inflight_messages_set(self.max_inflight_messages)
         #self.mqtt_client.on_subscribe = self.on_subscribe
 
         if self.willTopic is not None:
@@ -79,6 +576,41 @@ class MQTT_Client(threading.Thread):
 
         logging.info('leaving program loop')
 
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.metrics.connects += 1
+            # subscriptions may have been changed after __init__
+            self.metrics.set_topic_filters(t for t, _ in self.subscribe_topics)
+        self.on_connect(client, userdata, flags, rc)
+
+    def _handle_message(self, client, userdata, msg):
+        if self.journal is not None:
+            self.journal.write(time.time(), msg.topic, msg.payload, msg.qos, msg.retain)
+
+        start = time.perf_counter_ns()
+        try:
+            self.on_message(client, userdata, msg)
+        finally:
+            self.metrics.message_handled(msg.topic, time.perf_counter_ns() - start)
+
+    def metrics_snapshot(self):
+        """
+        Metrics to publish, daemons may add their own.
+        """
+
+        metrics = self.metrics.snapshot(self.mqtt_client)
+        if _scheduler is not None:
+            metrics['scheduler'] = _scheduler.stats()
+        return metrics
+
+    def publish_metrics(self):
+        if not self.connection_established:
+            return
+
+        prefix = self.metrics_topic_prefix + self.clientId + '/'
+        for name, value in self.metrics_snapshot().items():
+            self.mqtt_client.publish(prefix + name, json.dumps(value))
+
     def on_connect(self, client, userdata, flags, rc):
 
         try:
@@ -87,7 +619,7 @@ class MQTT_Client(threading.Thread):
 
             else:
                 logging.info('connected, subscribing')
-                if self.subscribe_topics:
+                if self.subscribe_topics and not self.hosted:
                     self.mqtt_client.subscribe(self.subscribe_topics)
 
                 if self.heartbeat:
@@ -103,15 +635,541 @@ class MQTT_Client(threading.Thread):
     def on_message(self, client, userdata, msg):
         pass
 
+    def on_publish(self, client, userdata, mid):
+
+        self.metrics.message_published()
+
+        with self._batches_lock:
+            batch = self._batches.pop(mid, None)
+            if batch is None:
+                if self._batches_publishing:
+                    # acknowledged before publish_scene registered the id
+                    self._early_acks.add(mid)
+                return
+
+        batch.acknowledged(mid)
+
+    def publish_scene(self, messages, current_value=None, qos=1, name='scene'):
+        """
+        Publish a batch of `(topic, payload, retain)` messages in one go.
+
+        Retained messages are skipped if `current_value(topic)` returns the
+        target payload already. All other messages are handed to paho at once,
+        so they are pipelined instead of waiting for each other. Returns a
+        `SceneBatch` which is done once the broker acknowledged every message.
+        """
+
+        batch = SceneBatch(name)
+
+        with self._batches_lock:
+            self._batches_publishing += 1
+
+        try:
+            for topic, payload, retain in messages:
+                if retain and current_value is not None and current_value(topic) == payload:
+                    batch.skipped += 1
+                    continue
+
+                info = self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+
+                if qos == 0 and info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                    # not queued by paho, will never be acknowledged
+                    continue
+
+                batch.add(info.mid)
+                with self._batches_lock:
+                    if info.mid in self._early_acks:
+                        self._early_acks.remove(info.mid)
+                        acked = True
+                    else:
+                        self._batches[info.mid] = batch
+                        acked = False
+                if acked:
+                    batch.acknowledged(info.mid)
+
+        finally:
+            with self._batches_lock:
+                self._batches_publishing -= 1
+                if not self._batches_publishing:
+                    self._early_acks.clear()
+
+        batch.seal()
+        return batch
+
+
+class HostedConnection():
+    """
+    The paho client of an `MQTT_Host` as one attached client sees it. The
+    ids of the messages the client publishes are recorded, so the host hands
+    their acknowledgements to this client only. Everything else is passed
+    through to the paho client.
+    """
+
+    def __init__(self, host, client, paho_client):
+        self._host = host
+        self._client = client
+        self._paho_client = paho_client
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._host._publishers_lock:
+            self._host._publishing += 1
+
+        try:
+            info = self._paho_client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+
+            if qos == 0 and info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                # not queued by paho, will never be acknowledged
+                return info
+
+            with self._host._publishers_lock:
+                if info.mid in self._host._early_publisher_acks:
+                    self._host._early_publisher_acks.remove(info.mid)
+                    acked = True
+                else:
+                    self._host._publishers[info.mid] = self._client
+                    acked = False
+            if acked:
+                self._client.on_publish(self._paho_client, None, info.mid)
+
+            return info
+
+        finally:
+            with self._host._publishers_lock:
+                self._host._publishing -= 1
+                if not self._host._publishing:
+                    # acknowledgements of the host's own messages
+                    self._host.metrics.message_published(len(self._host._early_publisher_acks))
+                    self._host._early_publisher_acks.clear()
+
+    def __getattr__(self, name):
+        return getattr(self._paho_client, name)
+
+
+class MQTT_Host(MQTT_Client):
+    """
+    One broker connection shared by the clients of several daemons in one
+    process, see `daemon-host.py`.
+
+    Attached clients are not started. When the host connects they get the
+    shared paho client (wrapped in a `HostedConnection`) as their
+    `mqtt_client` and their `on_connect` is called (so they publish their
+    heartbeat as usual). Their repeated heartbeats and metrics are published
+    by jobs of the host. The host subscribes to the topics of all clients
+    once, the clients do not subscribe themselves, so retained messages are
+    delivered once. Received messages are dispatched to the clients with a
+    matching subscription, publish acknowledgements to the client which
+    published the message.
+
+    A connection has only one will, so if the process dies only the heartbeat
+    of the host itself is reset by the broker. On a clean exit
+    `publish_wills` resets the heartbeats of the attached clients.
+    """
+
+    max_targets_cache_size = 4096
+
+    def __init__(self, clientId='daemon-host', keepalive=60, heartbeat=True, **kwargs):
+        super(MQTT_Host, self).__init__(clientId, keepalive=keepalive, heartbeat=heartbeat, daemon=True, **kwargs)
+
+        self.clients = []
+        self.subscribe_topics = []
+        self._router = TopicRouter()
+        self._targets = {}
+
+        # message id -> attached client which published it
+        self._publishers = {}
+        self._publishers_lock = threading.Lock()
+        self._publishing = 0
+        self._early_publisher_acks = set()
+
+    def attach(self, client):
+        client.hosted = True
+        self.clients.append(client)
+        self.subscribe_topics = self.subscribe_topics + [t for t in client.subscribe_topics if t not in self.subscribe_topics]
+
+        for topic_filter, _ in client.subscribe_topics:
+            self._router.add(topic_filter, client)
+        self._targets.clear()
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            for c in self.clients:
+                c.mqtt_client = HostedConnection(self, c, self.mqtt_client)
+
+        super(MQTT_Host, self)._handle_connect(client, userdata, flags, rc)
+
+        for c in self.clients:
+            try:
+                c._handle_connect(client, userdata, flags, rc)
+            except Exception:
+                logging.exception('{}: on_connect exception'.format(c.clientId))
+
+    def on_message(self, client, userdata, msg):
+        targets = self._targets.get(msg.topic)
+        if targets is None:
+            # a client matches once even with several matching subscriptions
+            targets = tuple(dict.fromkeys(self._router.match(msg.topic)))
+            if len(self._targets) >= self.max_targets_cache_size:
+                self._targets.clear()
+            self._targets[msg.topic] = targets
+
+        for c in targets:
+            try:
+                c._handle_message(client, userdata, msg)
+            except Exception:
+                logging.exception('{}: message handler exception ({})'.format(c.clientId, msg.topic))
+
+    def start_metrics(self):
+        super(MQTT_Host, self).start_metrics()
+
+        # the attached clients are not started, their metrics are published
+        # by the host's scheduler
+        for c in self.clients:
+            if c.metrics_interval:
+                get_scheduler().every(c.metrics_interval, c.publish_metrics, name=c.clientId + ' metrics')
+
+    def refresh_heartbeat(self):
+        super(MQTT_Host, self).refresh_heartbeat()
+
+        for c in self.clients:
+            c.refresh_heartbeat()
+
+    def on_publish(self, client, userdata, mid):
+        with self._publishers_lock:
+            target = self._publishers.pop(mid, None)
+            if target is None and self._publishing:
+                # acknowledged before `HostedConnection.publish` recorded the
+                # id, or a message of the host itself
+                self._early_publisher_acks.add(mid)
+                return
+
+        if target is None:
+            super(MQTT_Host, self).on_publish(client, userdata, mid)
+        else:
+            target.on_publish(client, userdata, mid)
+
+    def publish_wills(self, timeout=2):
+        if not self.connection_established:
+            return
+
+        infos = [
+                self.mqtt_client.publish(c.willTopic, c.willMessage, c.willQos, c.willRetain)
+                for c in self.clients if c.willTopic is not None
+            ]
+        deadline = time.monotonic() + timeout
+        for info in infos:
+            info.wait_for_publish(max(0, deadline - time.monotonic()))
+
+
+class AsyncMQTT_Client():
+    """
+    asyncio variant of `MQTT_Client`: the paho client is driven by the event
+    loop through its socket callbacks instead of a `loop_forever` thread, so
+    a daemon can do all its work in coroutines on one loop.
+
+    Subclasses implement `async def on_message(self, msg)`; messages are
+    handled one after another in the order they arrived. `publish` can be
+    awaited until the message was sent (QoS 0) or acknowledged (QoS 1, 2).
+
+    Usage:
+        client = MyClient('name', **helpers.get_client_kwargs(args))
+        asyncio.run(client.run())
+
+    All methods have to be called from the thread running the event loop.
+    """
+
+    heartbeat_topic_prefix = MQTT_Client.heartbeat_topic_prefix
+    metrics_topic_prefix = MQTT_Client.metrics_topic_prefix
+    subscribe_topics = []
+
+    max_inflight_messages = MQTT_Client.max_inflight_messages
+    journal_flush_interval = MQTT_Client.journal_flush_interval
+    heartbeat_interval = MQTT_Client.heartbeat_interval
+
+    reconnect_delay = 5
+
+    def __init__(
+        self,
+        clientId = None,
+        mqtt_host = '127.0.0.1',
+        mqtt_port = 1883,
+        keepalive = 60,
+        heartbeat = False,
+        heartbeat_blank = False,
+        metrics_interval = None,
+        metrics_port = None,
+        journal_dir = None,
+    ):
+        self.clientId = clientId
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.keepalive = keepalive
+
+        self.heartbeat = heartbeat
+        self.heartbeat_topic = self.heartbeat_topic_prefix + self.clientId
+        self.heartbeat_will = b'' if heartbeat_blank else b'\x00'
+
+        self.mqtt_client = None
+        self.connection_established = False
+
+        self.metrics = ClientMetrics(self.subscribe_topics)
+        self.metrics_interval = metrics_interval
+        self.metrics_port = metrics_port
+
+        self.journal = journal.JournalWriter(journal_dir) if journal_dir else None
+
+        self._loop = None
+        self._messages = None
+        self._disconnected = None
+        # message id -> (future, qos) of awaited publishes
+        self._pending = {}
+
+    async def run(self):
+        """
+        Connect and handle messages, reconnecting when the connection is
+        lost. Runs until cancelled.
+        """
+
+        self._loop = asyncio.get_running_loop()
+        self._messages = asyncio.Queue()
+        self._disconnected = asyncio.Event()
+
+        self.mqtt_client = mqtt_client.Client(self.clientId)
+        self.mqtt_client.on_message = self._handle_message
+        self.mqtt_client.on_connect = self._handle_connect
+        self.mqtt_client.on_disconnect = self._handle_disconnect
+        self.mqtt_client.on_publish = self._handle_publish
+        self.mqtt_client.on_socket_open = self._socket_open
+        self.mqtt_client.on_socket_close = self._socket_close
+        self.mqtt_client.on_socket_register_write = self._socket_register_write
+        self.mqtt_client.on_socket_unregister_write = self._socket_unregister_write
+        self.mqtt_client.max_inflight_messages_set(self.max_inflight_messages)
+
+        if self.heartbeat:
+            self.mqtt_client.will_set(self.heartbeat_topic, self.heartbeat_will, 2, True)
+
+        tasks = [
+                self._loop.create_task(self._misc_loop()),
+                self._loop.create_task(self._message_loop()),
+            ]
+        if self.metrics_interval:
+            tasks.append(self._loop.create_task(self._periodic(self.metrics_interval, self.publish_metrics)))
+        if self.metrics_port:
+            MetricsHTTPServer(self, self.metrics_port).start()
+        if self.journal is not None:
+            tasks.append(self._loop.create_task(self._periodic(self.journal_flush_interval, self.journal.flush)))
+        if self.heartbeat and self.heartbeat_interval:
+            tasks.append(self._loop.create_task(self._periodic(self.heartbeat_interval, self.refresh_heartbeat)))
+
+        try:
+            while True:
+                self._disconnected.clear()
+                logging.info('connecting')
+                try:
+                    self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, self.keepalive)
+                except OSError as e:
+                    logging.info('could not connect ({}), retrying'.format(e))
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+
+                await self._disconnected.wait()
+                await asyncio.sleep(self.reconnect_delay)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.mqtt_client.disconnect()
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        """
+        Publish a message and wait until it was written to the socket (QoS 0)
+        or acknowledged by the broker. Returns paho's `MQTTMessageInfo`;
+        raises `ConnectionError` if a QoS 0 message was dropped because there
+        is no connection or it was lost.
+        """
+
+        info = self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS and qos == 0:
+            # not queued by paho
+            raise ConnectionError(mqtt_client.error_string(info.rc))
+
+        future = self._loop.create_future()
+        self._pending[info.mid] = (future, qos)
+        await future
+        return info
+
+    def on_connect(self, client, userdata, flags, rc):
+
+        if rc != 0:
+            logging.info('could not connect, bad return code')
+            return
+
+        logging.info('connected, subscribing')
+        if self.subscribe_topics:
+            self.mqtt_client.subscribe(self.subscribe_topics)
+
+        if self.heartbeat:
+            logging.info('sending heartbeat')
+            self.mqtt_client.publish(self.heartbeat_topic, b'\x01', retain=True)
+
+        self.connection_established = True
+
+    async def on_message(self, msg):
+        pass
+
+    def refresh_heartbeat(self):
+        if self.connection_established:
+            self.mqtt_client.publish(self.heartbeat_topic, b'\x01', retain=True)
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot(self.mqtt_client)
+
+    def publish_metrics(self):
+        if not self.connection_established:
+            return
+
+        prefix = self.metrics_topic_prefix + self.clientId + '/'
+        for name, value in self.metrics_snapshot().items():
+            self.mqtt_client.publish(prefix + name, json.dumps(value))
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.metrics.connects += 1
+            self.metrics.set_topic_filters(t for t, _ in self.subscribe_topics)
+        self.on_connect(client, userdata, flags, rc)
+
+    def _handle_disconnect(self, client, userdata, rc):
+        logging.info('disconnected ({})'.format(rc))
+        self.connection_established = False
+
+        # paho sends QoS 1 and 2 messages again after reconnecting, QoS 0
+        # messages are lost
+        for mid, (future, qos) in list(self._pending.items()):
+            if qos == 0:
+                del self._pending[mid]
+                if not future.done():
+                    future.set_exception(ConnectionError('connection lost'))
+
+        self._disconnected.set()
+
+    def _handle_message(self, client, userdata, msg):
+        if self.journal is not None:
+            self.journal.write(time.time(), msg.topic, msg.payload, msg.qos, msg.retain)
+        self._messages.put_nowait(msg)
+
+    def _handle_publish(self, client, userdata, mid):
+        self.metrics.message_published()
+
+        pending = self._pending.pop(mid, None)
+        if pending is not None and not pending[0].done():
+            pending[0].set_result(None)
+
+    async def _message_loop(self):
+        while True:
+            msg = await self._messages.get()
+            start = time.perf_counter_ns()
+            try:
+                await self.on_message(msg)
+            except Exception:
+                logging.exception('message handler exception ({})'.format(msg.topic))
+            finally:
+                self.metrics.message_handled(msg.topic, time.perf_counter_ns() - start)
+
+    async def _misc_loop(self):
+        # keepalive pings and timeouts, the part of paho's loop not driven by
+        # socket events
+        while True:
+            await asyncio.sleep(1)
+            if self.mqtt_client.socket() is not None:
+                self.mqtt_client.loop_misc()
+
+    async def _periodic(self, interval, func):
+        deadline = self._loop.time()
+        while True:
+            deadline += interval
+            await asyncio.sleep(max(0, deadline - self._loop.time()))
+            try:
+                func()
+            except Exception:
+                logging.exception('periodic job exception')
+
+    def _socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+
+    def _socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+
+    def _socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+
+# What the `create_daemon(args)` function of a daemon module returns: its
+# `MQTT_Client` (not started yet), the other threads it started, which have
+# to stay alive, and a function to call on exit (or None).
+Daemon = namedtuple('Daemon', ['client', 'threads', 'on_exit'])
+
+
+def run_daemon(daemon):
+    """
+    Run a daemon on its own broker connection until one of its threads dies.
+    """
+
+    daemon.client.start()
+
+    while daemon.client.is_alive() and all(t.is_alive() for t in daemon.threads):
+        time.sleep(1)
+
+    logging.info('exiting')
+    if daemon.on_exit is not None:
+        daemon.on_exit()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(1)
+
 
 def get_default_parser():
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--logging-type', default='stdout', choices=['stdout', 'file', 'journald'])
     parser.add_argument('--logfile', default='/var/log/mqtt-mpd-transport.log', help='Only used for logging-type=file')
     parser.add_argument('--loglevel', default='debug', help='Standard python logging levels error,warning,info,debug')
+    parser.add_argument('--mqtt-host', help='MQTT broker host (default: daemon specific)')
+    parser.add_argument('--mqtt-port', type=int, help='MQTT broker port (default: 1883)')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='Publish runtime metrics under stats/<clientId>/ every this many seconds, 0 to disable')
+    parser.add_argument('--metrics-port', type=int, help='Serve runtime metrics for Prometheus on this port')
+    parser.add_argument('--journal-dir', help='Write all received messages to a binary journal in this directory, see journal-query.py')
     return parser
 
 
+def get_connection_kwargs(args):
+    """
+    `mqtt_host` and `mqtt_port` keyword arguments for the `--mqtt-host` and
+    `--mqtt-port` options which were given on the command line.
+    """
+
+    kwargs = {}
+    if args.mqtt_host is not None:
+        kwargs['mqtt_host'] = args.mqtt_host
+    if args.mqtt_port is not None:
+        kwargs['mqtt_port'] = args.mqtt_port
+    return kwargs
+
+
+def get_client_kwargs(args):
+    """
+    `MQTT_Client` keyword arguments for the options of `get_default_parser`
+    which were given on the command line.
+    """
+
+    kwargs = get_connection_kwargs(args)
+    kwargs['metrics_interval'] = args.metrics_interval
+    kwargs['metrics_port'] = args.metrics_port
+    kwargs['journal_dir'] = args.journal_dir
+    return kwargs
+
+
 def configure_logging(logging_type, loglevel, logfile=None):
     # assuming loglevel is bound to the string value obtained from the
     # command line argument. Convert to upper case to allow the user to
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+Shows the messages of a journal written with `--journal-dir`, see
+`journal.py`.
+
+Usage:
+    python journal-query.py JOURNAL_DIR [--topic 'licht/+/+'] [--since=-2h] [--until '2026-10-01 20:00']
+
+Times are unix timestamps, dates like `2026-10-01 20:00` (local time) or
+relative to now like `-30m`, `-2h`, `-7d` (given as `--since=-2h`).
+"""
+
+import argparse
+import re
+import sys
+import time
+from datetime import datetime
+
+import capture
+import journal
+
+
+RELATIVE_RE = re.compile(r'^-(\d+(?:\.\d+)?)([smhd])$')
+UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_time(s):
+    m = RELATIVE_RE.match(s)
+    if m:
+        return time.time() - float(m.group(1)) * UNIT_SECONDS[m.group(2)]
+
+    try:
+        return float(s)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid time: {}'.format(s))
+
+
+def format_payload(payload):
+    try:
+        text = payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return payload.hex()
+
+    if text.isprintable():
+        return repr(text)
+    return payload.hex()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT journal query')
+    parser.add_argument('directory', help='Journal directory')
+    parser.add_argument('--topic', help='Topic or topic filter with wildcards (default: all)')
+    parser.add_argument('--since', type=parse_time, help='Start time')
+    parser.add_argument('--until', type=parse_time, help='End time')
+    parser.add_argument('--capture', help='Write the messages to this capture file (for logicer-replay.py) instead of printing them')
+    parser.add_argument('--count', action='store_true', help='Only print the number of messages')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    messages = journal.query(args.directory, args.since, args.until, args.topic)
+
+    if args.capture:
+        writer = capture.CaptureWriter(args.capture)
+        for m in messages:
+            writer.write(m.time, m.topic, m.payload, m.qos, m.retain)
+        writer.close()
+        count = writer.count
+
+    elif args.count:
+        count = sum(1 for _ in messages)
+        print(count)
+
+    else:
+        count = 0
+        for m in messages:
+            print('{} {}{} {}'.format(
+                    datetime.fromtimestamp(m.time).isoformat(sep=' ', timespec='milliseconds'),
+                    m.topic,
+                    ' (retained)' if m.retain else '',
+                    format_payload(m.payload),
+                ))
+            count += 1
+
+    print('{} messages in {:.1f} ms'.format(count, (time.perf_counter() - start) * 1e3), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
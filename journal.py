@@ -0,0 +1,270 @@
+"""
+Append-only binary journal of MQTT messages, for finding out afterwards what
+happened on which topic.
+
+A journal is a directory of segments. Each segment `<start ms>.jrn` starts
+with `MAGIC`, followed by length-prefixed records (record length, time,
+flags, topic length, topic and payload bytes; flags like in `capture.py`).
+A new segment is started when the current one reaches `max_bytes` or
+`max_age` seconds.
+
+Next to each segment an index `<start ms>.idx` holds `(time, offset)` pairs
+of every record starting after `index_interval` bytes, so queries for a time
+range only read the part of the segment they need.
+
+Records are collected in memory and written in batches by `flush`, an
+interrupted last record is ignored when reading.
+"""
+
+import atexit
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from paho.mqtt.client import topic_matches_sub
+
+
+MAGIC = b'AC4JRNL\x01'
+RECORD = struct.Struct('<IdBH') # record length, time, flags, topic length
+INDEX = struct.Struct('<dQ') # time, offset
+
+FLAG_RETAIN = 0x01
+FLAG_QOS_SHIFT = 1
+
+JournalMessage = namedtuple('JournalMessage', ['time', 'topic', 'payload', 'qos', 'retain'])
+
+
+class JournalWriter():
+
+    max_bytes = 64 * 1024 * 1024
+    max_age = 24 * 3600
+    index_interval = 64 * 1024
+
+    # flush right away if this much is buffered, instead of waiting for the
+    # next periodic flush
+    max_buffer = 1024 * 1024
+
+    def __init__(self, directory, max_bytes=None, max_age=None, clock=time.time):
+        self.directory = directory
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_age is not None:
+            self.max_age = max_age
+        self.clock = clock
+        self.count = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._buffer = bytearray()
+        self._index = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self._file = None
+        self._index_file = None
+        self._start_segment(self.clock())
+        self._open_segment()
+
+        atexit.register(self.close)
+
+    def _start_segment(self, t):
+        # the files are opened by `_open_segment` once the records of the
+        # previous segment are written
+        self._segment_name = '{:013d}'.format(int(t * 1000))
+        self._segment_start = t
+        self._segment_size = len(MAGIC)
+        self._next_index = self._segment_size
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, self._segment_name)
+        self._file = open(path + '.jrn', 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._index_file = open(path + '.idx', 'ab')
+
+    def write(self, t, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+        topic = topic.encode('utf-8')
+        flags = (FLAG_RETAIN if retain else 0) | (qos << FLAG_QOS_SHIFT)
+        length = RECORD.size + len(topic) + len(payload)
+
+        with self._lock:
+            if self._segment_size >= self._next_index:
+                self._index.append(INDEX.pack(t, self._segment_size))
+                self._next_index = self._segment_size + self.index_interval
+
+            self._buffer += RECORD.pack(length, t, flags, len(topic))
+            self._buffer += topic
+            self._buffer += payload
+            self._segment_size += length
+            self.count += 1
+
+            full = len(self._buffer) >= self.max_buffer
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records, and start a new segment if the current one
+        is full or too old.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                data, self._buffer = self._buffer, bytearray()
+                index, self._index = self._index, []
+
+                rotate = (self._segment_size >= self.max_bytes
+                        or self.clock() - self._segment_start >= self.max_age)
+                if rotate:
+                    self._start_segment(self.clock())
+
+            if self._file is None:
+                return
+
+            if data:
+                self._file.write(data)
+                self._file.flush()
+            if index:
+                self._index_file.write(b''.join(index))
+                self._index_file.flush()
+
+            if rotate:
+                self._close_files()
+                self._open_segment()
+
+    def _close_files(self):
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+            self._file = None
+            self._index_file = None
+
+    def close(self):
+        self.flush()
+        with self._flush_lock:
+            self._close_files()
+
+
+def segments(directory):
+    """
+    Returns `(start time, segment path, index path)` of the journal segments,
+    oldest first.
+    """
+
+    result = []
+    for name in os.listdir(directory):
+        base, ext = os.path.splitext(name)
+        if ext == '.jrn' and base.isdigit():
+            path = os.path.join(directory, base)
+            result.append((int(base) / 1000, path + '.jrn', path + '.idx'))
+    result.sort()
+    return result
+
+
+def read_index(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return [], []
+
+    entries = list(INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size]))
+    return [t for t, _ in entries], [offset for _, offset in entries]
+
+
+def read_segment(path, index_path=None, since=None, until=None, topic_filter=None):
+    """
+    Yields the `JournalMessage`s of a segment between `since` and `until`
+    (unix times, both optional) on topics matching `topic_filter`.
+    """
+
+    if topic_filter is not None and not ('+' in topic_filter or '#' in topic_filter):
+        exact_topic = topic_filter.encode('utf-8')
+    else:
+        exact_topic = None
+
+    # topic bytes -> decoded topic, and whether it matches the filter
+    topics = {}
+    matched = {}
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a journal segment: {}'.format(path))
+
+        offset = len(MAGIC)
+        if since is not None and index_path is not None:
+            times, offsets = read_index(index_path)
+            i = bisect.bisect_left(times, since)
+            if i > 0:
+                offset = offsets[i - 1]
+
+        end_of_data = len(data)
+        while offset + RECORD.size <= end_of_data:
+            length, t, flags, topic_len = RECORD.unpack_from(data, offset)
+            end = offset + length
+            if length < RECORD.size or end > end_of_data:
+                break
+
+            if until is not None and t > until:
+                break
+
+            if since is None or t >= since:
+                start = offset + RECORD.size
+                topic = data[start:start + topic_len]
+
+                if exact_topic is not None:
+                    matches = topic == exact_topic
+                    topic = topic_filter
+                else:
+                    decoded = topics.get(topic)
+                    if decoded is None:
+                        decoded = topics[topic] = topic.decode('utf-8')
+                        matched[topic] = topic_filter is None or topic_matches_sub(topic_filter, decoded)
+                    matches = matched[topic]
+                    topic = decoded
+
+                if matches:
+                    yield JournalMessage(
+                            t,
+                            topic,
+                            data[start + topic_len:end],
+                            flags >> FLAG_QOS_SHIFT,
+                            bool(flags & FLAG_RETAIN),
+                        )
+
+            offset = end
+
+    finally:
+        data.close()
+
+
+def query(directory, since=None, until=None, topic_filter=None):
+    """
+    Yields the `JournalMessage`s of all segments of a journal between `since`
+    and `until` on topics matching `topic_filter`.
+    """
+
+    all_segments = segments(directory)
+    for i, (start, path, index_path) in enumerate(all_segments):
+        if until is not None and start > until:
+            break
+
+        # the next segment was started after all records of this one
+        if since is not None and i + 1 < len(all_segments) and all_segments[i + 1][0] < since:
+            continue
+
+        yield from read_segment(path, index_path, since, until, topic_filter)
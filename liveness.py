@@ -0,0 +1,98 @@
+"""
+Liveness of the daemons, from their `heartbeat/<client>` messages.
+
+Clients publish `\\x01` when they connect and every `heartbeat_interval`
+seconds after that (see `helpers.MQTT_Client`), their will resets the topic
+to `\\x00` or an empty payload. A client is `down` after its will and
+`timeout` if it was not heard of for `timeout` seconds, which catches hung
+daemons and broken connections the broker did not notice yet.
+
+Only clients seen refreshing their heartbeat can time out: the deadline is
+armed by the second heartbeat received live (not retained) since the client
+was last down. Devices which publish their heartbeat only when they connect,
+and retained heartbeats after a restart, set the client `up` without a
+deadline.
+
+The deadlines of all clients are kept in one heap; entries of clients heard
+of again are skipped when they come up.
+"""
+
+import heapq
+import itertools
+import threading
+
+import helpers
+
+
+UP = 'up'
+DOWN = 'down'
+TIMEOUT = 'timeout'
+
+
+class LivenessMonitor():
+
+    timeout = 3 * helpers.MQTT_Client.heartbeat_interval
+
+    def __init__(self, on_change, timeout=None):
+        """
+        `on_change(client, state, states)` is called on every state change,
+        with `states` a copy of the states of all clients.
+        """
+
+        self.on_change = on_change
+        if timeout is not None:
+            self.timeout = timeout
+
+        self.states = {}
+        self.deadlines = {}
+        # clients a live heartbeat was received from since they were down
+        self.heard_live = set()
+
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def heartbeat(self, client, payload, now, retain=False):
+        if payload == b'\x01':
+            with self._lock:
+                if not retain and client in self.heard_live:
+                    # refreshing, may time out from now on
+                    deadline = now + self.timeout
+                    self.deadlines[client] = deadline
+                    heapq.heappush(self._heap, (deadline, next(self._sequence), client))
+                elif not retain:
+                    self.heard_live.add(client)
+                changes = self._set_state(client, UP)
+        else:
+            with self._lock:
+                self.deadlines.pop(client, None)
+                self.heard_live.discard(client)
+                changes = self._set_state(client, DOWN)
+
+        self._notify(changes)
+
+    def poll(self, now):
+        """
+        Mark the clients as timed out whose deadline passed.
+        """
+
+        changes = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, client = heapq.heappop(self._heap)
+                if self.deadlines.get(client) != deadline:
+                    continue
+                del self.deadlines[client]
+                changes += self._set_state(client, TIMEOUT)
+
+        self._notify(changes)
+
+    def _set_state(self, client, state):
+        if self.states.get(client) == state:
+            return []
+        self.states[client] = state
+        return [(client, state, dict(self.states))]
+
+    def _notify(self, changes):
+        for client, state, states in changes:
+            self.on_change(client, state, states)
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+"""
+Measures the per-message cost of `MQTTLogicer.on_message`.
+
+Simulates a DMX fader being moved in a UI: every frame a `dmx/<room>/master`
+message is received, followed by the per-channel messages the logicer fans out
+to (these are received again, as the logicer subscribes to `dmx/+/+`). Some
+light switch and status traffic is mixed in.
+
+Usage:
+    python logicer-benchmark.py [--seconds 10] [--fps 30]
+"""
+
+import argparse
+import logging
+import time
+from collections import namedtuple
+
+import logicer
+from paho.mqtt.client import MQTTMessageInfo
+
+
+_Message = namedtuple('_Message', ['topic', 'payload', 'retain'])
+
+
+class NullClient():
+    """
+    Stand-in for the paho client, counts publishes.
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        return MQTTMessageInfo(self.published)
+
+
+def initial_messages():
+    """
+    Retained messages a freshly connected logicer would receive.
+    """
+
+    topics = (
+            logicer.MQTTLogicer.alle_lichter
+            + logicer.MQTTLogicer.dmx_channels
+            + list(logicer.MQTTLogicer.fenster_to_licht)
+        )
+    messages = [_Message(t, b'\x00', True) for t in topics]
+    messages.append(_Message('heartbeat/logicer', b'\x01', True))
+    return messages
+
+
+def fader_messages(seconds, fps):
+    """
+    Generate the messages of a fader being moved for `seconds` at `fps`.
+    """
+
+    rooms = ('wohnzimmer', 'plenar', 'fnord')
+    channels = {
+            room: [t for t in logicer.MQTTLogicer.dmx_channels if t.startswith('dmx/' + room + '/')]
+            for room in rooms
+        }
+
+    messages = []
+    for frame in range(int(seconds * fps)):
+        room = rooms[frame // fps % len(rooms)]
+        value = frame % 256
+        payload = bytes((value, value, value, 0, 0, 0, 0, 0xff))
+
+        messages.append(_Message('dmx/' + room + '/master', payload, False))
+        for t in channels[room]:
+            messages.append(_Message(t, payload, True))
+
+        if frame % fps == 0:
+            messages.append(_Message('schalter/wohnzimmer/links', bytes((frame // fps % 2,)), False))
+            messages.append(_Message('heartbeat/logicer', b'\x01', True))
+            messages.append(_Message('temp/plenar/raum', b'21.5', False))
+
+    return messages
+
+
+def run(messages, repeat):
+    best = None
+
+    for _ in range(repeat):
+        lg = logicer.MQTTLogicer()
+        lg.mqtt_client = NullClient()
+
+        for msg in initial_messages():
+            lg.on_message(None, None, msg)
+
+        start = time.perf_counter()
+        for msg in messages:
+            lg.on_message(None, None, msg)
+        duration = time.perf_counter() - start
+
+        if best is None or duration < best:
+            best = duration
+
+    return best, lg.mqtt_client.published
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT Logicer dispatch benchmark')
+    parser.add_argument('--seconds', type=float, default=10, help='Simulated fader time')
+    parser.add_argument('--fps', type=int, default=30, help='Fader messages per second')
+    parser.add_argument('--repeat', type=int, default=5, help='Report the best of this many runs')
+    args = parser.parse_args()
+
+    # the logicer logs every dispatched message at debug level
+    logging.basicConfig(level=logging.WARNING)
+
+    messages = fader_messages(args.seconds, args.fps)
+    duration, published = run(messages, args.repeat)
+
+    print('messages:       {}'.format(len(messages)))
+    print('publishes:      {}'.format(published))
+    print('total:          {:.1f} ms'.format(duration * 1e3))
+    print('per message:    {:.2f} us'.format(duration / len(messages) * 1e6))
+    print('messages/s:     {:.0f}'.format(len(messages) / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""
+Replays a capture (see `mqtt-recorder.py`) through `MQTTLogicer.on_message`.
+
+The logicer publishes into a recording stand-in client instead of a broker.
+Reports per-message handler latency percentiles and throughput, and can write
+the published messages to a capture file or compare them against an earlier
+run to check that a rule change did not change the behaviour.
+
+Usage:
+    python logicer-replay.py traffic.cap [--realtime] [--output out.cap] [--expect out.cap]
+"""
+
+import argparse
+import logging
+import sys
+import time
+from collections import namedtuple
+
+import capture
+import logicer
+
+
+_Message = namedtuple('_Message', ['topic', 'payload', 'qos', 'retain'])
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def replay(messages, realtime=False):
+    """
+    Feed `messages` into a fresh logicer. Returns the handler latencies in
+    nanoseconds, the total wall time and the published messages.
+
+    The logicer clock follows the capture timestamps, so time based rules
+    behave as they did while recording, also when not replaying in real time.
+    """
+
+    current_time = [messages[0].time if messages else 0.0]
+
+    lg = logicer.MQTTLogicer()
+    lg.clock = lambda: current_time[0]
+    lg.mqtt_client = capture.RecordingClient(clock=lg.clock)
+
+    latencies = []
+    replay_start = time.perf_counter()
+
+    for m in messages:
+        if realtime:
+            delay = (m.time - messages[0].time) - (time.perf_counter() - replay_start)
+            if delay > 0:
+                time.sleep(delay)
+
+        current_time[0] = m.time
+        msg = _Message(m.topic, m.payload, m.qos, m.retain)
+
+        start = time.perf_counter_ns()
+        lg.on_message(None, None, msg)
+        latencies.append(time.perf_counter_ns() - start)
+
+    duration = time.perf_counter() - replay_start
+
+    return latencies, duration, lg.mqtt_client.published
+
+
+def compare(published, expected):
+    """
+    Returns None if both streams hold the same messages in the same order,
+    otherwise a description of the first difference. Times are ignored.
+    """
+
+    for i, (a, b) in enumerate(zip(published, expected)):
+        if (a.topic, a.payload, a.qos, a.retain) != (b.topic, b.payload, b.qos, b.retain):
+            return 'message {}: got {} expected {}'.format(i, a, b)
+
+    if len(published) != len(expected):
+        return 'got {} messages, expected {}'.format(len(published), len(expected))
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT Logicer capture replay')
+    parser.add_argument('capture', help='Capture file to replay')
+    parser.add_argument('--realtime', action='store_true', help='Keep the recorded message timing (default: maximum speed)')
+    parser.add_argument('--output', help='Write the published messages to this capture file')
+    parser.add_argument('--expect', help='Compare the published messages with this capture file')
+    parser.add_argument('--loglevel', default='warning', help='Standard python logging levels error,warning,info,debug')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', level=getattr(logging, args.loglevel.upper()))
+
+    messages = list(capture.read_capture(args.capture))
+    latencies, duration, published = replay(messages, args.realtime)
+
+    latencies.sort()
+    handler_time = sum(latencies) / 1e9
+
+    print('messages:       {}'.format(len(messages)))
+    print('published:      {}'.format(len(published)))
+    print('wall time:      {:.3f} s'.format(duration))
+    if handler_time:
+        print('messages/s:     {:.0f} (handler time only)'.format(len(messages) / handler_time))
+    for p in (50, 90, 99, 99.9, 100):
+        print('latency p{:<5}  {:.1f} us'.format(p, percentile(latencies, p) / 1e3))
+
+    if args.output:
+        writer = capture.CaptureWriter(args.output)
+        for m in published:
+            writer.write(m.time, m.topic, m.payload, m.qos, m.retain)
+        writer.close()
+
+    if args.expect:
+        difference = compare(published, list(capture.read_capture(args.expect)))
+        if difference is not None:
+            print('output differs: {}'.format(difference))
+            sys.exit(1)
+        print('output identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,22 +9,40 @@ Implements logic for the MQTT-based home automation. This includes:
     * club shutdown:        Turn off lights, music
     * dmx channels:         Set the etherrape dmx output
     * room master:          Forwards commands to all lights in a room
+    * dmx fades:            Fades the dmx channels of a room (`dmx/<room>/fade`)
+    * dmx frames:           Fans `dmx/<room>/frame` out to the dmx channels
+
+The rooms and rules are in logicer_rules.py, the scenes applied by
+`preset/<room>/<name>` in scenes.json. Both are reloaded on SIGHUP or a
+message to `logicer/reload`.
 """
 
 import argparse
+import functools
+import importlib
+import json
 import logging
-import re
+import signal
 import struct
 import threading
 import time
+import types
 import requests
-import sys
 from collections import namedtuple
 from datetime import datetime
 from subprocess import Popen
 
+from paho.mqtt.client import topic_matches_sub
+
 import config
+import gestures
 import helpers
+import aggregates
+import dmxfade
+import dmxframe
+import liveness
+import logicer_rules
+import statestore
 
 
 _LastStateEntry = namedtuple('_LastStateEntry', ['value', 'time'])
@@ -35,105 +53,37 @@ class MQTTLogicer(helpers.MQTT_Client):
     Last received messages for topics are stored in `last_state`.
     """
 
-    fnordcenter_lichter = [
-        'licht/fnord/links',
-        'licht/fnord/rechts',
-    ]
-    keller_lichter = [
-        'licht/keller/loet',
-        'licht/keller/mitte',
-        'licht/keller/vorne',
-    ]
-    leds_keller = [
-        'led/keller/werkbankwarm',
-        'led/keller/werkbankkalt',
-        'led/keller/hintenwarm',
-        'led/keller/hintenkalt',
-    ]
-    wohnzimmer_lichter = [
-        'licht/wohnzimmer/kueche',
-        'licht/wohnzimmer/mitte',
-        'licht/wohnzimmer/tuer',
-        'licht/wohnzimmer/gang',
-    ]
-    plenarsaal_lichter = [
-        'licht/plenar/vornefenster',
-        'licht/plenar/vornewand',
-        'licht/plenar/hintenfenster',
-        'licht/plenar/hintenwand',
-    ]
-    powers = [
-        'power/wohnzimmer/kitchenlight',
-    ]
-    sockets = [
-        'socket/wohnzimmer/screen/a',
-        'socket/wohnzimmer/screen/b',
-        'relais/plenar/amp',
-        'relais/plenar/dmx',
-        'relais/fnord/dmx',
-        'relais/fnord/audio',
-    ]
-    screens = [
-        'screen/wohnzimmer/infoscreen'
-    ]
-    alle_lichter = fnordcenter_lichter + keller_lichter + wohnzimmer_lichter + plenarsaal_lichter + powers + sockets + leds_keller + screens
-    exit_light = 'licht/wohnzimmer/tuer'
-
-    fenster_to_licht = {
-        'fenster/plenar/vornerechts': 'licht/plenar/vornefenster',
-        'fenster/plenar/vornelinks': 'licht/plenar/vornefenster',
-        'fenster/plenar/hintenrechts': 'licht/plenar/hintenfenster',
-        'fenster/plenar/hintenlinks': 'licht/plenar/hintenfenster',
-        'fenster/wohnzimmer/rechts': 'licht/wohnzimmer/kueche',
-        'fenster/wohnzimmer/links': 'licht/wohnzimmer/kueche',
-        'fenster/fnord/links': 'licht/fnord/links',
-        'fenster/fnord/rechts': 'licht/fnord/rechts',
-    }
-
-    musiken = [
-        'mpd/plenar',
-        'mpd/fnord',
-        'mpd/baellebad',
-        'mpd/keller',
-    ]
+    # rooms, topics and rule tables, see logicer_rules.py
+    rules_module = logicer_rules
 
-    dmx_channels_fnordcenter = [
-        'dmx/fnord/fairyfenster',
-        'dmx/fnord/schranklinks',
-        'dmx/fnord/schrankrechts',
-        'dmx/fnord/scummfenster',
-    ]
-    dmx_channels_wohnzimmer = [
-        'dmx/wohnzimmer/mitte1',
-        'dmx/wohnzimmer/mitte2',
-        'dmx/wohnzimmer/mitte3',
-        'dmx/wohnzimmer/tuer1',
-        'dmx/wohnzimmer/tuer2',
-        'dmx/wohnzimmer/tuer3',
-        'dmx/wohnzimmer/gang',
-        'dmx/wohnzimmer/baellebad',
-        'dmx/wohnzimmer/spuele1',
-        'dmx/wohnzimmer/spuele2',
-        'dmx/wohnzimmer/chaosknoten',
-        'dmx/wohnzimmer/tresen',
-        'dmx/wohnzimmer/tresen2',
+    # rules which can not be removed by reloading the rules module
+    builtin_publish_rules = [
+        ('logicer/reload',              'reload_command'),
     ]
-    leds_wohnzimmer = [
-        'led/kitchen/sink',
-    ]
-    dmx_channels_plenarsaal = [
-        'dmx/plenar/vorne1',
-        'dmx/plenar/vorne2',
-        'dmx/plenar/vorne3',
-        'dmx/plenar/hinten1',
-        'dmx/plenar/hinten2',
-        'dmx/plenar/hinten3',
-        'dmx/plenar/hinten4',
-    ]
-    dmx_channels = dmx_channels_fnordcenter + dmx_channels_wohnzimmer + dmx_channels_plenarsaal + leds_wohnzimmer
+    rules_status_topic = 'logicer/reload/status'
 
     last_state = None
-    last_event = None
+
+    # topic classes which may collect many topics nobody needs for long, kept
+    # in `last_state` with bounded size: (topic filter, max topics, max age)
+    volatile_topics = [
+        ('heartbeat/+',     256,    7 * 24 * 3600),
+        ('licht/+',         32,     24 * 3600),
+        ('dmx/+',           32,     24 * 3600),
+    ]
+
+    # seconds between writes of the snapshot
+    state_flush_interval = 5
+
+    # max rate of the relayed `dmx/<room>/master` values per room, faster
+    # fader movements are coalesced to the latest value
+    dmx_master_fps = 30
+
+    # frame rate of the fades started by `dmx/<room>/fade`
+    dmx_fade_fps = 30
+
+    # time source for the rules, replaced for deterministic replays
+    clock = time.time
 
     subscribe_topics = [
             ('schalter/+/+',             0),
@@ -153,27 +103,215 @@ class MQTTLogicer(helpers.MQTT_Client):
             ('club/gate',                0),
             ('club/bell',                0),
             ('heartbeat/+',              0),
+            ('logicer/reload',           0),
+            # the aggregates, so unchanged ones are not published again
+            ('derived/+/+/+',            0),
             #('temp/+/+',     0),
         ]
 
-    def __init__(self, clientId='logicer', keepalive=60, heartbeat=True):
-        super(MQTTLogicer, self).__init__(clientId, keepalive=keepalive, heartbeat=heartbeat, daemon=True)
+    def __init__(self, clientId='logicer', keepalive=60, heartbeat=True, spaceapi=None, state_file=None,
+                 scheduler=None, dmx_master_fps=None, dmx_fade_fps=None, **kwargs):
+        super(MQTTLogicer, self).__init__(clientId, keepalive=keepalive, heartbeat=heartbeat, daemon=True, **kwargs)
+
+        self.last_state = statestore.StateStore(self.volatile_topics)
+
+        # topics loaded from the snapshot, not yet confirmed by a message
+        self.unconfirmed_topics = set()
+        # topics changed since the last snapshot flush
+        self.dirty_topics = set()
+        self.snapshot = None
+
+        if state_file:
+            self.load_snapshot(state_file)
 
-        self.last_state = {}
-        self.last_event = {}
+        # status updates are only queued until the publisher thread is started
+        self.spaceapi = spaceapi if spaceapi is not None else SpaceApiPublisher()
+
+        # without a scheduler `dmx/<room>/master` is relayed right away
+        self.scheduler = scheduler
+        if dmx_master_fps is not None:
+            self.dmx_master_fps = dmx_master_fps
+        # master topic -> (channels, payload) waiting for the next frame
+        self.dmx_master_pending = {}
+        self.dmx_master_last_flush = {}
+        self.dmx_master_coalesced = 0
+        self._dmx_master_lock = threading.Lock()
+
+        # channel -> payload last published for a `dmx/<room>/frame`
+        self.dmx_frame_sent = {}
+
+        if dmx_fade_fps:
+            self.dmx_fade_fps = dmx_fade_fps
+
+        self.liveness = liveness.LivenessMonitor(self.liveness_changed)
+
+        self.rules_lock = threading.RLock()
+        self.__dict__.update(self.compile_rules(rules_from_module(self.rules_module)))
+
+    def compile_rules(self, rules):
+        """
+        Build the dispatch tables from `value_changed_rules` and
+        `publish_rules` of `rules` (attribute name -> value, like
+        `rules_from_module` returns), the `scenes` by preset topic, a gesture
+        engine for the `gesture_rules`, an aggregate engine for the
+        `aggregate_rules` (initialized from `last_state`) and a fade engine
+        for the `dmx_channels`. Returns them as attribute name -> value.
+        """
+
+        engine = gestures.GestureEngine()
+        for topic, options, *rule in rules['gesture_rules']:
+            engine.configure(topic, self.bind_rule(rule), **options)
+
+        aggregate_engine = aggregates.AggregateEngine(self.aggregate_changed)
+        for output_topic, topics, predicate in rules['aggregate_rules']:
+            aggregate_engine.add(output_topic, topics, predicate)
+        aggregate_engine.seed((topic, entry.value) for topic, entry in self.last_state.items())
+
+        return {
+                'gestures': engine,
+                'aggregates': aggregate_engine,
+                # stepped by the scheduler, see `step_fades`
+                'fades': dmxfade.FadeEngine(rules['dmx_channels'], fps=self.dmx_fade_fps),
+                'value_changed_router': helpers.TopicRouter(
+                    (rule[0], self.bind_rule(rule[1:])) for rule in rules['value_changed_rules']
+                ),
+                'publish_router': helpers.TopicRouter(
+                    (rule[0], self.bind_rule(rule[1:])) for rule in rules['publish_rules'] + self.builtin_publish_rules
+                ),
+                'presets': compile_scenes(rules['scenes'], rules['scene_topics']),
+            }
+
+    def reload_rules(self):
+        """
+        Reload `rules_module` and replace the rules. The state and the
+        connection are kept; if the module is broken, the old rules stay.
+        """
+
+        start = time.monotonic()
+        try:
+            rules = rules_from_module(importlib.reload(self.rules_module))
+            compiled = self.compile_rules(rules)
+
+        except Exception as e:
+            logging.exception('reloading rules failed, keeping the old ones')
+            self.publish_rules_status({'ok': False, 'error': '{}: {}'.format(e.__class__.__name__, e)})
+            return False
+
+        with self.rules_lock:
+            compiled['gestures'].take_over(self.gestures)
+            if self.gestures.scheduler is not None:
+                compiled['gestures'].start(self.gestures.scheduler)
+            compiled['fades'].take_over(self.fades)
+            self.__dict__.update(rules)
+            self.__dict__.update(compiled)
+            self.publish_aggregates()
+
+        duration = time.monotonic() - start
+        logging.info('reloaded rules in {:.1f} ms'.format(duration * 1e3))
+        self.publish_rules_status({'ok': True, 'ms': round(duration * 1e3, 3)})
+        return True
+
+    def reload_command(self, topic, payload, retain):
+        if not retain:
+            self.reload_rules()
+
+    def publish_rules_status(self, status):
+        if self.connection_established:
+            self.mqtt_client.publish(self.rules_status_topic, json.dumps(status))
+
+    def bind_rule(self, rule):
+        name, *args = rule
+        handler = getattr(self, name)
+        if args:
+            return functools.partial(handler, *args)
+        return handler
 
     def on_message(self, client, userdata, msg):
 
-        if not msg.topic in self.last_state:
-            self.initial_value(msg.topic, msg.payload)
+        # the rules are not replaced by `reload_rules` while a message is handled
+        with self.rules_lock:
+            entry = self.last_state.get(msg.topic)
 
-        else:
-            if msg.payload != self.last_state[msg.topic].value:
+            if entry is None:
+                self.initial_value(msg.topic, msg.payload)
+
+            elif self.unconfirmed_topics and msg.retain and msg.topic in self.unconfirmed_topics:
+                # retained message after a restart, the snapshot value may be
+                # outdated but this is not a change happening right now
+                self.initial_value(msg.topic, msg.payload)
+
+            elif msg.payload != entry.value:
                 self.value_changed(msg.topic, msg.payload)
 
-        self.got_publish(msg.topic, msg.payload, msg.retain)
+            if self.unconfirmed_topics:
+                self.unconfirmed_topics.discard(msg.topic)
+
+            self.got_publish(msg.topic, msg.payload, msg.retain)
+
+            self.last_state.set(msg.topic, msg.payload, self.clock())
+            self.aggregates.update(msg.topic, msg.payload)
+
+            if self.snapshot is not None:
+                self.dirty_topics.add(msg.topic)
+
+    def load_snapshot(self, state_file):
+        """
+        Restore `last_state` from the on-disk snapshot, so rules work right
+        after a restart. Must be called before connecting.
+        """
+
+        start = time.monotonic()
+
+        self.snapshot = statestore.StateSnapshot(state_file)
+        for topic, (value, t) in self.snapshot.load().items():
+            self.last_state.set(topic, value, t)
+        self.unconfirmed_topics = set(self.last_state)
+        self.snapshot.compact(self.snapshot_entries(self.last_state))
+
+        logging.info('loaded {} topics from state snapshot in {:.1f} ms'.format(
+                len(self.last_state), (time.monotonic() - start) * 1e3))
+
+    def flush_snapshot(self):
+        """
+        Write the topics changed since the last call to the snapshot.
+        """
+
+        if self.snapshot is None:
+            return
+
+        # on_message adds to the set after updating last_state, so a topic
+        # changed concurrently is either written now or stays dirty
+        dirty = list(self.dirty_topics)
+        self.dirty_topics.difference_update(dirty)
+
+        if self.snapshot.needs_compaction():
+            self.snapshot.compact(self.snapshot_entries(self.last_state))
+        elif dirty:
+            self.snapshot.append(self.snapshot_entries(self.last_state, dirty), len(self.last_state))
+
+    def maintain_state(self):
+        """
+        Evict expired volatile topics and flush the snapshot, run periodically.
+        """
+
+        self.last_state.expire(self.clock())
+        self.flush_snapshot()
 
-        self.last_state[msg.topic] = _LastStateEntry(msg.payload, time.time())
+    def metrics_snapshot(self):
+        metrics = super(MQTTLogicer, self).metrics_snapshot()
+        metrics['last_state'] = self.last_state.stats()
+        metrics['dmx_master_coalesced'] = self.dmx_master_coalesced
+        metrics['dmx_fades'] = self.fades.stats()
+        return metrics
+
+    @staticmethod
+    def snapshot_entries(state, topics=None):
+        if topics is None:
+            topics = list(state)
+        for topic in topics:
+            entry = state.get(topic)
+            if entry is not None:
+                yield topic, entry.value, entry.time
 
 
     # FROM HERE ON: actual logic
@@ -193,237 +331,368 @@ class MQTTLogicer(helpers.MQTT_Client):
     def value_changed(self, topic, new_value):
         """
         Called when a topic receives a message which differs from the one
-        stored in `last_state`.
+        stored in `last_state`. Dispatches to the `value_changed_rules`.
         """
 
-        # legacy, new switch now
-        #if topic == 'schalter/wohnzimmer/rechts':
-        #    logging.debug('toggling club status')
-        #    self.mqtt_client.publish('club/status', new_value, retain=True)
-
-        if topic == 'schalter/gate/1' and new_value == b'\x00':
-            now = time.time()
-            timeout = now - self.last_state[topic].time
-            if timeout > 5:
-                logging.debug('sending force shutdown')
-                self.mqtt_client.publish('club/shutdown', b'\x44')
-            else:
-                logging.debug('sending shutdown')
-                self.mqtt_client.publish('club/shutdown', b'')
+        for handler in self.value_changed_router.match(topic):
+            handler(topic, new_value)
 
-        if topic == 'schalter/gate/2' and new_value == b'\x00':
-            logging.debug('toggling club status')
-            if self.last_state['club/status'].value == b'\x01':
-                self.mqtt_client.publish('club/status', b'\x00', retain=True)
-            else:
-                self.mqtt_client.publish('club/status', b'\x01', retain=True)
-
-        if topic == 'schalter/wohnzimmer/links':
-            logging.debug('toggling wohnzimmer')
-            self.toggle_room_lights(self.wohnzimmer_lichter)
-
-        if topic == 'schalter/wohnzimmer/gang':
-            logging.debug('toggling wohnzimmer')
-            self.toggle_room_lights(['licht/wohnzimmer/gang'])
-
-        if topic == 'schalter/plenar/vorne':
-            logging.debug('toggling plenarsaal')
-            self.toggle_room_lights(self.plenarsaal_lichter)
-
-        if topic == 'schalter/fnord/vorne':
-            logging.debug('toggling fnordcenter')
-            self.toggle_room_lights(self.fnordcenter_lichter)
-
-        if topic == 'schalter/keller/1' and new_value == b'\x00':
-            logging.debug('toggling keller')
-            self.toggle_room_lights(self.keller_lichter)
-
-        if topic in self.dmx_channels_plenarsaal and any(b for b in new_value):
-            if self.last_state['relais/plenar/dmx'].value != b'\x01':
-                logging.debug('non zero dmx code, switching on plenarsaal dmx socket {}'.format(self.last_state['relais/plenar/dmx'].value))
-                self.mqtt_client.publish('relais/plenar/dmx', b'\x01', retain=True)
-
-        if topic in self.dmx_channels_fnordcenter and any(b for b in new_value):
-            if self.last_state['relais/fnord/dmx'].value != b'\x01':
-                logging.debug('non zero dmx code, switching on fnordcenter dmx socket {}'.format(self.last_state['relais/fnord/dmx'].value))
-                self.mqtt_client.publish('relais/fnord/dmx', b'\x01', retain=True)
-            
-        cycle_topics = {
-                'schalter/keller/hinten2':[
-                        'led/keller/hintenwarm',
-                        'led/keller/hintenkalt'
-                    ],
-                'schalter/keller/3':[
-                        'led/keller/werkbankwarm',
-                        'led/keller/werkbankkalt'
-                    ],
-            }
+    def got_publish(self, topic, payload, retain):
+        """
+        Called for each message received. Dispatches to the `publish_rules`.
+        """
 
-        if (topic == 'schalter/keller/hinten2' or topic == 'schalter/keller/3') and new_value == b'\x00':
-            t = self.last_event.get(topic, 0)
-            now = time.time()
-            timeout = now - t
-            self.last_event[topic] = now
+        for handler in self.publish_router.match(topic):
+            handler(topic, payload, retain)
 
-            if timeout > 10:
-                logging.debug('toggling {}'.format(topic))
-                self.toggle_room_lights(cycle_topics[topic])
-            else:
-                logging.debug('cycling {}'.format(topic))
-                self.cycle_topic_states(
-                        cycle_topics[topic],
-                        [
-                            (b'\x00', b'\x00'),
-                            (b'\x01', b'\x01'),
-                            (b'\x01', b'\x00'),
-                            (b'\x00', b'\x01'),
-                        ]
-                    )
 
-        if topic == 'club/bell' and new_value == b'\x00':
+    # value_changed handlers
+
+    def club_status_switch(self, topic, new_value):
+        if new_value != b'\x00':
+            return
 
-            if self.last_state['club/status'].value == b'\x01':
-                logging.debug('bell received, opening door')
-                self.mqtt_client.publish('club/gate', b'')
+        logging.debug('toggling club status')
+        if self.last_state['club/status'].value == b'\x01':
+            self.mqtt_client.publish('club/status', b'\x00', retain=True)
+        else:
+            self.mqtt_client.publish('club/status', b'\x01', retain=True)
 
-            else:
-                logging.debug('bell off')
+    def toggle_switch(self, lights, topic, new_value):
+        logging.debug('toggling {}'.format(topic))
+        self.toggle_room_lights(lights)
 
-        if topic == 'beamer/plenar/lamp_state' and new_value == b'\x01':
-            logging.debug('beamer turned on, forcing dmx relay on')
-            # atem video switcher is currently (temporarily) on this relay
-            self.mqtt_client.publish('relais/plenar/dmx', b'\x01', retain=True)
+    def dmx_relay_on(self, relay, topic, new_value):
+        if not any(b for b in new_value):
+            return
 
+        if self.last_state[relay].value != b'\x01':
+            logging.debug('non zero dmx code, switching on dmx socket {} {}'.format(relay, self.last_state[relay].value))
+            self.mqtt_client.publish(relay, b'\x01', retain=True)
 
-    def got_publish(self, topic, payload, retain):
+    def bell(self, topic, new_value):
+        if new_value != b'\x00':
+            return
+
+        if self.last_state['club/status'].value == b'\x01':
+            logging.debug('bell received, opening door')
+            self.mqtt_client.publish('club/gate', b'')
+
+        else:
+            logging.debug('bell off')
+
+    def beamer_lamp_state(self, topic, new_value):
+        if new_value != b'\x01':
+            return
+
+        logging.debug('beamer turned on, forcing dmx relay on')
+        # atem video switcher is currently (temporarily) on this relay
+        self.mqtt_client.publish('relais/plenar/dmx', b'\x01', retain=True)
+
+
+    # gesture handlers
+
+    def shutdown_gesture(self, topic, gesture):
+        if gesture == 'long':
+            logging.debug('sending force shutdown')
+            self.mqtt_client.publish('club/shutdown', b'\x44')
+        elif gesture in ('short', 'repeat'):
+            logging.debug('sending shutdown')
+            self.mqtt_client.publish('club/shutdown', b'')
+
+    def toggle_gesture(self, lights, topic, gesture):
+        if gesture in ('short', 'long', 'repeat'):
+            logging.debug('toggling {}'.format(topic))
+            self.toggle_room_lights(lights)
+
+    def toggle_or_cycle_gesture(self, topics, topic, gesture):
         """
-        Called for each message received.
+        Toggle the topics, or cycle through `cycle_states` if the button was
+        pressed again within the cycle window.
         """
 
-        match = re.match(r'^licht/(fnord|wohnzimmer|plenar|keller)$', topic)
-        if match:
-            if retain:
-                return
+        if gesture in ('short', 'long'):
+            logging.debug('toggling {}'.format(topic))
+            self.toggle_room_lights(topics)
+        elif gesture == 'repeat':
+            logging.debug('cycling {}'.format(topic))
+            self.cycle_topic_states(topics, self.cycle_states)
 
-            # if payload is 0x00 or 0x01 relay to all light channels of the room
-            # else toggle the room
-            room = match.group(1)
-            if room == 'fnord':
-                lights = self.fnordcenter_lichter
-            elif room == 'wohnzimmer':
-                lights = self.wohnzimmer_lichter
-            elif room == 'plenar':
-                lights = self.plenarsaal_lichter
-            elif room == 'keller':
-                lights = self.keller_lichter
-            else:
-                logging.warning('This should not happen')
-                return
 
+    # got_publish handlers
 
-            if payload in (b'\x00', b'\x01'):
-                logging.debug('switching ' + room)
-                for t in lights:
-                    self.mqtt_client.publish(t, payload, retain=True)
+    def gesture_input(self, topic, payload, retain):
+        self.gestures.feed(topic, payload, retain, self.clock())
 
-            else:
-                logging.debug('toggling ' + room)
-                self.toggle_room_lights(lights)
+    def room_light_master(self, room, lights, topic, payload, retain):
+        if retain:
+            return
 
+        # if payload is 0x00 or 0x01 relay to all light channels of the room
+        # else toggle the room
+        if payload in (b'\x00', b'\x01'):
+            logging.debug('switching ' + room)
+            for t in lights:
+                self.mqtt_client.publish(t, payload, retain=True)
 
-        match = re.match(r'^dmx/(fnord|wohnzimmer|plenar|keller)/master$', topic)
-        if match:
-            if retain:
-                return
+        else:
+            logging.debug('toggling ' + room)
+            self.toggle_room_lights(lights)
 
-            # relay message to all dmx channels of the room
-            room = match.group(1)
-            for t in [s for s in self.dmx_channels if s.startswith('dmx/' + room)]:
-                self.mqtt_client.publish(t, payload, retain=True)
+    def room_dmx_master(self, channels, topic, payload, retain):
+        if retain:
+            return
+
+        # setting the room directly ends its fades
+        self.fades.cancel(channels)
 
+        if self.scheduler is None or not self.dmx_master_fps:
+            self.publish_dmx_master(channels, payload)
+            return
 
-        if topic.startswith('preset/'):
-            if retain:
+        # the first value is relayed right away, values arriving faster than
+        # the frame rate only replace the one waiting for the next frame
+        with self._dmx_master_lock:
+            if topic in self.dmx_master_pending:
+                self.dmx_master_pending[topic] = (channels, payload)
+                self.dmx_master_coalesced += 1
                 return
 
-            self.preset(topic, payload)
+            now = self.scheduler.clock()
+            next_frame = self.dmx_master_last_flush.get(topic, 0) + 1 / self.dmx_master_fps
+            if now < next_frame:
+                self.dmx_master_pending[topic] = (channels, payload)
+                self.scheduler.at(next_frame, functools.partial(self.flush_dmx_master, topic), name='dmx master')
+                return
 
+            self.dmx_master_last_flush[topic] = now
 
-        match = re.match(r'^heartbeat/(.*)$', topic)
-        if match:
-            logging.debug('heartbeat ' + match.group(1) + ": " + str(payload))
+        self.publish_dmx_master(channels, payload)
 
-        if topic.startswith('schalter/test/1'):
-            logging.debug('test: ' + str(payload))
+    def flush_dmx_master(self, topic):
+        with self._dmx_master_lock:
+            pending = self.dmx_master_pending.pop(topic, None)
+            if pending is None:
+                # cancelled by a newer command for the room
+                return
+            self.dmx_master_last_flush[topic] = self.scheduler.clock()
 
+        self.publish_dmx_master(*pending)
 
-        if topic == 'club/shutdown':
-            if retain:
-                return
+    def cancel_dmx_master(self, topic):
+        """
+        Drop the `dmx/<room>/master` value waiting for the next frame of the
+        room of `topic` (`dmx/<room>/<command>`), a newer command sets the
+        room.
+        """
+
+        with self._dmx_master_lock:
+            self.dmx_master_pending.pop(topic[:topic.rindex('/')] + '/master', None)
 
-            logging.debug('shutdown')
+    def cancel_dmx_masters(self, topics):
+        """
+        Drop the `dmx/<room>/master` values waiting for the next frame of
+        all rooms with channels in `topics`, which are set now.
+        """
 
-            # turn off beamer
-            self.mqtt_client.publish('beamer/plenar/control', 'power off')
+        topics = set(topics)
+        with self._dmx_master_lock:
+            for master, (channels, _) in list(self.dmx_master_pending.items()):
+                if not topics.isdisjoint(channels):
+                    del self.dmx_master_pending[master]
 
-            # turn off music and reset outputs
-            for t in self.musiken:
-                self.mqtt_client.publish(t+'/control', 'stop')
-                self.mqtt_client.publish(t+'/control', 'resetoutputs')
+    def publish_dmx_master(self, channels, payload):
+        # relay message to all dmx channels of the room
+        for t in channels:
+            self.mqtt_client.publish(t, payload, retain=True)
 
-            # turn off dmx lights
-            for t in self.dmx_channels:
-                self.mqtt_client.publish(t, b'\x00'*8, retain=True)
+    def room_dmx_frame(self, channels, topic, payload, retain):
+        """
+        Fan a frame of all channels of a room (see `dmxframe.py`) out to the
+        channel topics, for receivers which only know those.
+        """
 
-            to_switch = { t: b'\x00' for t in self.alle_lichter }
+        if retain:
+            return
 
-            if payload != b'\x44': # shutdown is not forced
-                # turn on lights corresponding to open windows
-                for fenster, licht in self.fenster_to_licht.items():
-                    if not fenster in self.last_state:
-                        pass # TODO: edge case
-                    elif self.last_state[fenster].value != b'\x00':
-                        to_switch[licht] = b'\x01'
-                        to_switch[self.exit_light] = b'\x01'
+        try:
+            payloads = dmxframe.unpack(payload)
+        except ValueError as e:
+            logging.warning('invalid frame on {}: {}'.format(topic, e))
+            return
 
-            # publish licht messages
-            for t, p in to_switch.items():
+        if len(payloads) > len(channels):
+            logging.warning('frame on {} has {} channels, the room only {}'.format(topic, len(payloads), len(channels)))
+            payloads = payloads[:len(channels)]
+
+        # setting the room directly ends its fades and a coalesced master
+        # value of an older message
+        self.fades.cancel(channels)
+        self.cancel_dmx_master(topic)
+
+        # unchanged channels are skipped, unless their last frame value is
+        # not confirmed by `last_state` yet
+        sent = self.dmx_frame_sent
+        current_value = self.current_value
+        for t, p in zip(channels, payloads):
+            if sent.get(t) != p or current_value(t) != p:
+                sent[t] = p
                 self.mqtt_client.publish(t, p, retain=True)
 
-            # set club status to closed
-            self.mqtt_client.publish('club/status', b'\x00', retain=True)
+    def room_dmx_fade(self, channels, topic, payload, retain):
+        """
+        Fade the dmx channels of a room, the payload is JSON like
+        `{"to": "ff8000", "time": 2.5, "easing": "in_out"}` (target payload
+        in hex, seconds, optional easing from `dmxfade.EASINGS`).
+        """
+
+        if retain:
+            return
 
-        if topic == 'club/status':
-            self.set_club_status(payload, self.last_state.get('club/status/message', NULL_STATE).value)
-        if topic == 'club/status/message':
-            self.set_club_status(self.last_state.get('club/status', _LastStateEntry(b'\x00', 0)).value, payload)
+        try:
+            fade = json.loads(payload)
+            target = bytes.fromhex(fade['to'])
+            duration = float(fade.get('time', 1))
+            self.fades.fade(channels, target, duration, self.clock(),
+                            easing=fade.get('easing', 'linear'), current_value=self.current_value)
+
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning('invalid fade on {}: {}'.format(topic, e))
+            return
 
+        # the fade replaces a coalesced master value of an older message
+        self.cancel_dmx_master(topic)
 
-    def preset(self, topic, payload):
+        logging.debug('fading {} channels of {} to {} in {}s'.format(len(channels), topic, fade['to'], duration))
 
-        match = re.match(r'^preset/(fnord|wohnzimmer|plenar|keller)/(on|off)$', topic)
-        if match:
-            logging.debug('preset ' + topic)
-            room = match.group(1)
-            if match.group(2) == 'on':
-                p = b'\x01'
-            else:
-                p = b'\x00'
-            self.mqtt_client.publish('licht/' + room, p)
-            self.mqtt_client.publish('dmx/' + room + '/master', b'\x00'*8)
+    def step_fades(self):
+        """
+        Publish the next frame of the running fades, run by the scheduler.
+        """
+
+        # the engine is not replaced by `reload_rules` during a step
+        with self.rules_lock:
+            for t, p in self.fades.step(self.clock()):
+                if self.connection_established:
+                    self.mqtt_client.publish(t, p, retain=True)
+
+    def heartbeat_received(self, topic, payload, retain):
+        logging.debug('heartbeat ' + topic[len('heartbeat/'):] + ": " + str(payload))
+        self.liveness.heartbeat(topic[len('heartbeat/'):], payload, self.clock(), retain)
+
+    def poll_liveness(self):
+        self.liveness.poll(self.clock())
+
+    def liveness_changed(self, client, state, states):
+        logging.info('{} is {}'.format(client, state))
+
+        if not self.connection_established:
+            return
+
+        self.mqtt_client.publish('health/' + client, b'\x01' if state == liveness.UP else b'\x00', retain=True)
+        self.mqtt_client.publish('health', json.dumps(states, sort_keys=True, separators=(',', ':')), retain=True)
+
+    def test_switch(self, topic, payload, retain):
+        logging.debug('test: ' + str(payload))
+
+    def shutdown(self, topic, payload, retain):
+        if retain:
             return
 
+        logging.debug('shutdown')
+
+        # turn off beamer
+        messages = [('beamer/plenar/control', 'power off', False)]
+
+        # turn off music and reset outputs
+        for t in self.musiken:
+            messages.append((t+'/control', 'stop', False))
+            messages.append((t+'/control', 'resetoutputs', False))
+
+        # turn off dmx lights
+        for t in self.dmx_channels:
+            messages.append((t, b'\x00'*8, True))
+
+        to_switch = { t: b'\x00' for t in self.alle_lichter }
+
+        if payload != b'\x44': # shutdown is not forced
+            # turn on lights corresponding to open windows (windows without
+            # known state are treated as closed)
+            for room, windows in self.room_fenster.items():
+                group = self.aggregates.group(windows)
+                if group is None:
+                    continue
+                for fenster in group.active:
+                    to_switch[self.fenster_to_licht[fenster]] = b'\x01'
+                    to_switch[self.exit_light] = b'\x01'
 
-        match = re.match(r'^preset/(wohnzimmer|plenar)/fade$', topic)
-        if match:
-            logging.debug('preset ' + topic)
-            room = match.group(1)
-            self.mqtt_client.publish('licht/' + room, b'\x00')
-            self.mqtt_client.publish('dmx/' + room + '/master', b'\x00\x00\x00\x00\x00\x81\xff')
+        # licht messages
+        for t, p in to_switch.items():
+            messages.append((t, p, True))
+
+        # set club status to closed
+        messages.append(('club/status', b'\x00', True))
+
+        # running fades and coalesced master values would turn the dmx
+        # lights on again
+        self.fades.cancel(self.dmx_channels)
+        self.cancel_dmx_masters(self.dmx_channels)
+
+        # only topics not already in the target state are sent
+        self.publish_scene(messages, current_value=self.current_value, name='shutdown')
+
+    def club_status(self, topic, payload, retain):
+        self.set_club_status(payload, self.last_state.get('club/status/message', NULL_STATE).value)
+
+    def club_status_message(self, topic, payload, retain):
+        self.set_club_status(self.last_state.get('club/status', _LastStateEntry(b'\x00', 0)).value, payload)
+
+    def preset(self, topic, payload, retain):
+        if retain:
             return
 
-        logging.info('unknown preset')
+        scene = self.presets.get(topic)
+        if scene is None:
+            logging.info('unknown preset')
+            return
 
+        logging.debug('preset ' + topic)
+        self.apply_scene(topic[len('preset/'):], scene)
+
+    def apply_scene(self, name, scene):
+        """
+        Publish the `(topic, payload)` pairs of a compiled scene whose topics
+        are not in that state already. Fades and coalesced master values of
+        the scene's dmx channels end.
+        """
+
+        topics = [t for t, _ in scene]
+        self.fades.cancel(topics)
+        self.cancel_dmx_masters(topics)
+
+        current_value = self.current_value
+        messages = [(t, p, True) for t, p in scene if current_value(t) != p]
+        logging.debug('scene {}: {} of {} topics changed'.format(name, len(messages), len(scene)))
+
+        if messages:
+            self.publish_scene(messages, name=name)
+
+    def aggregate_changed(self, topic, value):
+        if self.connection_established and self.current_value(topic) != value:
+            self.mqtt_client.publish(topic, value, retain=True)
+
+    def publish_aggregates(self):
+        for group in self.aggregates.groups.values():
+            if group.value is not None:
+                self.aggregate_changed(group.output_topic, group.value)
+
+    def current_value(self, topic):
+        """
+        Last received payload of `topic`, or None if unknown.
+        """
+
+        entry = self.last_state.get(topic)
+        return None if entry is None else entry.value
 
     def toggle_room_lights(self, room_lights):
         """
@@ -432,13 +701,23 @@ class MQTTLogicer(helpers.MQTT_Client):
             * If no light is on, turn all on.
         """
 
-        for t in room_lights:
-            if not t in self.last_state:
-                # strange edge case - i don't know what to do
-                logging.warning('Toggling light without known last state, ignoring. ({})'.format(repr(t)))
+        group = self.aggregates.group(room_lights)
+
+        if group is not None:
+            if group.unknown:
+                logging.warning('Toggling lights without known last state, ignoring. ({})'.format(repr(group.output_topic)))
                 return
 
-        some_light_on = any(self.last_state[t].value != b'\x00' for t in room_lights)
+            some_light_on = bool(group.active)
+
+        else:
+            for t in room_lights:
+                if not t in self.last_state:
+                    # strange edge case - i don't know what to do
+                    logging.warning('Toggling light without known last state, ignoring. ({})'.format(repr(t)))
+                    return
+
+            some_light_on = any(self.last_state[t].value != b'\x00' for t in room_lights)
 
         if some_light_on:
             logging.debug('turning lights off')
@@ -494,33 +773,86 @@ class MQTTLogicer(helpers.MQTT_Client):
             #logging.debug('setting irc topic')
             #Popen(['/usr/bin/python2.7', '/home/autoc4/logicer/irc_topicer.py', status])
 
-            # forward to webserver (for spaceapi)
+            # forward to webserver (for spaceapi), without blocking the mqtt loop
             logging.debug('setting spaceapi open status')
-            try:
-                requests.post(
-                        'https://api.koeln.ccc.de/newstate',
-                        timeout=5,
-                        data={
-                            "password"  : config.spaceapi_password,
-                            "state"     : status,
-                            "message"   : ( message.decode("utf-8") if isinstance(message, bytes) else message )
-                        }
-                    )
-            except Exception as e:
-                logging.warning('connection to webserver/spaceapi failed: {}'.format(repr(e)))
+            self.spaceapi.submit(status, message.decode("utf-8") if isinstance(message, bytes) else message)
 
 
-class MQTT_Time_Thread(threading.Thread):
+def compile_scenes(scenes, topics):
     """
-    Publishes the current time in regular intervals.
+    Expand the topic filters of `scenes` (see logicer_rules.py) to `topics`
+    and decode the payloads. Returns preset topic -> tuple of `(topic,
+    payload)`; later entries of a scene override earlier ones.
     """
 
-    interval = 60
-    topic = 'time'
+    compiled = {}
+    for name, entries in scenes.items():
+        target = {}
+        for topic_filter, payload in entries.items():
+            payload = bytes.fromhex(payload)
+            if '+' in topic_filter or '#' in topic_filter:
+                matching = [t for t in topics if topic_matches_sub(topic_filter, t)]
+                if not matching:
+                    raise ValueError('scene {}: {} matches no topic'.format(name, topic_filter))
+            else:
+                matching = [topic_filter]
+            for t in matching:
+                target[t] = payload
+        compiled['preset/' + name] = tuple(target.items())
+    return compiled
 
-    def __init__(self, logicer, *args, **kwargs):
-        super(MQTT_Time_Thread, self).__init__(*args, daemon=True, **kwargs)
-        self.logicer = logicer
+
+def rules_from_module(module):
+    """
+    The rules defined in a rules module, as attribute name -> value.
+    """
+
+    return {
+            name: value for name, value in vars(module).items()
+            if not name.startswith('_') and not isinstance(value, types.ModuleType)
+        }
+
+
+# the rules are class attributes, for code using them without an instance
+for _name, _value in rules_from_module(logicer_rules).items():
+    setattr(MQTTLogicer, _name, _value)
+
+
+class SpaceApiPublisher(threading.Thread):
+    """
+    Forwards the club status to the SpaceAPI webserver.
+
+    Runs in its own thread, so a slow webserver never delays the MQTT loop.
+    Only the latest submitted status is kept ("latest wins"), failed requests
+    are retried with exponential backoff unless a newer status comes in, and
+    a (state, message) pair which was already sent successfully is not sent
+    again.
+    """
+
+    url = 'https://api.koeln.ccc.de/newstate'
+    timeout = 5
+    retry_delays = [1, 2, 4, 8, 16, 32, 60]
+
+    def __init__(self, url=None, password=None, *args, **kwargs):
+        super(SpaceApiPublisher, self).__init__(*args, daemon=True, **kwargs)
+
+        if url is not None:
+            self.url = url
+        self.password = config.spaceapi_password if password is None else password
+
+        self.session = requests.Session()
+        self.condition = threading.Condition()
+        self.pending = None
+        self.last_sent = None
+
+    def submit(self, state, message):
+        """
+        Queue a status update, replacing any update not yet sent. Never blocks.
+        """
+
+        with self.condition:
+            self.pending = (state, message)
+            self.condition.notify()
 
     def run(self):
 
@@ -528,21 +860,82 @@ class MQTT_Time_Thread(threading.Thread):
             self.main_loop()
 
         except:
-            logging.exception('Thimethread exception, exiting.')
+            logging.exception('SpaceAPI thread exception, exiting.')
 
     def main_loop(self):
 
-        while not self.logicer.connection_established:
-            time.sleep(0.1)
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                update, self.pending = self.pending, None
+
+            if update == self.last_sent:
+                logging.debug('spaceapi status unchanged, not sending')
+                continue
 
-        logging.info('timethread started')
+            self.send(update)
 
-        while True:
-            self.publish_time()
-            time.sleep(self.interval)
+    def send(self, update):
+        state, message = update
+
+        # the last attempt is not followed by a delay
+        for delay in self.retry_delays + [None]:
+            try:
+                response = self.session.post(
+                        self.url,
+                        timeout=self.timeout,
+                        data={
+                            "password"  : self.password,
+                            "state"     : state,
+                            "message"   : message,
+                        }
+                    )
+
+                if response.status_code < 500:
+                    if response.ok:
+                        self.last_sent = update
+                    else:
+                        logging.warning('spaceapi rejected status update: {}'.format(response.status_code))
+                    return
+
+                error = 'HTTP {}'.format(response.status_code)
+
+            except requests.RequestException as e:
+                error = repr(e)
+
+            if delay is None:
+                break
+
+            logging.warning('connection to webserver/spaceapi failed, retrying in {}s: {}'.format(delay, error))
+
+            # wait before retrying, unless a newer status supersedes this one
+            with self.condition:
+                if self.condition.wait_for(lambda: self.pending is not None, timeout=delay):
+                    return
+
+        # give up on this update, the next submitted one will be sent again
+        logging.warning('giving up on spaceapi status update: {}'.format(error))
+
+
+class MQTT_Time_Publisher():
+    """
+    Publishes the current time every full minute, run by the scheduler.
+    """
+
+    interval = 60
+    topic = 'time'
+
+    def __init__(self, logicer):
+        self.logicer = logicer
+
+    def schedule(self, scheduler):
+        return scheduler.every(self.interval, self.publish_time, align=True, name='time')
 
     def publish_time(self):
 
+        if not self.logicer.connection_established:
+            return
+
         t = datetime.now()
         data = struct.pack('<BBBBBBBB',
             t.hour,
@@ -557,29 +950,50 @@ class MQTT_Time_Thread(threading.Thread):
         self.logicer.mqtt_client.publish(self.topic, data)
 
 
+def add_arguments(parser):
+    parser.add_argument('--state-file', default='logicer-state.bin', help='Snapshot of the last known topic states, empty to disable')
+    parser.add_argument('--dmx-master-fps', type=float, default=MQTTLogicer.dmx_master_fps, help='Max rate of relayed dmx/<room>/master values, 0 to relay every message')
+    parser.add_argument('--dmx-fade-fps', type=float, default=MQTTLogicer.dmx_fade_fps, help='Frame rate of dmx/<room>/fade fades')
+
+
+def create_daemon(args):
+    spaceapi = SpaceApiPublisher()
+    spaceapi.start()
+
+    scheduler = helpers.get_scheduler()
+
+    logicer = MQTTLogicer(spaceapi=spaceapi, state_file=args.state_file, scheduler=scheduler,
+                          dmx_master_fps=args.dmx_master_fps, dmx_fade_fps=args.dmx_fade_fps,
+                          **helpers.get_client_kwargs(args))
+
+    logicer.gestures.start(scheduler)
+
+    MQTT_Time_Publisher(logicer).schedule(scheduler)
+
+    scheduler.every(1, logicer.poll_liveness, name='liveness')
+
+    scheduler.every(1 / logicer.fades.fps, logicer.step_fades, name='dmx fades')
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: logicer.reload_rules())
+
+    # writes the changed part of `last_state` to the snapshot
+    scheduler.every(logicer.state_flush_interval, logicer.maintain_state, name='state')
+
+    return helpers.Daemon(logicer, [scheduler, spaceapi], logicer.flush_snapshot)
+
+
 def main():
     parser = argparse.ArgumentParser(
             description='MQTT Logicer',
             parents=[helpers.get_default_parser()],
         )
+    add_arguments(parser)
     args = parser.parse_args()
     helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
 
     logging.info('starting')
 
-    logicer = MQTTLogicer()
-    logicer.start()
-
-    timethread = MQTT_Time_Thread(logicer)
-    timethread.start()
-
-    while logicer.is_alive() and timethread.is_alive():
-        time.sleep(1)
-
-    logging.info('exiting')
-    sys.stdout.flush()
-    sys.stderr.flush()
-    sys.exit(1)
+    helpers.run_daemon(create_daemon(args))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,204 @@
+"""
+Rooms, topics and rule tables of the logicer.
+
+Everything defined here becomes an attribute of `logicer.MQTTLogicer`. The
+module is reloaded by `MQTTLogicer.reload_rules` (on SIGHUP or a message to
+`logicer/reload`), so rules can be changed without restarting the logicer.
+Handler names refer to methods of `MQTTLogicer`.
+"""
+
+import json
+import os
+
+fnordcenter_lichter = [
+    'licht/fnord/links',
+    'licht/fnord/rechts',
+]
+keller_lichter = [
+    'licht/keller/loet',
+    'licht/keller/mitte',
+    'licht/keller/vorne',
+]
+leds_keller = [
+    'led/keller/werkbankwarm',
+    'led/keller/werkbankkalt',
+    'led/keller/hintenwarm',
+    'led/keller/hintenkalt',
+]
+wohnzimmer_lichter = [
+    'licht/wohnzimmer/kueche',
+    'licht/wohnzimmer/mitte',
+    'licht/wohnzimmer/tuer',
+    'licht/wohnzimmer/gang',
+]
+plenarsaal_lichter = [
+    'licht/plenar/vornefenster',
+    'licht/plenar/vornewand',
+    'licht/plenar/hintenfenster',
+    'licht/plenar/hintenwand',
+]
+powers = [
+    'power/wohnzimmer/kitchenlight',
+]
+sockets = [
+    'socket/wohnzimmer/screen/a',
+    'socket/wohnzimmer/screen/b',
+    'relais/plenar/amp',
+    'relais/plenar/dmx',
+    'relais/fnord/dmx',
+    'relais/fnord/audio',
+]
+screens = [
+    'screen/wohnzimmer/infoscreen'
+]
+alle_lichter = fnordcenter_lichter + keller_lichter + wohnzimmer_lichter + plenarsaal_lichter + powers + sockets + leds_keller + screens
+exit_light = 'licht/wohnzimmer/tuer'
+
+fenster_to_licht = {
+    'fenster/plenar/vornerechts': 'licht/plenar/vornefenster',
+    'fenster/plenar/vornelinks': 'licht/plenar/vornefenster',
+    'fenster/plenar/hintenrechts': 'licht/plenar/hintenfenster',
+    'fenster/plenar/hintenlinks': 'licht/plenar/hintenfenster',
+    'fenster/wohnzimmer/rechts': 'licht/wohnzimmer/kueche',
+    'fenster/wohnzimmer/links': 'licht/wohnzimmer/kueche',
+    'fenster/fnord/links': 'licht/fnord/links',
+    'fenster/fnord/rechts': 'licht/fnord/rechts',
+}
+
+musiken = [
+    'mpd/plenar',
+    'mpd/fnord',
+    'mpd/baellebad',
+    'mpd/keller',
+]
+
+dmx_channels_fnordcenter = [
+    'dmx/fnord/fairyfenster',
+    'dmx/fnord/schranklinks',
+    'dmx/fnord/schrankrechts',
+    'dmx/fnord/scummfenster',
+]
+dmx_channels_wohnzimmer = [
+    'dmx/wohnzimmer/mitte1',
+    'dmx/wohnzimmer/mitte2',
+    'dmx/wohnzimmer/mitte3',
+    'dmx/wohnzimmer/tuer1',
+    'dmx/wohnzimmer/tuer2',
+    'dmx/wohnzimmer/tuer3',
+    'dmx/wohnzimmer/gang',
+    'dmx/wohnzimmer/baellebad',
+    'dmx/wohnzimmer/spuele1',
+    'dmx/wohnzimmer/spuele2',
+    'dmx/wohnzimmer/chaosknoten',
+    'dmx/wohnzimmer/tresen',
+    'dmx/wohnzimmer/tresen2',
+]
+leds_wohnzimmer = [
+    'led/kitchen/sink',
+]
+dmx_channels_plenarsaal = [
+    'dmx/plenar/vorne1',
+    'dmx/plenar/vorne2',
+    'dmx/plenar/vorne3',
+    'dmx/plenar/hinten1',
+    'dmx/plenar/hinten2',
+    'dmx/plenar/hinten3',
+    'dmx/plenar/hinten4',
+]
+dmx_channels = dmx_channels_fnordcenter + dmx_channels_wohnzimmer + dmx_channels_plenarsaal + leds_wohnzimmer
+
+room_lights = {
+    'fnord': fnordcenter_lichter,
+    'wohnzimmer': wohnzimmer_lichter,
+    'plenar': plenarsaal_lichter,
+    'keller': keller_lichter,
+}
+room_dmx_channels = {
+    'fnord': dmx_channels_fnordcenter,
+    'wohnzimmer': dmx_channels_wohnzimmer,
+    'plenar': dmx_channels_plenarsaal,
+    'keller': [],
+}
+
+room_fenster = {
+    room: [f for f in fenster_to_licht if f.split('/')[1] == room] for room in room_lights
+}
+
+cycle_states = [
+    (b'\x00', b'\x00'),
+    (b'\x01', b'\x01'),
+    (b'\x01', b'\x00'),
+    (b'\x00', b'\x01'),
+]
+
+# Rule tables: (topic filter, handler method name, *extra handler args)
+#
+# Handlers get the extra args followed by the topic and the payload (and,
+# for `publish_rules`, the retain flag). The tables are compiled into
+# `helpers.TopicRouter`s by `compile_rules`.
+
+# push buttons, recognised by the gesture engine (see `gestures.py`):
+# (topic, gesture options, handler method name, *extra handler args)
+gesture_rules = [
+    ('schalter/gate/1',             {'long_press': 5},      'shutdown_gesture'),
+    ('schalter/keller/1',           {},                     'toggle_gesture', keller_lichter),
+    ('schalter/keller/hinten2',     {'cycle_window': 10},   'toggle_or_cycle_gesture', ['led/keller/hintenwarm', 'led/keller/hintenkalt']),
+    ('schalter/keller/3',           {'cycle_window': 10},   'toggle_or_cycle_gesture', ['led/keller/werkbankwarm', 'led/keller/werkbankkalt']),
+]
+
+# called when the payload differs from the one stored in `last_state`
+value_changed_rules = [
+    ('schalter/gate/2',             'club_status_switch'),
+    ('schalter/wohnzimmer/links',   'toggle_switch', wohnzimmer_lichter),
+    ('schalter/wohnzimmer/gang',    'toggle_switch', ['licht/wohnzimmer/gang']),
+    ('schalter/plenar/vorne',       'toggle_switch', plenarsaal_lichter),
+    ('schalter/fnord/vorne',        'toggle_switch', fnordcenter_lichter),
+    ('club/bell',                   'bell'),
+    ('beamer/plenar/lamp_state',    'beamer_lamp_state'),
+] + [
+    (t, 'dmx_relay_on', 'relais/plenar/dmx') for t in dmx_channels_plenarsaal
+] + [
+    (t, 'dmx_relay_on', 'relais/fnord/dmx') for t in dmx_channels_fnordcenter
+]
+
+# called for each message received
+publish_rules = [
+    ('preset/+/+',                  'preset'),
+    ('heartbeat/+',                 'heartbeat_received'),
+    ('schalter/test/1',             'test_switch'),
+    ('club/shutdown',               'shutdown'),
+    ('club/status',                 'club_status'),
+    ('club/status/message',         'club_status_message'),
+] + [
+    ('licht/' + room, 'room_light_master', room, lights) for room, lights in room_lights.items()
+] + [
+    ('dmx/' + room + '/master', 'room_dmx_master', tuple(channels)) for room, channels in room_dmx_channels.items()
+] + [
+    ('dmx/' + room + '/fade', 'room_dmx_fade', tuple(channels)) for room, channels in room_dmx_channels.items() if channels
+] + [
+    ('dmx/' + room + '/frame', 'room_dmx_frame', tuple(channels)) for room, channels in room_dmx_channels.items() if channels
+] + [
+    (rule[0], 'gesture_input') for rule in gesture_rules
+]
+
+# scenes applied by `preset/<room>/<name>`, see scenes.json:
+# scene name -> {topic or topic filter: hex payload}
+#
+# Topic filters are expanded to the matching `scene_topics`. Only topics
+# whose last known payload differs from the scene are published.
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenes.json')) as _f:
+    scenes = json.load(_f)
+scene_topics = alle_lichter + dmx_channels
+
+# derived topics, maintained by the aggregate engine (see `aggregates.py`):
+# (output topic, member topics, predicate)
+#
+# They are kept under `derived/`, out of the namespaces of the member topics,
+# so receivers subscribed to e.g. `dmx/+/+` do not take them for channels.
+aggregate_rules = [
+    ('derived/licht/' + room + '/any_on', lights, 'on') for room, lights in room_lights.items()
+] + [
+    ('derived/fenster/' + room + '/any_open', windows, 'on') for room, windows in room_fenster.items() if windows
+] + [
+    ('derived/dmx/' + room + '/any_on', channels, 'nonzero') for room, channels in room_dmx_channels.items() if channels
+]
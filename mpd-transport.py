@@ -96,8 +96,8 @@ class MQTT_mpd_transport(helpers.MQTT_Client):
             ('mpd/+/control', 0),
         ]
 
-    def __init__(self, clientId='mpd-bridge', keepalive=60, heartbeat=True):
-        super(MQTT_mpd_transport, self).__init__(clientId, keepalive=keepalive, heartbeat=heartbeat, daemon=True)
+    def __init__(self, clientId='mpd-bridge', keepalive=60, heartbeat=True, **kwargs):
+        super(MQTT_mpd_transport, self).__init__(clientId, keepalive=keepalive, heartbeat=heartbeat, daemon=True, **kwargs)
 
     def on_message(self, client, userdata, msg):
         match = re.match(r'mpd/(\w+)/control', msg.topic)
@@ -158,6 +158,10 @@ class MPD_idler(threading.Thread):
             logging.exception('MPD Thread exception, exiting.')
 
     def main_loop(self):
+        # wait for mqtt thread to start, connect, ...
+        while not self.mqtt_thread.connection_established:
+            time.sleep(0.1)
+
         self.client = mpd.MPDClient()
         self.client.timeout = 10
         self.client.idletimeout = None
@@ -239,23 +243,9 @@ class MPD_idler(threading.Thread):
         self.mqtt_thread.mqtt_client.publish(self.mqtt_topic_prefix + '/song/json', json.dumps(currentsong_dict), retain=True, qos=0)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-            description='MQTT MPD Bridge',
-            parents=[helpers.get_default_parser()],
-        )
-    args = parser.parse_args()
-    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
-
-    logging.info('starting')
-
+def create_daemon(args):
     logging.info('starting mqtt-mpd transport')
-    mqtt_thread = MQTT_mpd_transport()
-    mqtt_thread.start()
-
-    # wait for mqtt thread to start, connect, ...
-    while not mqtt_thread.connection_established:
-        time.sleep(0.1)
+    mqtt_thread = MQTT_mpd_transport(**helpers.get_client_kwargs(args))
 
     mpd_threads = []
 
@@ -265,12 +255,20 @@ def main():
         t.start()
         mpd_threads.append(t)
 
+    return helpers.Daemon(mqtt_thread, mpd_threads, None)
+
 
-    while mqtt_thread.is_alive() and all(t.is_alive() for t in mpd_threads):
-        time.sleep(1)
+def main():
+    parser = argparse.ArgumentParser(
+            description='MQTT MPD Bridge',
+            parents=[helpers.get_default_parser()],
+        )
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    logging.info('starting')
 
-    logging.info('exiting')
-    sys.exit(1)
+    helpers.run_daemon(create_daemon(args))
 
 
 if __name__ == '__main__':
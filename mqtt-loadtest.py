@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+"""
+End-to-end load test of a daemon through an MQTT broker.
+
+Publishes numbered messages to `--topic` at `--rate` and measures the time
+until the daemon under test forwarded them to `--expect`. The sequence number
+is stored in the first 4 payload bytes, so this works for daemons which relay
+payloads (like the logicer for `dmx/<room>/master`).
+
+By default the test runs against an in-process `mqttbroker.MQTTBroker` and
+starts the logicer in-process, so nothing but python is needed. Other daemons
+can be started separately, pointed at the broker with `--mqtt-host` /
+`--mqtt-port`.
+
+Usage:
+    python mqtt-loadtest.py [--rate 30] [--seconds 10] [--latency-ms 0]
+    python mqtt-loadtest.py --no-logicer --mqtt-port 1883 --topic ... --expect ...
+"""
+
+import argparse
+import logging
+import struct
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+
+import helpers
+import logicer
+import mqttbroker
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTester():
+
+    def __init__(self, host, port, topic, expect, payload_size=8):
+        self.topic = topic
+        self.expect = expect
+        self.payload_size = payload_size
+
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self.lock = threading.Lock()
+        self.subscribed = threading.Event()
+
+        self.client = mqtt_client.Client('loadtest')
+        self.client.on_connect = self.on_connect
+        self.client.on_subscribe = lambda *a: self.subscribed.set()
+        self.client.on_message = self.on_message
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.expect)
+
+    def on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        if len(msg.payload) < 4:
+            return
+
+        seq, = struct.unpack_from('!I', msg.payload)
+        with self.lock:
+            sent = self.sent.pop(seq, None)
+            self.received += 1
+            if sent is not None:
+                self.latencies.append(now - sent)
+
+    def run(self, rate, seconds):
+        interval = 1 / rate
+        start = time.perf_counter()
+
+        for seq in range(1, int(rate * seconds) + 1):
+            deadline = start + seq * interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            payload = struct.pack('!I', seq) + b'\xff' * (self.payload_size - 4)
+            with self.lock:
+                self.sent[seq] = time.perf_counter()
+            self.client.publish(self.topic, payload)
+
+        # wait for stragglers
+        time.sleep(1)
+        self.client.loop_stop()
+
+        return time.perf_counter() - start - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='MQTT end-to-end load test',
+            parents=[helpers.get_default_parser()],
+        )
+    parser.add_argument('--rate', type=float, default=30, help='Messages per second')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--topic', default='dmx/plenar/master')
+    parser.add_argument('--expect', default='dmx/plenar/vorne1')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Injected latency of the in-process broker')
+    parser.add_argument('--no-logicer', action='store_true', help='Do not start the logicer in-process')
+    parser.set_defaults(loglevel='warning')
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    host = args.mqtt_host or '127.0.0.1'
+    port = args.mqtt_port
+
+    if port is None:
+        broker = mqttbroker.MQTTBroker(host, 0, args.latency_ms / 1e3)
+        broker.start()
+        port = broker.port
+
+        # retained state a production broker would hold, the logicer rules
+        # expect it
+        for t in logicer.MQTTLogicer.alle_lichter + logicer.MQTTLogicer.dmx_channels + ['relais/plenar/dmx', 'relais/fnord/dmx', 'club/status']:
+            broker.publish(t, b'\x00', 0, True)
+
+    if not args.no_logicer:
+        lg = logicer.MQTTLogicer(mqtt_host=host, mqtt_port=port)
+        lg.start()
+        while not lg.connection_established:
+            time.sleep(0.01)
+
+    tester = LoadTester(host, port, args.topic, args.expect)
+    tester.subscribed.wait(5)
+    duration = tester.run(args.rate, args.seconds)
+
+    latencies = sorted(tester.latencies)
+    print('sent:           {}'.format(int(args.rate * args.seconds)))
+    print('received:       {} ({:.0f}/s)'.format(tester.received, tester.received / duration))
+    print('lost:           {}'.format(len(tester.sent)))
+    for p in (50, 90, 99, 100):
+        print('latency p{:<5}  {:.2f} ms'.format(p, percentile(latencies, p) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
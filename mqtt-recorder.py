@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+"""
+Records MQTT traffic into a capture file, see `capture.py`.
+
+The capture can be replayed through the logicer with `logicer-replay.py`.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import capture
+import helpers
+
+
+class MQTT_Recorder(helpers.MQTT_Client):
+
+    def __init__(self, writer, topics, clientId='recorder', keepalive=60, **kwargs):
+        super(MQTT_Recorder, self).__init__(clientId, keepalive=keepalive, heartbeat=False, daemon=True, **kwargs)
+
+        self.writer = writer
+        self.subscribe_topics = [(t, 0) for t in topics]
+
+    def on_message(self, client, userdata, msg):
+        self.writer.write(time.time(), msg.topic, msg.payload, msg.qos, msg.retain)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='MQTT Traffic Recorder',
+            parents=[helpers.get_default_parser()],
+        )
+    parser.add_argument('--topic', action='append', help='Topic filter to record, may be given multiple times (default: #)')
+    parser.add_argument('output', help='Capture file to write')
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    writer = capture.CaptureWriter(args.output)
+
+    recorder = MQTT_Recorder(writer, args.topic or ['#'], **helpers.get_client_kwargs(args))
+    recorder.start()
+
+    try:
+        while recorder.is_alive():
+            time.sleep(1)
+            writer.flush()
+
+    except KeyboardInterrupt:
+        pass
+
+    writer.close()
+    logging.info('recorded {} messages'.format(writer.count))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@
 For manual MQTT testing.
 
 Usage:
-    python -i mqtt-test.py
+    python -i mqtt-test.py [host [port]]
 """
 
 import sys
@@ -16,7 +16,11 @@ def pr(mosq, obj, msg):
 
 mqtt_client = mqtt_client.Client("testid")
 mqtt_client.on_message = pr
-mqtt_client.connect('127.0.0.1', 1883, 6000)
+mqtt_client.connect(
+        sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1883,
+        6000,
+    )
 #mqtt_client.subscribe('heartbeat/#', 2)
 #mqtt_client.publish('heartbeat/test', b'', retain=True)
 #mqtt_client.loop_forever()
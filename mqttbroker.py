@@ -0,0 +1,397 @@
+#!/usr/bin/python3
+
+"""
+A small MQTT 3.1.1 broker for tests and benchmarks, so the daemons can be run
+against each other on one machine without mosquitto.
+
+Supports wildcard subscriptions, retained messages, wills, QoS 0 and 1 for
+delivery (QoS 2 publishes are accepted, subscriptions are granted at most
+QoS 1) and an injected delivery latency. Sessions are not persisted.
+
+Usage:
+    python mqttbroker.py [--port 1883] [--latency-ms 0]
+
+or in-process:
+    broker = mqttbroker.MQTTBroker(port=0)
+    broker.start()
+    client = helpers.MQTT_Client('test', mqtt_port=broker.port)
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+
+from paho.mqtt.client import topic_matches_sub
+
+import helpers
+
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        out.append(byte)
+        if not length:
+            return bytes(out)
+
+
+def encode_string(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+def packet(header, body=b''):
+    return bytes((header,)) + encode_length(len(body)) + body
+
+
+class _Reader():
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def u8(self):
+        self.offset += 1
+        return self.data[self.offset - 1]
+
+    def u16(self):
+        self.offset += 2
+        return struct.unpack_from('!H', self.data, self.offset - 2)[0]
+
+    def binary(self):
+        length = self.u16()
+        self.offset += length
+        return self.data[self.offset - length:self.offset]
+
+    def string(self):
+        return self.binary().decode('utf-8')
+
+    def rest(self):
+        return self.data[self.offset:]
+
+
+class Session():
+    """
+    A connected client. Received packets are handled in the reader thread,
+    outgoing packets are sent by a writer thread after the injected latency.
+    """
+
+    def __init__(self, broker, sock, address):
+        self.broker = broker
+        self.sock = sock
+        self.address = address
+        self.client_id = None
+        self.will = None
+        self.subscriptions = {}
+        self.closed = False
+
+        self._packet_ids = itertools.cycle(range(1, 65536))
+        self._queue = []
+        self._sequence = itertools.count()
+        self._queue_condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, data, delay=0):
+        with self._queue_condition:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), data))
+            self._queue_condition.notify()
+
+    def send_publish(self, topic, payload, qos, retain):
+        header = PUBLISH | (qos << 1) | (0x01 if retain else 0)
+        body = encode_string(topic)
+        if qos:
+            body += struct.pack('!H', next(self._packet_ids))
+        self.send(packet(header, body + payload), self.broker.latency)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self._queue_condition:
+            self._queue_condition.notify()
+
+    def _recv_exact(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError('connection closed')
+            data += chunk
+        return data
+
+    def _read_packet(self):
+        header = self._recv_exact(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._recv_exact(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._recv_exact(length)
+
+    def _read_loop(self):
+        clean = False
+
+        try:
+            while not self.closed:
+                header, body = self._read_packet()
+                if header & 0xf0 == DISCONNECT:
+                    clean = True
+                    break
+                self.handle(header, body)
+
+        except (ConnectionError, OSError):
+            pass
+
+        except:
+            logging.exception('broker session exception ({})'.format(self.client_id))
+
+        self.broker.disconnected(self, clean)
+        self.close()
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._queue_condition:
+                    while not self.closed and (not self._queue or self._queue[0][0] > time.monotonic()):
+                        timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                        self._queue_condition.wait(timeout)
+                    if self.closed:
+                        return
+                    _, _, data = heapq.heappop(self._queue)
+
+                self.sock.sendall(data)
+
+        except OSError:
+            pass
+
+    def handle(self, header, body):
+        kind = header & 0xf0
+        r = _Reader(body)
+
+        if kind == CONNECT:
+            r.string() # protocol name
+            r.u8() # protocol level
+            flags = r.u8()
+            r.u16() # keepalive
+            self.client_id = r.string()
+            if flags & 0x04:
+                will_topic = r.string()
+                will_payload = r.binary()
+                self.will = (will_topic, will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+            self.broker.connected(self)
+            self.send(packet(CONNACK, b'\x00\x00'))
+
+        elif kind == PUBLISH:
+            qos = (header >> 1) & 0x03
+            topic = r.string()
+            if qos:
+                packet_id = r.u16()
+            self.broker.publish(topic, r.rest(), qos, bool(header & 0x01))
+            if qos == 1:
+                self.send(packet(PUBACK, struct.pack('!H', packet_id)))
+            elif qos == 2:
+                self.send(packet(PUBREC, struct.pack('!H', packet_id)))
+
+        elif kind == PUBREL:
+            self.send(packet(PUBCOMP, body[:2]))
+
+        elif kind in (PUBACK, PUBREC, PUBCOMP):
+            if kind == PUBREC:
+                self.send(packet(PUBREL | 0x02, body[:2]))
+
+        elif kind == SUBSCRIBE:
+            packet_id = r.u16()
+            granted = []
+            new = []
+            while r.offset < len(body):
+                topic_filter = r.string()
+                qos = min(r.u8() & 0x03, 1)
+                granted.append(qos)
+                new.append((topic_filter, qos))
+
+            # other sessions iterate the subscriptions under the lock
+            with self.broker._lock:
+                self.subscriptions.update(new)
+                self.broker.subscriptions_changed()
+            self.send(packet(SUBACK, struct.pack('!H', packet_id) + bytes(granted)))
+            self.broker.send_retained(self, new)
+
+        elif kind == UNSUBSCRIBE:
+            packet_id = r.u16()
+            topic_filters = []
+            while r.offset < len(body):
+                topic_filters.append(r.string())
+
+            with self.broker._lock:
+                for topic_filter in topic_filters:
+                    self.subscriptions.pop(topic_filter, None)
+                self.broker.subscriptions_changed()
+            self.send(packet(UNSUBACK, struct.pack('!H', packet_id)))
+
+        elif kind == PINGREQ:
+            self.send(packet(PINGRESP))
+
+        else:
+            logging.warning('broker: unknown packet type {:#x}'.format(kind))
+
+
+class MQTTBroker():
+
+    def __init__(self, host='127.0.0.1', port=1883, latency=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+
+        self.sessions = {}
+        self.retained = {}
+        self.published = 0
+
+        self._lock = threading.RLock()
+        self._router = helpers.TopicRouter()
+        self._listener = None
+
+    def start(self):
+        """
+        Start listening in a background thread. With `port=0` a free port is
+        chosen and stored in `port`.
+        """
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, self.port))
+        self._listener.listen(64)
+        self.port = self._listener.getsockname()[1]
+
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logging.info('broker listening on {}:{}'.format(self.host, self.port))
+
+    def stop(self):
+        self._listener.close()
+        with self._lock:
+            sessions = list(self.sessions.values())
+        for s in sessions:
+            s.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Session(self, sock, address).start()
+
+    def connected(self, session):
+        with self._lock:
+            old = self.sessions.get(session.client_id)
+            self.sessions[session.client_id] = session
+        if old is not None:
+            # client id taken over, drop the old connection without its will
+            old.will = None
+            old.close()
+
+    def disconnected(self, session, clean):
+        with self._lock:
+            if self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+                self.subscriptions_changed()
+
+        if not clean and session.will is not None:
+            topic, payload, qos, retain = session.will
+            self.publish(topic, payload, qos, retain)
+
+    def subscriptions_changed(self):
+        with self._lock:
+            router = helpers.TopicRouter()
+            for session in self.sessions.values():
+                for topic_filter, qos in session.subscriptions.items():
+                    router.add(topic_filter, (session, qos))
+            self._router = router
+
+    def publish(self, topic, payload, qos, retain):
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            router = self._router
+
+        # one copy per client, with the highest matching subscription qos
+        targets = {}
+        for session, sub_qos in router.match(topic):
+            targets[session] = max(targets.get(session, 0), sub_qos)
+
+        for session, sub_qos in targets.items():
+            session.send_publish(topic, payload, min(qos, sub_qos), False)
+
+    def send_retained(self, session, subscriptions):
+        with self._lock:
+            retained = list(self.retained.items())
+
+        for topic, (payload, qos) in retained:
+            matching = [sub_qos for topic_filter, sub_qos in subscriptions if topic_matches_sub(topic_filter, topic)]
+            if matching:
+                session.send_publish(topic, payload, min(qos, max(matching)), True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='MQTT test broker',
+            parents=[helpers.get_default_parser()],
+        )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay every delivered message by this much')
+    args = parser.parse_args()
+    helpers.configure_logging(args.logging_type, args.loglevel, args.logfile)
+
+    broker = MQTTBroker(args.host, args.port, args.latency_ms / 1e3)
+    broker.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
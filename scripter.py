@@ -1,50 +1,168 @@
+import argparse
+import json
 import logging
 import sys
 sys.path.append('/home/autoc4/.pyenv/versions/3.4.0/lib/python3.4/site-packages/')
 from paho.mqtt import client as mqtt_client
+from collections import deque
+import multiprocessing
 from threading import Thread
 import re
 import time
 import socket
 import random
 
+import arbiter
+import dmxfade
+import helpers
+import timeline
+
+# channels held together with the key by manual control
 channel2lock = {
     'dmx/plenar/vorne1': ['dmx/plenar/master'],
     # ...
 }
 
+# merge mode of channels written by several scripts of the same priority,
+# default arbiter.LTP
+channel_merge_modes = {
+    # 'dmx/plenar/vorne1': arbiter.HTP,
+}
+
 from logicer import MQTTLogicer
-channel_whitelist = MQTTLogicer.alle_lichter + MQTTLogicer.dmx_channels # + ['dmx/plenar/master']
+channel_whitelist = frozenset(MQTTLogicer.alle_lichter + MQTTLogicer.dmx_channels) # | {'dmx/plenar/master'}
+
+
+class OutputStage():
+    """
+    Publishes the channel payloads of a script only if they differ from the
+    last published ones, which are kept in `last_values`.
+
+    With a `keyframe_interval` all channels in `last_values` are published
+    again every that many seconds (a keyframe), so receivers which missed a
+    message or started later catch up; between keyframes only the changed
+    channels are sent.
+    """
+
+    def __init__(self, mqtt_client, keyframe_interval=None):
+        self.mqtt_client = mqtt_client
+        self.keyframe_interval = keyframe_interval
+        self.next_keyframe = None
 
+        # channel -> last published payload
+        self.last_values = {}
+
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.suppressed = 0
+        self.suppressed_bytes = 0
+        self.keyframes = 0
+
+    def send(self, channel, payload):
+        if self.last_values.get(channel) == payload:
+            self.suppressed += 1
+            self.suppressed_bytes += len(payload)
+            return
+
+        self.last_values[channel] = payload
+        self._publish(channel, payload)
+
+    def end_frame(self, now):
+        """
+        Called after each frame, publishes a keyframe if one is due.
+        """
+
+        if not self.keyframe_interval:
+            return
+
+        if self.next_keyframe is None:
+            self.next_keyframe = now + self.keyframe_interval
+        elif now >= self.next_keyframe:
+            self.next_keyframe += self.keyframe_interval
+            if self.next_keyframe <= now:
+                self.next_keyframe = now + self.keyframe_interval
+            self.keyframes += 1
+            for channel, payload in self.last_values.items():
+                self._publish(channel, payload)
+
+    def _publish(self, channel, payload):
+        self.sent += 1
+        self.sent_bytes += len(payload)
+        self.mqtt_client.publish(channel, payload)
+
+    def stats(self, elapsed):
+        """
+        Rates since the last `reset`, `elapsed` seconds ago.
+        """
+
+        elapsed = max(elapsed, 1e-9)
+        return {
+                'publishes_per_s': self.sent / elapsed,
+                'bytes_per_s': self.sent_bytes / elapsed,
+                'saved_publishes_per_s': self.suppressed / elapsed,
+                'saved_bytes_per_s': self.suppressed_bytes / elapsed,
+                'keyframes': self.keyframes,
+            }
+
+
+class Script():
+    """
+    `loop` is called once per frame by the `FrameScheduler`, all other
+    callbacks run between frames in the same thread.
+    """
 
-# do loop? then be able to set call frequency
-# or threads with manual sleep's?
-class Script(Thread):
     name = None
 
+    # seconds a `loop` call may take before it counts as an overrun, None for
+    # one frame
+    budget = None
+
+    # seconds between republishing all channels, None to only publish changes
+    keyframe_interval = None
+
+    # scripts with a higher priority win channels written by several scripts
+    priority = 0
+
+    # run in a worker process, see `ProcessScript`
+    isolated = False
+
     #last_values = None
     #unlocked_channels = None
 
-    def __init__(self, mqtt_client, *args, **kwargs):
-        super(Script, self).__init__(*args, **kwargs)
-
+    def __init__(self, mqtt_client, arbiter=None):
         self.mqtt_client = mqtt_client
         self.unlocked_channels = set()
-        self.last_values = {}
-
-    def run(self):
-        self.on_starting()
-        while True:
-            self.loop()
-            time.sleep(0.01)
-
-    def lock_channel(self, channel):
-        if channel in channel2lock:
-            for c in channel2lock[channel]:
-                self.lock_channel(c)
 
-        if channel in self.unlocked_channels:
-            self.unlocked_channels.remove(channel)
+        # without arbiter the channels are published directly
+        self.source = None
+        if arbiter is not None:
+            self.source = arbiter.source(script_name(self), self.priority)
+            self.source.on_hold = self.channel_held
+
+        self.output = OutputStage(self.source or mqtt_client, self.keyframe_interval)
+        # channel -> last published payload
+        self.last_values = self.output.last_values
+
+        # wall clock time of the current frame, set by the FrameScheduler
+        self.frame_time = None
+
+    def channel_held(self, channel, held):
+        """
+        Called by the arbiter when manual control starts holding a channel
+        this script wrote (`held`) and when the hold ends. The payloads of the
+        script are not published while the channel is held.
+        """
+
+        try:
+            if held:
+                self.on_channel_locked(channel)
+            else:
+                self.on_channel_released(channel)
+        except Exception:
+            logging.exception('script exception ({})'.format(script_name(self)))
 
     def unlock_channel(self, channel):
         self.unlocked_channels.add(channel)
@@ -58,7 +176,7 @@ class Script(Thread):
         if channel.startswith('dmx'):
             while len(payload) in (4,7,8):
                 payload += b'\x00'
-        self.mqtt_client.publish(channel, payload)
+        self.output.send(channel, payload)
 
     # overwrite these:
 
@@ -68,46 +186,561 @@ class Script(Thread):
         pass
     def on_channel_locked(self, channel):
         pass
-    # a publish in `script/id`
-    def on_message(self, payload):
+    def on_channel_released(self, channel):
+        pass
+    # a publish in `script/<name>` or `script/<name>/<topic>`
+    def on_message(self, topic, payload):
         pass
     def loop(self):
         pass
 
-def interpolate(v1,v2,t,max_t):
-    if t >= max_t:
-        return v2
-    return t/max_t * v2 + (1.-t/max_t) * v1
-
-class Fader():
-    last_color = (0,0,0)
-    target_color = (0,0,0)
-    last_time = None
-    fade_time = None
-    fading = False
-
-    def start_fading(self, target_color, fade_time):
-        self.last_color = self.get_current_color()
-        self.target_color = target_color
-        self.last_time = time.time()
-        self.fade_time = float(fade_time)
-        self.fading = True
-    def get_current_color(self):
-        if not self.fading:
-            return self.target_color
-        return tuple(map(
-                lambda a,b: int(interpolate(a, b, time.time()-self.last_time, self.fade_time)),
-                self.last_color, self.target_color
-            ))
-    def poll_fading(self):
-        if self.fading:
-            if self.get_current_color() == self.target_color:
-                self.fading = False
-            return self.get_current_color()
-        return None
+
+def script_name(script):
+    return script.name or script.__class__.__name__
+
+
+class ScriptStats():
+    """
+    Time a script spent in `loop` since the last report of the
+    `FrameScheduler`.
+    """
+
+    __slots__ = ('calls', 'time_sum', 'time_max', 'cpu_sum', 'overruns')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.cpu_sum = 0
+        self.overruns = 0
+
+    def stats(self):
+        return {
+                'calls': self.calls,
+                'mean_ms': self.time_sum / self.calls * 1e3 if self.calls else 0,
+                'max_ms': self.time_max * 1e3,
+                'cpu_ms': self.cpu_sum * 1e3,
+                'overruns': self.overruns,
+            }
+
+
+class FrameScheduler(Thread):
+    """
+    Calls `loop` of all scripts from one thread, once per frame at `fps`.
+
+    Frames are scheduled from the previous deadline, not from when the last
+    one finished, so they do not drift; if a frame took too long the missed
+    frames are skipped and counted. A `loop` call taking longer than the
+    script's `budget` counts as an overrun. Calls from other threads (like
+    received messages) are queued with `post` and run before the next frame,
+    so scripts never run concurrently.
+
+    Every `stats_interval` seconds the statistics are logged and passed to
+    `on_stats`, and reset.
+    """
+
+    fps = 100
+    stats_interval = 60
+
+    def __init__(self, fps=None, arbiter=None, on_stats=None, clock=time.monotonic, *args, **kwargs):
+        super(FrameScheduler, self).__init__(*args, daemon=True, **kwargs)
+
+        if fps is not None:
+            self.fps = fps
+        self.interval = 1 / self.fps
+        self.arbiter = arbiter
+        self.on_stats = on_stats
+        self.clock = clock
+
+        self.scripts = []
+        self.script_stats = {}
+        self._pending = deque()
+
+        self.frames = 0
+        self.skipped = 0
+        self.jitter_sum = 0
+        self.jitter_max = 0
+        self.stats_start = self.clock()
+
+    def add(self, script):
+        self.post(self._start_script, script)
+
+    def post(self, func, *args):
+        """
+        Call `func(*args)` from the scheduler thread before the next frame.
+        """
+
+        self._pending.append((func, args))
+
+    def _start_script(self, script):
+        script.on_starting()
+        self.scripts.append(script)
+        self.script_stats[script] = ScriptStats()
+
+    def _stop_script(self, script):
+        self.scripts.remove(script)
+        del self.script_stats[script]
+        if script.source is not None:
+            script.source.arbiter.remove(script.source)
+        try:
+            script.on_stopping()
+        except Exception:
+            logging.exception('script exception ({})'.format(script_name(script)))
+
+    def run(self):
+
+        try:
+            self.main_loop()
+
+        except:
+            logging.exception('FrameScheduler exception, exiting.')
+
+    def main_loop(self):
+
+        deadline = self.clock()
+        next_stats = deadline + self.stats_interval
+
+        while True:
+            delay = deadline - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+
+            jitter = self.clock() - deadline
+            self.frames += 1
+            self.jitter_sum += jitter
+            if jitter > self.jitter_max:
+                self.jitter_max = jitter
+
+            self.run_frame(time.time())
+
+            deadline += self.interval
+            now = self.clock()
+            if deadline <= now:
+                missed = int((now - deadline) // self.interval) + 1
+                self.skipped += missed
+                deadline += missed * self.interval
+
+            if now >= next_stats:
+                self.report()
+                next_stats += self.stats_interval
+
+    def run_frame(self, frame_time):
+        while self._pending:
+            func, args = self._pending.popleft()
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('script exception ({})'.format(getattr(func, '__qualname__', func)))
+
+        for script in list(self.scripts):
+            stats = self.script_stats[script]
+            script.frame_time = frame_time
+
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                script.loop()
+            except Exception:
+                logging.exception('script exception ({}), stopping it'.format(script_name(script)))
+                self._stop_script(script)
+                continue
+            duration = time.perf_counter() - start
+
+            stats.calls += 1
+            stats.time_sum += duration
+            stats.cpu_sum += time.thread_time() - cpu_start
+            if duration > stats.time_max:
+                stats.time_max = duration
+            if duration > (script.budget or self.interval):
+                stats.overruns += 1
+
+            script.output.end_frame(frame_time)
+
+        # publishes what the scripts wrote
+        if self.arbiter is not None:
+            self.arbiter.flush(frame_time)
+
+    def stats(self):
+        elapsed = self.clock() - self.stats_start
+        scripts = {}
+        for script, stats in self.script_stats.items():
+            scripts[script_name(script)] = stats.stats()
+            scripts[script_name(script)]['output'] = script.output.stats(elapsed)
+            worker_stats = getattr(script, 'worker_stats', None)
+            if worker_stats is not None:
+                scripts[script_name(script)]['worker'] = worker_stats()
+
+        stats = {
+                'fps': self.fps,
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'jitter_mean_ms': self.jitter_sum / self.frames * 1e3 if self.frames else 0,
+                'jitter_max_ms': self.jitter_max * 1e3,
+                'scripts': scripts,
+            }
+        if self.arbiter is not None:
+            stats['arbiter'] = self.arbiter.stats()
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        logging.debug('frame stats: {}'.format(stats))
+
+        for script, script_stats in self.script_stats.items():
+            if script_stats.overruns:
+                logging.warning('{} overran its budget in {} of {} frames (max {:.1f} ms)'.format(
+                        script_name(script), script_stats.overruns, script_stats.calls, script_stats.time_max * 1e3))
+            script_stats.reset()
+            script.output.reset()
+
+        self.stats_start = self.clock()
+        self.frames = 0
+        self.skipped = 0
+        self.jitter_sum = 0
+        self.jitter_max = 0
+
+        if self.on_stats is not None:
+            self.on_stats(stats)
+
+
+class _Collector():
+    """
+    Stand-in for the mqtt client of a script in a worker process, collects
+    the publishes to send them to the `ProcessScript`.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        self.messages.append((topic, payload))
+
+    def take(self):
+        messages, self.messages = self.messages, []
+        return messages
+
+
+def _detached_script(cls, args, kwargs):
+    """
+    A script whose publishes are collected instead of sent: returns the
+    script, the collector of its mqtt client and the collector of its
+    changed channel payloads (without keyframes).
+    """
+
+    client = _Collector()
+    writes = _Collector()
+    script = cls(client, *args, **kwargs)
+    script.output = OutputStage(writes)
+    script.last_values = script.output.last_values
+    return script, client, writes
+
+
+def _worker_main(conn, cls, args, kwargs, loglevel):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', level=loglevel)
+
+    # channel writes go to the parent unless unchanged, keyframes are sent
+    # by the parent's output stage
+    script, client, writes = _detached_script(cls, args, kwargs)
+    script.on_starting()
+
+    unlocked = None
+    try:
+        while True:
+            message = conn.recv()
+            kind = message[0]
+
+            if kind == 'frame':
+                script.frame_time = message[1]
+                start = time.perf_counter()
+                script.loop()
+                duration = time.perf_counter() - start
+
+                # the unlocked channels only when they changed
+                if script.unlocked_channels != unlocked:
+                    unlocked = set(script.unlocked_channels)
+                    changed_unlocked = unlocked
+                else:
+                    changed_unlocked = None
+                conn.send(('frame', writes.take(), client.take(), changed_unlocked, duration))
+
+            elif kind == 'message':
+                script.on_message(*message[1:])
+            elif kind == 'hold':
+                script.channel_held(*message[1:])
+            elif kind == 'stop':
+                script.on_stopping()
+                return
+
+    except EOFError:
+        # the parent is gone
+        return
+    except Exception:
+        logging.exception('script exception ({}), exiting worker'.format(script_name(script)))
+        sys.exit(1)
+
+
+class ProcessScript(Script):
+    """
+    Runs a script in a worker process, so heavy computations do not hold up
+    the other scripts and the MQTT thread.
+
+    Every frame the worker is told to run the script's `loop` once; the
+    channel writes come back over a pipe and are published from this
+    process with the next frame, so they are one frame late. While the
+    worker has not answered the previous frame no new frame is sent (the
+    frame counts as late). A crashed worker is restarted after
+    `restart_delay` seconds, doubling up to `max_restart_delay` while it keeps
+    crashing.
+    """
+
+    restart_delay = 1
+    max_restart_delay = 60
+
+    # a worker running this long without crashing resets the restart delay
+    stable_time = 60
+
+    def __init__(self, mqtt_client, cls, args=(), kwargs=None, arbiter=None):
+        self.name = script_name(cls)
+        self.priority = cls.priority
+        self.budget = cls.budget
+        self.keyframe_interval = cls.keyframe_interval
+        super(ProcessScript, self).__init__(mqtt_client, arbiter=arbiter)
+
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs or {}
+
+        self.process = None
+        self.conn = None
+        self.busy = False
+        self.started = None
+        self.next_start = 0
+        self.delay = self.restart_delay
+
+        self.restarts = 0
+        self.late_frames = 0
+        self.worker_time_max = 0
+
+    def start_worker(self):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+                target=_worker_main,
+                args=(child_conn, self.cls, self.args, self.kwargs, logging.getLogger().getEffectiveLevel()),
+                name='script ' + self.name,
+                daemon=True,
+            )
+        self.process.start()
+        child_conn.close()
+        self.busy = False
+        self.started = time.monotonic()
+
+    def worker_failed(self):
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+        if time.monotonic() - self.started >= self.stable_time:
+            self.delay = self.restart_delay
+        logging.warning('worker of {} failed (exit code {}), restarting in {}s'.format(
+                self.name, self.process.exitcode, self.delay))
+        self.process = None
+
+        self.next_start = time.monotonic() + self.delay
+        self.delay = min(self.delay * 2, self.max_restart_delay)
+
+    def send(self, message):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, EOFError, OSError):
+            self.worker_failed()
+
+    def on_starting(self):
+        self.start_worker()
+
+    def on_stopping(self):
+        self.send(('stop',))
+        if self.process is None:
+            return
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def on_message(self, topic, payload):
+        self.send(('message', topic, payload))
+
+    def channel_held(self, channel, held):
+        self.send(('hold', channel, held))
+
+    def loop(self):
+        if self.process is None:
+            if time.monotonic() < self.next_start:
+                return
+            self.restarts += 1
+            self.start_worker()
+
+        try:
+            while self.conn.poll():
+                self.handle_result(self.conn.recv())
+        except (EOFError, OSError):
+            self.worker_failed()
+            return
+
+        if not self.process.is_alive():
+            self.worker_failed()
+            return
+
+        if self.busy:
+            self.late_frames += 1
+            return
+
+        self.busy = True
+        self.send(('frame', self.frame_time))
+
+    def handle_result(self, result):
+        _, writes, messages, unlocked, duration = result
+        self.busy = False
+
+        if unlocked is not None:
+            self.unlocked_channels = unlocked
+        for channel, payload in writes:
+            self.publish(channel, payload)
+        for topic, payload in messages:
+            self.mqtt_client.publish(topic, payload)
+        if duration > self.worker_time_max:
+            self.worker_time_max = duration
+
+    def worker_stats(self):
+        stats = {
+                'restarts': self.restarts,
+                'late_frames': self.late_frames,
+                'loop_max_ms': self.worker_time_max * 1e3,
+            }
+        self.late_frames = 0
+        self.worker_time_max = 0
+        return stats
+
+
+def render_timeline(cls, path, seconds, fps=None, keyframe_interval=None, args=(), kwargs=None):
+    """
+    Run a script for `seconds` as fast as possible and write its channel
+    output to the timeline file `path`, see `timeline.py`. Returns the
+    `timeline.TimelineWriter`.
+    """
+
+    fps = fps or FrameScheduler.fps
+    script, _, writes = _detached_script(cls, args, kwargs or {})
+    writer = timeline.TimelineWriter(path, fps, keyframe_interval)
+
+    start = time.time()
+    script.frame_time = start
+    script.on_starting()
+
+    for i in range(int(seconds * fps)):
+        script.frame_time = start + i / fps
+        script.loop()
+        writer.add_frame(writes.take())
+
+    script.on_stopping()
+    writer.close()
+    return writer
+
+
+class TimelinePlayer(Script):
+    """
+    Plays a timeline file rendered by `render_timeline`, repeating it unless
+    `repeat` is False. The frame is chosen from the frame time, so playback
+    keeps its speed if the scheduler runs at another rate.
+
+    A message to `script/timeline/seek` with a position in seconds jumps
+    there.
+    """
+
+    name = 'timeline'
+
+    def __init__(self, mqtt_client, path, repeat=True, arbiter=None):
+        super(TimelinePlayer, self).__init__(mqtt_client, arbiter=arbiter)
+
+        self.path = path
+        self.repeat = repeat
+        self.timeline = None
+
+        self.start_time = None
+        self.seek_to = None
+
+        # number and file offset of the frame in `state`
+        self.frame = None
+        self.offset = None
+        self.state = None
+
+    def on_starting(self):
+        self.timeline = timeline.Timeline(self.path)
+        self.state = self.timeline.new_state()
+        for channel, length in zip(self.timeline.channels, self.timeline.lengths):
+            if length:
+                self.unlock_channel(channel)
+
+        logging.info('playing {} ({:.0f}s, {} channels)'.format(
+                self.path, self.timeline.duration, len(self.timeline.channels)))
+
+    def on_stopping(self):
+        self.timeline.close()
+
+    def on_message(self, topic, payload):
+        if topic == 'seek':
+            try:
+                self.seek(float(payload))
+            except ValueError:
+                logging.warning('invalid seek position: {}'.format(payload))
+
+    def seek(self, seconds):
+        self.seek_to = seconds
+
+    def loop(self):
+        tl = self.timeline
+        if not tl.frames:
+            return
+
+        if self.seek_to is not None:
+            self.start_time = self.frame_time - self.seek_to
+            self.seek_to = None
+        elif self.start_time is None:
+            self.start_time = self.frame_time
+
+        # rounded, so frame time jitter does not repeat or skip frames when
+        # playing at the rate it was rendered at
+        index = round((self.frame_time - self.start_time) * tl.fps)
+        if index >= tl.frames:
+            index = index % tl.frames if self.repeat else tl.frames - 1
+        index = max(index, 0)
+        if index == self.frame:
+            return
+
+        changed = set()
+
+        # backwards (repeat, seek) or far ahead: from the previous keyframe
+        if self.frame is None or index < self.frame or index - self.frame > tl.keyframe_interval:
+            keyframe, self.offset = tl.keyframe_before(index)
+            self.frame = keyframe - 1
+
+        while self.frame < index:
+            self.offset = tl.read_frame(self.offset, self.state, changed)
+            self.frame += 1
+
+        for i in changed:
+            if tl.lengths[i]:
+                self.publish(tl.channels[i], tl.payload(self.state, i))
+
 
 class Test(Script):
-    faders = None
+    fades = None
 
     colors = (
         (255,255,255),
@@ -122,10 +755,13 @@ class Test(Script):
 
     color_time = None
 
+    # after the color bytes
+    payload_suffix = b'\x00\x00\x00\xff'
+
     def __init__(self, *args, **kwargs):
         super(Test, self).__init__(*args, **kwargs)
 
-        self.faders = [Fader() for i in range(3)]
+        self.fades = dmxfade.FadeEngine([c for channels in self.channel_groups for c in channels])
 
     def on_starting(self):
         self.unlock_channel('dmx/wohnzimmer/mitte1')
@@ -138,22 +774,22 @@ class Test(Script):
         self.unlock_channel('dmx/plenar/hinten2')
         self.unlock_channel('dmx/plenar/hinten3')
         self.unlock_channel('dmx/plenar/hinten4')
-        self.new_color()
-    def broadcast_color(self, color, channels):
-        for channel in channels:
-            self.publish(channel, bytes(color)+b'\x00\x00\x00\xff')
-    def new_color(self):
-        self.color_time = time.time()
-        for fader in self.faders:
+        now = time.time()
+        for channels in self.channel_groups:
+            self.fades.fade(channels, bytes(3) + self.payload_suffix, 0, now)
+        for channel, payload in self.fades.step(now):
+            self.publish(channel, payload)
+        self.new_color(now)
+    def new_color(self, now):
+        self.color_time = now
+        for channels in self.channel_groups:
             i = random.randint(0,len(self.colors)-1)
-            fader.start_fading(self.colors[i], 5)
+            self.fades.fade(channels, bytes(self.colors[i]) + self.payload_suffix, 5, self.color_time)
     def loop(self):
-        if time.time() - self.color_time > 60:
-            self.new_color()
-        for fader,channels in zip(self.faders, (self.channel_groups)):
-            color = fader.poll_fading()
-            if color:
-                self.broadcast_color(color, channels)
+        if self.frame_time - self.color_time > 60:
+            self.new_color(self.frame_time)
+        for channel, payload in self.fades.step(self.frame_time):
+            self.publish(channel, payload)
 
 
 class MQTT_thread(Thread):
@@ -162,9 +798,24 @@ class MQTT_thread(Thread):
     """
 
     def __init__(self, clientId=None, keepalive=None, willQos=0,
-                 willTopic=None, willMessage=None, willRetain=False, *args, **kwargs):
+                 willTopic=None, willMessage=None, willRetain=False,
+                 mqtt_host='127.0.0.1', mqtt_port=1883, fps=None, frames=False, processes=False, *args, **kwargs):
         super(MQTT_thread, self).__init__(*args, **kwargs)
 
+        # decides which script (or manual control) sets a channel
+        # with `frames` rooms are sent as `dmx/<room>/frame`
+        self.arbiter = arbiter.ChannelArbiter(
+                self.publish_channel, channel_whitelist, channel2lock, channel_merge_modes,
+                publish_frame=self.publish_frame if frames else None,
+                rooms={room: channels for room, channels in MQTTLogicer.room_dmx_channels.items() if channels},
+            )
+
+        # runs the scripts
+        self.frames = FrameScheduler(fps, self.arbiter, on_stats=self.publish_stats)
+
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+
         if clientId is not None:
             self.clientId = clientId
         else:
@@ -180,27 +831,42 @@ class MQTT_thread(Thread):
         self.willMessage = willMessage
         self.willRetain = willRetain
 
+        # run all scripts in worker processes
+        self.processes = processes
+
         self.scripts = []
 
     def start_script(self, cls, *args, **kwargs):
-        s = cls(self.mqtt_client, *args, **kwargs)
-        s.start()
+        if self.processes or cls.isolated:
+            s = ProcessScript(self.mqtt_client, cls, args, kwargs, arbiter=self.arbiter)
+        else:
+            s = cls(self.mqtt_client, *args, arbiter=self.arbiter, **kwargs)
+        self.frames.add(s)
         self.scripts.append(s)
 
+    def publish_channel(self, channel, payload):
+        self.mqtt_client.publish(channel, payload)
+
+    def publish_frame(self, room, frame):
+        self.mqtt_client.publish('dmx/' + room + '/frame', frame)
+
+    def publish_stats(self, stats):
+        self.mqtt_client.publish('stats/' + self.clientId, json.dumps(stats))
+
     def run(self):
         self.mqtt_client = mqtt_client.Client(self.clientId)
-        self.mqtt_client.on_message = self.publishReceived
+        self.mqtt_client.on_message = self.on_message
         self.mqtt_client.on_connect = self.on_connect
         #self.mqtt_client.on_publish = on_publish
         #self.mqtt_client.on_subscribe = self.on_subscribe
         # Uncomment to enable debug messages
         #self.mqtt_client.on_log = on_log
         logging.info('connecting')
-        self.mqtt_client.connect('127.0.0.1', 1883, self.keepalive)
+        self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, self.keepalive)
         self.mqtt_client.loop_forever()
         logging.info('leaving program loop')
 
-    def on_connect(self, mosq, obj, rc):
+    def on_connect(self, client, userdata, flags, rc):
         if rc != 0:
             logging.info('could not connect, bad return code')
         else:
@@ -216,12 +882,13 @@ class MQTT_thread(Thread):
         if match:
             for s in self.scripts:
                 if s.name == match.group(1):
-                    s.on_message(topic, msg.payload)
+                    self.frames.post(s.on_message, match.group(2), msg.payload)
             return
 
-        if msg.topic in MQTTLogicer.dmx_channels and len(msg.payload) in (4,7,8):
-            for s in self.scripts:
-                s.lock_channel(msg.topic)
+        # payloads of the scripts are padded to other lengths, see
+        # `Script.publish`; these come from manual control
+        if msg.topic in channel_whitelist and msg.topic.startswith('dmx/') and len(msg.payload) in (4,7,8):
+            self.frames.post(self.arbiter.manual, msg.topic, time.time())
 
 
 def set_log_level(loglevel):
@@ -236,17 +903,31 @@ def set_log_level(loglevel):
     #logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', level=numeric_level)
 
 def main():
+    parser = argparse.ArgumentParser(description='MQTT scripter')
+    parser.add_argument('--fps', type=float, default=FrameScheduler.fps, help='Frames per second the scripts are run at')
+    parser.add_argument('--frames', action='store_true', help='Send rooms as dmx/<room>/frame, fanned out by the logicer')
+    parser.add_argument('--processes', action='store_true', help='Run every script in its own worker process')
+    parser.add_argument('--timeline', help='Play this timeline file (see timeline-render.py) instead of the test script')
+    parser.add_argument('--mqtt-host', help='MQTT broker host (default: 127.0.0.1)')
+    parser.add_argument('--mqtt-port', type=int, help='MQTT broker port (default: 1883)')
+    args = parser.parse_args()
+
     set_log_level('DEBUG')
     logging.info('starting')
 
     logging.info('starting mqtt thread')
-    mqtt_thread = MQTT_thread()
+    mqtt_thread = MQTT_thread(fps=args.fps, frames=args.frames, processes=args.processes,
+                              **helpers.get_connection_kwargs(args))
     mqtt_thread.start()
+    mqtt_thread.frames.start()
 
     # wait for mqtt thread to start, connect, ...
     time.sleep(1)
 
-    mqtt_thread.start_script(Test)
+    if args.timeline:
+        mqtt_thread.start_script(TimelinePlayer, args.timeline)
+    else:
+        mqtt_thread.start_script(Test)
 
     mqtt_thread.join()
     logging.info('mqtt thread joined')
@@ -10,7 +10,6 @@ from datetime import datetime
 import json
 import re
 import threading
-import time
 import urllib.request
 
 import config
@@ -35,10 +34,11 @@ class IssParser():
 
     url = 'http://www.heavens-above.com/PassSummary.aspx?satid=25544&lat=50.9502&lng=6.9131&loc=6A&alt=51&tz=CET'
     base_url = 'http://www.heavens-above.com/'
+    timeout = 30
 
     @staticmethod
     def get_iss_data():
-        response = urllib.request.urlopen(IssParser.url)
+        response = urllib.request.urlopen(IssParser.url, timeout=IssParser.timeout)
         bs = BeautifulSoup(response, 'html.parser')
 
         if bs.text.find('No visible passes found within the search period') >= 0:
@@ -114,10 +114,11 @@ class IridiumParser():
 
     url = 'http://www.heavens-above.com/IridiumFlares.aspx?lat=50.9502&lng=6.9131&loc=6A&alt=51&tz=CET'
     base_url = 'http://www.heavens-above.com/'
+    timeout = 30
 
     @staticmethod
     def get_iridium_data():
-        response = urllib.request.urlopen(IridiumParser.url)
+        response = urllib.request.urlopen(IridiumParser.url, timeout=IridiumParser.timeout)
         bs = BeautifulSoup(response, 'html.parser')
         #data = response.read().decode()
 
@@ -176,44 +177,73 @@ class IridiumParser():
         return dt
 
 
-class MQTT_Skynet_Thread(threading.Thread):
+class MQTT_Skynet_Poller():
     """
-    Publishes the current time in regular intervals.
+    Publishes the upcoming satellite passes in regular intervals, started by
+    the scheduler. The data is fetched in a thread of its own, so a slow
+    webserver does not hold up the other jobs of the scheduler.
     """
 
     interval = 60 * 60 * 3
+    retry_delay = 60
     topic = 'skynet'
 
-    def __init__(self, mqtt_thread, *args, **kwargs):
-        super(MQTT_Skynet_Thread, self).__init__(*args, daemon=True, **kwargs)
+    def __init__(self, mqtt_thread, scheduler):
         self.mqtt_thread = mqtt_thread
+        self.scheduler = scheduler
 
-    def run(self):
+        self.job = None
+        self.retry_job = None
+        self.fetching = threading.Lock()
 
-        try:
-            self.main_loop()
+    def schedule(self):
+        self.job = self.scheduler.every(self.interval, self.poll, delay=0, name='skynet')
+        return self.job
+
+    def poll(self):
+
+        if self.retry_job is not None:
+            self.retry_job.cancel()
+            self.retry_job = None
+
+        if not self.mqtt_thread.connection_established:
+            self.retry(1)
+            return
 
-        except:
-            logging.exception('Skynet thread exception, exiting.')
+        if not self.fetching.acquire(blocking=False):
+            logging.info('still fetching data, skipping poll')
+            return
 
-    def main_loop(self):
+        threading.Thread(target=self.fetch, name='skynet fetch', daemon=True).start()
+
+    def fetch(self):
+
+        try:
+            self.poll_data()
 
-        while not self.mqtt_thread.connection_established:
-            time.sleep(0.1)
+        except OSError as e: # URLError, timeouts
+            logging.info('error fetching data: {}'.format(e.__class__.__name__))
+            self.retry(self.retry_delay)
 
-        logging.info('skynet thread started')
+        except Exception:
+            logging.exception('error fetching data')
 
-        while True:
+        finally:
+            self.fetching.release()
 
-            try:
-                self.poll_data()
+    def retry(self, delay):
+        now = self.scheduler.clock()
 
-            except (urllib.error.URLError, TimeoutError) as e:
-                logging.info('error fetching data: {}'.format(e.__class__.__name__))
-                time.sleep(60)
-                continue
+        # the periodic poll comes first anyway
+        if self.job is not None:
+            next_poll = self.job.deadline
+            if next_poll <= now:
+                # called from the periodic poll, not rescheduled yet
+                next_poll += self.job.interval
+            if next_poll - now <= delay:
+                return
 
-            time.sleep(self.interval)
+        self.retry_job = self.scheduler.after(delay, self.poll, name='skynet retry')
 
     def poll_data(self):
 
@@ -232,6 +262,15 @@ def to_str(i):
         return 'Ir{satellite_num}  {brightness_float: 1.1f}  {altitude_deg:2}°  {azimuth_deg:3}°  {ptime}'.format(**i)
 
 
+def create_daemon(args):
+    mqtt_thread = helpers.MQTT_Client('skynet', keepalive=60, heartbeat=True, daemon=True, **helpers.get_client_kwargs(args))
+
+    scheduler = helpers.get_scheduler()
+    MQTT_Skynet_Poller(mqtt_thread, scheduler).schedule()
+
+    return helpers.Daemon(mqtt_thread, [scheduler], None)
+
+
 def main():
     parser = argparse.ArgumentParser(
             description='MQTT Skynet Poller',
@@ -242,19 +281,7 @@ def main():
 
     logging.info('starting')
 
-    mqtt_thread = helpers.MQTT_Client('skynet', keepalive=60, heartbeat=True, daemon=True)
-    mqtt_thread.start()
-
-    skynet_thread = MQTT_Skynet_Thread(mqtt_thread)
-    skynet_thread.start()
-
-    while mqtt_thread.is_alive() and skynet_thread.is_alive():
-        time.sleep(1)
-
-    logging.info('exiting')
-    sys.stdout.flush()
-    sys.stderr.flush()
-    sys.exit(1)
+    helpers.run_daemon(create_daemon(args))
 
 if __name__ == "__main__":
     main()
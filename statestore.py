@@ -0,0 +1,279 @@
+"""
+The last known state of MQTT topics: in-memory store and on-disk snapshot.
+"""
+
+import collections
+import logging
+import os
+import struct
+import sys
+import threading
+
+import helpers
+
+
+class StateSnapshot():
+    """
+    On-disk snapshot of topic states, stored as an append-only log.
+
+    Every record holds one (topic, payload, time) entry, later records for a
+    topic replace earlier ones. Appending only writes the changed topics; the
+    log is rewritten (compacted) when it holds much more records than there
+    are topics. A record torn by a crash is dropped when loading, callers
+    should compact after loading so it is not followed by new records.
+    """
+
+    magic = b'AC4STATE\x01'
+    record = struct.Struct('<dHI') # time, topic length, payload length
+
+    # compact when the log holds this many times more records than topics
+    compact_ratio = 4
+    compact_min_records = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._records = 0
+        self._topics = 0
+
+    def load(self):
+        """
+        Read the snapshot, returns a dict of topic -> (payload, time).
+        """
+
+        state = {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return state
+
+        if not data.startswith(self.magic):
+            logging.warning('state snapshot {} has an unknown format, ignoring'.format(self.path))
+            return state
+
+        offset = len(self.magic)
+        records = 0
+
+        while offset + self.record.size <= len(data):
+            t, topic_len, payload_len = self.record.unpack_from(data, offset)
+            end = offset + self.record.size + topic_len + payload_len
+            if end > len(data):
+                break
+
+            start = offset + self.record.size
+            topic = data[start:start + topic_len].decode('utf-8')
+            state[topic] = (data[start + topic_len:end], t)
+
+            offset = end
+            records += 1
+
+        if offset != len(data):
+            logging.warning('state snapshot {} ends with an incomplete record, dropping it'.format(self.path))
+
+        self._records = records
+        self._topics = len(state)
+
+        return state
+
+    def append(self, entries, state_size):
+        """
+        Append `(topic, payload, time)` entries. `state_size` is the number of
+        topics in the full state, see `needs_compaction`.
+        """
+
+        if self._file is None:
+            self._open()
+
+        for topic, payload, t in entries:
+            topic = topic.encode('utf-8')
+            self._file.write(self.record.pack(t, len(topic), len(payload)) + topic + payload)
+            self._records += 1
+
+        self._file.flush()
+        self._topics = state_size
+
+    def needs_compaction(self):
+        return (
+                self._records > self.compact_min_records
+                and self._records > self.compact_ratio * self._topics
+            )
+
+    def compact(self, entries):
+        """
+        Rewrite the log to hold only the given `(topic, payload, time)` entries.
+        """
+
+        self.close()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.magic)
+            records = 0
+            for topic, payload, t in entries:
+                topic = topic.encode('utf-8')
+                f.write(self.record.pack(t, len(topic), len(payload)) + topic + payload)
+                records += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.path)
+
+        self._records = records
+        self._topics = records
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            self.compact(())
+
+        self._file = open(self.path, 'ab')
+
+
+class StateEntry():
+    """
+    Last known value of a topic. Updated in place by `StateStore.set`.
+    """
+
+    __slots__ = ('value', 'time', 'volatile')
+
+    def __init__(self, value, time, volatile=None):
+        self.value = value
+        self.time = time
+        self.volatile = volatile
+
+    def __repr__(self):
+        return 'StateEntry(value={!r}, time={!r})'.format(self.value, self.time)
+
+
+class _VolatileClass():
+    """
+    Topics matching `topic_filter`, kept in least recently updated order.
+    """
+
+    def __init__(self, topic_filter, max_entries, max_age):
+        self.topic_filter = topic_filter
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.topics = collections.OrderedDict()
+
+
+class StateStore():
+    """
+    The last value and time per topic, with O(1) get and set.
+
+    Topic strings are interned and entries are `__slots__` records updated in
+    place, so repeated messages on a topic do not allocate. Topics matching a
+    volatile topic class (e.g. `heartbeat/+`, or the broad subscriptions junk
+    topics end up in) are evicted when the class holds more than
+    `max_entries` topics, or by `expire` when not updated for `max_age`
+    seconds. Supports the read-only part of the dict interface.
+
+    Updating a known non-volatile topic takes no lock; adding topics and
+    volatile bookkeeping are locked, as `expire` may run in another thread.
+    """
+
+    def __init__(self, volatile_classes=()):
+        self._entries = {}
+        self._classes = []
+        self._router = helpers.TopicRouter()
+        self._lock = threading.Lock()
+
+        for topic_filter, max_entries, max_age in volatile_classes:
+            cls = _VolatileClass(topic_filter, max_entries, max_age)
+            self._classes.append(cls)
+            self._router.add(topic_filter, cls)
+
+        self.evicted = 0
+
+    def __contains__(self, topic):
+        return topic in self._entries
+
+    def __getitem__(self, topic):
+        return self._entries[topic]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, topic, default=None):
+        return self._entries.get(topic, default)
+
+    def keys(self):
+        return list(self._entries)
+
+    def items(self):
+        return list(self._entries.items())
+
+    def set(self, topic, value, t):
+        entry = self._entries.get(topic)
+
+        if entry is not None:
+            entry.value = value
+            entry.time = t
+            if entry.volatile is None:
+                return
+
+            with self._lock:
+                if topic in entry.volatile.topics:
+                    entry.volatile.topics.move_to_end(topic)
+                    return
+
+        topic = sys.intern(topic)
+        classes = self._router.match(topic)
+        volatile = classes[0] if classes else None
+
+        with self._lock:
+            self._entries[topic] = StateEntry(value, t, volatile)
+
+            if volatile is not None:
+                volatile.topics[topic] = None
+                while len(volatile.topics) > volatile.max_entries:
+                    self._evict(volatile)
+
+    def expire(self, now):
+        """
+        Evict volatile topics not updated within their class' `max_age`.
+        """
+
+        with self._lock:
+            for cls in self._classes:
+                if cls.max_age is None:
+                    continue
+                while cls.topics:
+                    oldest = next(iter(cls.topics))
+                    if now - self._entries[oldest].time <= cls.max_age:
+                        break
+                    self._evict(cls)
+
+    def _evict(self, cls):
+        topic, _ = cls.topics.popitem(last=False)
+        del self._entries[topic]
+        self.evicted += 1
+
+    def memory_usage(self):
+        """
+        Approximate memory used by the store, in bytes.
+        """
+
+        size = sys.getsizeof(self._entries)
+        for topic, entry in list(self._entries.items()):
+            size += sys.getsizeof(topic) + sys.getsizeof(entry) + sys.getsizeof(entry.value)
+        for cls in self._classes:
+            size += sys.getsizeof(cls.topics)
+        return size
+
+    def stats(self):
+        return {
+                'topics': len(self._entries),
+                'volatile': {cls.topic_filter: len(cls.topics) for cls in self._classes},
+                'evicted': self.evicted,
+                'bytes': self.memory_usage(),
+            }
@@ -0,0 +1,154 @@
+"""
+Tests of `logicer.MQTTLogicer` with a fake connection, which records the
+published messages instead of sending them.
+
+Usage:
+    python -m pytest test_logicer.py
+"""
+
+import itertools
+import json
+import unittest
+
+from paho.mqtt import client as mqtt_client
+
+import logicer
+
+
+class FakeMessage():
+
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+
+class FakeInfo():
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = mqtt_client.MQTT_ERR_SUCCESS
+
+
+class FakeClient():
+
+    def __init__(self):
+        self.published = []
+        self.mids = itertools.count(1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return FakeInfo(next(self.mids))
+
+
+class FakeClock():
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeScheduler():
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs = []
+
+    def at(self, deadline, fn, name=None):
+        self.jobs.append((deadline, fn))
+
+    def run_due(self):
+        due = [fn for deadline, fn in self.jobs if deadline <= self.clock()]
+        self.jobs = [(deadline, fn) for deadline, fn in self.jobs if deadline > self.clock()]
+        for fn in due:
+            fn()
+
+
+class LogicerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logicer = logicer.MQTTLogicer()
+        self.logicer.mqtt_client = self.client = FakeClient()
+        self.logicer.connection_established = True
+        self.logicer.clock = self.clock = FakeClock()
+        self.logicer.scheduler = self.scheduler = FakeScheduler(self.clock)
+
+    def send(self, topic, payload, retain=False):
+        self.logicer.on_message(None, None, FakeMessage(topic, payload, retain))
+
+    def published(self, prefix):
+        return [(t, p) for t, p in self.client.published if t.startswith(prefix)]
+
+    def start_fade(self):
+        self.send('dmx/plenar/fade', json.dumps({'to': 'ff' * 8, 'time': 10}).encode())
+        self.clock.now += 1
+        self.logicer.step_fades()
+        self.assertTrue(self.published('dmx/plenar/vorne1'))
+        self.client.published.clear()
+
+    def test_shutdown_ends_fades(self):
+        self.start_fade()
+
+        self.send('club/shutdown', b'\x44')
+        self.assertIn(('dmx/plenar/vorne1', b'\x00' * 8), self.client.published)
+        self.client.published.clear()
+
+        self.clock.now += 1
+        self.logicer.step_fades()
+        self.assertEqual(self.published('dmx/'), [])
+
+    def test_preset_ends_fades(self):
+        self.start_fade()
+
+        self.send('preset/plenar/off', b'\x01')
+        self.assertIn(('dmx/plenar/vorne1', b'\x00' * 8), self.client.published)
+        self.client.published.clear()
+
+        self.clock.now += 1
+        self.logicer.step_fades()
+        self.assertEqual(self.published('dmx/'), [])
+
+    def coalesce_master(self):
+        # the second value waits for the next frame
+        self.send('dmx/plenar/master', b'\x11' * 8)
+        self.send('dmx/plenar/master', b'\x22' * 8)
+        self.assertIn('dmx/plenar/master', self.logicer.dmx_master_pending)
+        self.client.published.clear()
+
+    def test_shutdown_drops_coalesced_master(self):
+        self.coalesce_master()
+
+        self.send('club/shutdown', b'\x44')
+        self.client.published.clear()
+
+        self.clock.now += 1
+        self.scheduler.run_due()
+        self.assertEqual(self.published('dmx/'), [])
+
+    def test_preset_drops_coalesced_master(self):
+        self.coalesce_master()
+
+        self.send('preset/plenar/off', b'\x01')
+        self.client.published.clear()
+
+        self.clock.now += 1
+        self.scheduler.run_due()
+        self.assertEqual(self.published('dmx/'), [])
+
+    def test_press_survives_reload(self):
+        # released before, so the press is an edge
+        self.send('schalter/gate/1', b'\x00', retain=True)
+        self.send('schalter/gate/1', b'\x01')
+
+        self.clock.now += 3
+        self.assertTrue(self.logicer.reload_rules())
+        self.clock.now += 3
+        self.send('schalter/gate/1', b'\x00')
+
+        self.assertIn(('club/shutdown', b'\x44'), self.client.published)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Tests of `logicer.SpaceApiPublisher` against a local `http.server` standing
+in for the SpaceAPI webserver.
+
+Usage:
+    python -m pytest test_spaceapi.py
+"""
+
+import http.server
+import threading
+import time
+import unittest
+import urllib.parse
+
+import logicer
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """
+    Records the posted status updates and answers with the next of
+    `statuses` (200 once they are used up). While `blocked` is cleared,
+    requests wait before answering.
+    """
+
+    def __init__(self, statuses=()):
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(handler):
+                body = handler.rfile.read(int(handler.headers['Content-Length']))
+                form = urllib.parse.parse_qs(body.decode())
+                with self.lock:
+                    self.requests.append((time.monotonic(), form['state'][0], form.get('message', [''])[0]))
+                    status = self.statuses.pop(0) if self.statuses else 200
+
+                self.blocked.wait(5)
+
+                handler.send_response(status)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+
+            def log_message(handler, format, *args):
+                pass
+
+        super(StandIn, self).__init__(('127.0.0.1', 0), Handler)
+
+        self.statuses = list(statuses)
+        self.requests = []
+        self.lock = threading.Lock()
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/newstate'.format(self.server_address[1])
+
+    def updates(self):
+        with self.lock:
+            return [(state, message) for _, state, message in self.requests]
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.005)
+
+
+class SpaceApiPublisherTest(unittest.TestCase):
+
+    def start_publisher(self, server, retry_delays=(0.1, 0.2, 0.4)):
+        publisher = logicer.SpaceApiPublisher(url=server.url, password='test')
+        publisher.retry_delays = list(retry_delays)
+        publisher.timeout = 2
+        publisher.start()
+        return publisher
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.blocked.set()
+            server.shutdown()
+            server.server_close()
+
+    def stand_in(self, statuses=()):
+        server = StandIn(statuses)
+        self.servers.append(server)
+        return server
+
+    def test_latest_wins(self):
+        server = self.stand_in()
+        publisher = self.start_publisher(server)
+
+        # the first update is in flight while the next ones come in, only
+        # the latest of those is sent after it
+        server.blocked.clear()
+        publisher.submit('open', 'a')
+        wait_until(lambda: len(server.updates()) == 1)
+
+        for message in 'bcdef':
+            publisher.submit('open', message)
+        server.blocked.set()
+
+        wait_until(lambda: publisher.last_sent == ('open', 'f'))
+        time.sleep(0.1)
+        self.assertEqual(server.updates(), [('open', 'a'), ('open', 'f')])
+
+    def test_retry_with_backoff(self):
+        server = self.stand_in([503, 502, 500])
+        publisher = self.start_publisher(server)
+
+        publisher.submit('closed', 'bye')
+        wait_until(lambda: publisher.last_sent == ('closed', 'bye'))
+
+        self.assertEqual(server.updates(), [('closed', 'bye')] * 4)
+
+        times = [t for t, _, _ in server.requests]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        for gap, delay in zip(gaps, publisher.retry_delays):
+            self.assertGreaterEqual(gap, delay * 0.9)
+        self.assertLess(gaps[0], gaps[1])
+        self.assertLess(gaps[1], gaps[2])
+
+    def test_give_up_after_last_attempt(self):
+        server = self.stand_in([503] * 3)
+        publisher = self.start_publisher(server, retry_delays=[0.1, 1])
+
+        with self.assertLogs(level='WARNING') as logs:
+            publisher.submit('open', 'down')
+            wait_until(lambda: any('giving up' in line for line in logs.output))
+            gave_up = time.monotonic()
+
+        # no delay after the last attempt
+        self.assertEqual(len(server.updates()), 3)
+        self.assertLess(gave_up - server.requests[-1][0], 0.5)
+        self.assertEqual(len([line for line in logs.output if 'retrying' in line]), 2)
+
+    def test_retry_abandoned_for_newer_update(self):
+        server = self.stand_in([503])
+        publisher = self.start_publisher(server, retry_delays=[2])
+
+        publisher.submit('open', 'old')
+        wait_until(lambda: len(server.updates()) == 1)
+        publisher.submit('open', 'new')
+
+        wait_until(lambda: publisher.last_sent == ('open', 'new'), timeout=1)
+        self.assertEqual(server.updates(), [('open', 'old'), ('open', 'new')])
+
+    def test_unchanged_not_sent_again(self):
+        server = self.stand_in()
+        publisher = self.start_publisher(server)
+
+        publisher.submit('open', 'hi')
+        wait_until(lambda: publisher.last_sent == ('open', 'hi'))
+
+        publisher.submit('open', 'hi')
+        time.sleep(0.2)
+        self.assertEqual(server.updates(), [('open', 'hi')])
+
+        # a changed message or state is sent
+        publisher.submit('open', 'hello')
+        wait_until(lambda: len(server.updates()) == 2)
+        publisher.submit('closed', 'hello')
+        wait_until(lambda: len(server.updates()) == 3)
+
+        self.assertEqual(server.updates(), [('open', 'hi'), ('open', 'hello'), ('closed', 'hello')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+"""
+Renders the channel output of a scripter script into a timeline file, which
+`scripter.py --timeline FILE` plays back without running the script.
+
+Usage:
+    python timeline-render.py Test show.tml [--seconds 300] [--fps 100]
+"""
+
+import argparse
+import time
+
+import scripter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a scripter script to a timeline')
+    parser.add_argument('script', help='Name of the script class in scripter.py')
+    parser.add_argument('path', help='Timeline file to write')
+    parser.add_argument('--seconds', type=float, default=60, help='Length of the timeline')
+    parser.add_argument('--fps', type=float, default=scripter.FrameScheduler.fps, help='Frames per second')
+    parser.add_argument('--keyframe-interval', type=int, help='Frames between keyframes (default: {})'.format(
+            scripter.timeline.TimelineWriter.keyframe_interval))
+    args = parser.parse_args()
+
+    cls = getattr(scripter, args.script, None)
+    if not (isinstance(cls, type) and issubclass(cls, scripter.Script)):
+        parser.error('no script named {}'.format(args.script))
+
+    start = time.perf_counter()
+    writer = scripter.render_timeline(cls, args.path, args.seconds, args.fps, args.keyframe_interval)
+    duration = time.perf_counter() - start
+
+    print('{} frames, {} channels, {} bytes ({:.1f} bytes/frame) in {:.1f} s'.format(
+            writer.frames, len(writer.channels), writer.size,
+            writer.size / max(writer.frames, 1), duration))
+
+
+if __name__ == '__main__':
+    main()
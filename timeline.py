@@ -0,0 +1,196 @@
+"""
+Pre-rendered channel output of a script, played back by
+`scripter.TimelinePlayer` without running the script.
+
+A timeline file starts with `MAGIC` and the file offset of its index,
+followed by the frames: every `keyframe_interval`-th frame is a keyframe
+holding all channels set so far, the frames between are deltas holding the
+channels which changed. Both are a list of `(channel index, payload length,
+payload)` entries. The index at the end of the file has the `HEADER` (frames
+per second, number of frames, keyframe interval, number of channels, bytes
+per channel slot), the channels (name length, payload length, name) and the
+file offsets of the keyframes. When played, payloads are padded with zeros
+to the slot size and cut to their channel's payload length.
+
+The frames are written as they are added and the index once they are all
+known, so rendering long timelines does not hold them in memory.
+
+Seeking starts at the keyframe before the target frame and applies the
+deltas up to it.
+"""
+
+import mmap
+import os
+import struct
+
+
+MAGIC = b'AC4TMLN\x02'
+HEADER = struct.Struct('<dIIHB') # fps, frames, keyframe interval, channels, slot size
+CHANNEL = struct.Struct('<BB') # name length, payload length
+OFFSET = struct.Struct('<Q')
+RECORD = struct.Struct('<BH') # kind, entries
+ENTRY = struct.Struct('<HB') # channel index, payload length
+
+KEYFRAME = 0
+DELTA = 1
+
+
+class TimelineWriter():
+    """
+    Writes the channel changes of each frame to the timeline file as they
+    are added, `close` adds the index.
+    """
+
+    keyframe_interval = 100
+
+    def __init__(self, path, fps, keyframe_interval=None):
+        self.path = path
+        self.fps = fps
+        if keyframe_interval is not None:
+            self.keyframe_interval = keyframe_interval
+
+        # channel -> index, in order of appearance
+        self.channels = {}
+        self.lengths = []
+        # index -> current payload
+        self.state = {}
+        self.keyframes = []
+        self.frames = 0
+        self.size = None
+
+        self.tmp_path = self.path + '.tmp'
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(OFFSET.pack(0))
+
+    def add_frame(self, changes):
+        """
+        Add a frame, `changes` are `(channel, payload)` of the channels which
+        changed since the previous frame.
+        """
+
+        changed = {}
+        for channel, payload in changes:
+            if len(payload) > 255:
+                raise ValueError('payloads longer than 255 bytes')
+
+            index = self.channels.get(channel)
+            if index is None:
+                index = self.channels[channel] = len(self.channels)
+                self.lengths.append(0)
+            if len(payload) > self.lengths[index]:
+                self.lengths[index] = len(payload)
+
+            if self.state.get(index) != payload:
+                self.state[index] = changed[index] = bytes(payload)
+
+        if self.frames % self.keyframe_interval == 0:
+            self.keyframes.append(self.file.tell())
+            kind, entries = KEYFRAME, self.state
+        else:
+            kind, entries = DELTA, changed
+
+        record = bytearray(RECORD.pack(kind, len(entries)))
+        for index, payload in sorted(entries.items()):
+            record += ENTRY.pack(index, len(payload))
+            record += payload
+        self.file.write(record)
+        self.frames += 1
+
+    def close(self):
+        f = self.file
+        index_offset = f.tell()
+
+        index = bytearray(HEADER.pack(self.fps, self.frames, self.keyframe_interval, len(self.channels), max(self.lengths, default=1)))
+        for channel, length in zip(self.channels, self.lengths):
+            name = channel.encode('utf-8')
+            index += CHANNEL.pack(len(name), length)
+            index += name
+        index += b''.join(OFFSET.pack(o) for o in self.keyframes)
+        f.write(index)
+        self.size = f.tell()
+
+        f.seek(len(MAGIC))
+        f.write(OFFSET.pack(index_offset))
+        f.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class Timeline():
+    """
+    A memory mapped timeline file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a timeline: {}'.format(path))
+
+        offset, = OFFSET.unpack_from(self.data, len(MAGIC))
+        if not offset:
+            raise ValueError('incomplete timeline: {}'.format(path))
+
+        self.fps, self.frames, self.keyframe_interval, channel_count, self.slot = HEADER.unpack_from(self.data, offset)
+        offset += HEADER.size
+
+        self.channels = []
+        self.lengths = []
+        for _ in range(channel_count):
+            name_length, length = CHANNEL.unpack_from(self.data, offset)
+            offset += CHANNEL.size
+            self.channels.append(self.data[offset:offset + name_length].decode('utf-8'))
+            self.lengths.append(length)
+            offset += name_length
+
+        keyframe_count = -(-self.frames // self.keyframe_interval)
+        self.keyframes = [o for o, in OFFSET.iter_unpack(self.data[offset:offset + keyframe_count * OFFSET.size])]
+
+    @property
+    def duration(self):
+        return self.frames / self.fps
+
+    def new_state(self):
+        return bytearray(self.slot * len(self.channels))
+
+    def keyframe_before(self, frame):
+        """
+        Number and file offset of the last keyframe at or before `frame`.
+        """
+
+        k = frame // self.keyframe_interval
+        return k * self.keyframe_interval, self.keyframes[k]
+
+    def read_frame(self, offset, state, changed):
+        """
+        Apply the frame at `offset` to `state`, adding the indices of the
+        changed channels to `changed`. Returns the offset of the next frame.
+        """
+
+        data = self.data
+        slot = self.slot
+        kind, count = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+
+        if kind == KEYFRAME:
+            # channels not set yet are zeros
+            state[:] = bytes(len(state))
+            changed.update(range(len(self.channels)))
+
+        for _ in range(count):
+            index, length = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            start = index * slot
+            state[start:start + length] = data[offset:offset + length]
+            state[start + length:start + slot] = bytes(slot - length)
+            offset += length
+            changed.add(index)
+        return offset
+
+    def payload(self, state, index):
+        start = index * self.slot
+        return bytes(state[start:start + self.lengths[index]])
+
+    def close(self):
+        self.data.close()